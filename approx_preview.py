@@ -0,0 +1,148 @@
+import re
+import threading
+import time
+
+from warehouse_router import HEAVY_TABLES, referenced_tables
+from table_layout import current_layout, is_large
+
+# Share of a heavy table the preview reads
+PREVIEW_SAMPLE_PERCENT = 10
+
+AGGREGATE_PATTERN = re.compile(r"\b(?:COUNT|SUM|AVG|MEDIAN|PERCENTILE_CONT)\s*\(|\bGROUP\s+BY\b", re.IGNORECASE)
+
+# Words that can follow a table reference but are not an alias
+NOT_ALIAS = (
+    "WHERE|JOIN|ON|USING|GROUP|ORDER|LIMIT|INNER|LEFT|RIGHT|FULL|CROSS|NATURAL|HAVING|QUALIFY|UNION|"
+    "SAMPLE|TABLESAMPLE|EXCEPT|INTERSECT|MINUS"
+)
+
+# Function to list the heavy tables a query reads, from HEAVY_TABLES and the loaded layout
+def heavy_tables(sql):
+    layout = current_layout()
+    return {
+        table for table in referenced_tables(sql)
+        if table in HEAVY_TABLES or (table in layout and is_large(layout[table]))
+    }
+
+# Function to tell whether a query is an aggregation over a heavy table worth previewing
+def wants_preview(sql):
+    return bool(heavy_tables(sql)) and bool(AGGREGATE_PATTERN.search(sql))
+
+# Function to find the closing parenthesis matching the one at open_index
+def matching_paren(sql, open_index):
+    depth = 0
+    for i in range(open_index, len(sql)):
+        if sql[i] == "(":
+            depth += 1
+        elif sql[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+# Function to tell whether a position in a query sits inside a subquery, i.e. within parentheses opened by a SELECT
+def in_subquery(sql, index):
+    opened = []
+    for i in range(index):
+        if sql[i] == "(":
+            opened.append(i)
+        elif sql[i] == ")" and opened:
+            opened.pop()
+    return any(re.match(r"\s*SELECT\b", sql[i + 1:], re.IGNORECASE) for i in opened)
+
+# Function to rewrite NAME(args) calls; build(args) returns the replacement or None to keep the call.
+# With where, only calls at positions where(sql, index) accepts are rewritten.
+def replace_calls(sql, name, build, where=None):
+    for match in reversed(list(re.finditer(rf"\b{name}\s*\(", sql, re.IGNORECASE))):
+        if where is not None and not where(sql, match.start()):
+            continue
+        close = matching_paren(sql, match.end() - 1)
+        if close is None:
+            continue
+        replacement = build(sql[match.end():close])
+        if replacement is not None:
+            sql = sql[:match.start()] + replacement + sql[close + 1:]
+    return sql
+
+# Function to swap exact distinct counts and percentiles for their approximate versions
+def approximate_functions(sql):
+    def count_distinct(args):
+        distinct = re.match(r"\s*DISTINCT\s+(.*)$", args, re.IGNORECASE | re.DOTALL)
+        return f"APPROX_COUNT_DISTINCT({distinct.group(1)})" if distinct else None
+
+    sql = replace_calls(sql, "COUNT", count_distinct)
+    sql = replace_calls(sql, "MEDIAN", lambda args: f"APPROX_PERCENTILE({args}, 0.5)")
+    return re.sub(
+        r"\bPERCENTILE_CONT\s*\(\s*([0-9.]+)\s*\)\s*WITHIN\s+GROUP\s*\(\s*ORDER\s+BY\s+([^()]+?)\s*\)",
+        r"APPROX_PERCENTILE(\2, \1)", sql, flags=re.IGNORECASE
+    )
+
+# Function to read a block sample of the first heavy table and scale counts and sums back up.
+# Only the outer query's aggregates read the sampled rows directly, so subquery aggregates stay as
+# they are. None when the heavy table is read inside a subquery or CTE, or through the outer side
+# of a join, where a scaled result would be wrong.
+def sample_heavy_table(sql, tables, percent):
+    if re.match(r"\s*WITH\b", sql, re.IGNORECASE):
+        return None
+    table_pattern = "|".join(re.escape(table) for table in tables)
+    references = list(re.finditer(
+        rf"\b(?:FROM|JOIN)\s+(?:[A-Za-z0-9_\"]+\.)*\"?(?:{table_pattern})\"?"
+        rf"(?:\s+(?:AS\s+)?(?!(?:{NOT_ALIAS})\b)[A-Za-z_][A-Za-z0-9_]*)?",
+        sql, re.IGNORECASE
+    ))
+    if not references or any(in_subquery(sql, match.start()) for match in references):
+        return None
+    first = references[0]
+    if re.search(r"\b(?:LEFT|RIGHT|FULL)(?:\s+OUTER)?\s+$", sql[:first.start()], re.IGNORECASE):
+        return None
+    sampled = f"{sql[:first.end()]} SAMPLE SYSTEM ({percent}){sql[first.end():]}"
+    factor = 100 / percent
+
+    def outer(text, index):
+        return not in_subquery(text, index)
+
+    sampled = replace_calls(sampled, "COUNT", lambda args: f"ROUND(COUNT({args}) * {factor:g})", outer)
+    return replace_calls(sampled, "SUM", lambda args: f"(SUM({args}) * {factor:g})", outer)
+
+# Function to rewrite a heavy aggregation into a fast approximate query; None when there is no cheaper form.
+# Distinct counts and percentiles use APPROX_* over all rows (they cannot be scaled from a sample);
+# plain counts and sums read a sample and are scaled up.
+def approximate_sql(sql, percent=PREVIEW_SAMPLE_PERCENT):
+    if not wants_preview(sql):
+        return None
+    approximated = approximate_functions(sql)
+    if approximated != sql:
+        return approximated
+    return sample_heavy_table(sql, heavy_tables(sql), percent)
+
+# Function to run the exact query on a pooled connection; called on a background thread
+def run_refinement(pool, fetch, job):
+    conn = None
+    error = None
+    try:
+        conn = pool.acquire()
+        job["df"] = fetch(conn, job["sql"])
+        job["status"] = "done"
+    except Exception as e:
+        error = e
+        job["status"] = "error"
+        job["error"] = str(e)
+    finally:
+        if conn is not None:
+            pool.release(conn, error)
+        job["finished_at"] = time.time()
+
+# Function to start the exact query behind a preview in the background.
+# fetch(conn, sql) returns a DataFrame; the job's df is filled in when it finishes.
+def start_refinement(pool, sql, fetch):
+    job = {
+        "sql": sql,
+        "status": "running",
+        "df": None,
+        "error": None,
+        "started_at": time.time(),
+        "finished_at": None,
+    }
+    job["thread"] = threading.Thread(target=run_refinement, args=(pool, fetch, job), daemon=True)
+    job["thread"].start()
+    return job
@@ -0,0 +1,291 @@
+import datetime
+import decimal
+import gzip
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pyarrow as pa
+
+# Cassette mode comes from the environment so both apps can record or replay unchanged:
+#   LOANBOT_CASSETTE_MODE = record | replay | replay_fast
+#   LOANBOT_CASSETTE      = path of the gzipped JSON-lines cassette file
+CASSETTE_MODE = os.environ.get("LOANBOT_CASSETTE_MODE", "")
+CASSETTE_PATH = os.environ.get("LOANBOT_CASSETTE", "loanbot_cassette.jsonl.gz")
+
+_write_lock = threading.Lock()
+# Replays hand out recorded events once unless a load test asks for them to repeat
+_replay_repeat = False
+
+# Function to turn Snowflake values into JSON-safe values
+def encode_value(value):
+    if isinstance(value, decimal.Decimal):
+        return {"$d": str(value)}
+    if isinstance(value, datetime.datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"$date": value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {"$t": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$b": value.hex()}
+    return value
+
+# Function to restore values written by encode_value
+def decode_value(value):
+    if isinstance(value, dict):
+        if "$d" in value:
+            return decimal.Decimal(value["$d"])
+        if "$dt" in value:
+            return datetime.datetime.fromisoformat(value["$dt"])
+        if "$date" in value:
+            return datetime.date.fromisoformat(value["$date"])
+        if "$t" in value:
+            return datetime.time.fromisoformat(value["$t"])
+        if "$b" in value:
+            return bytes.fromhex(value["$b"])
+    return value
+
+# Function to append one event to the cassette file
+def write_event(event, path=CASSETTE_PATH):
+    line = json.dumps(event, separators=(",", ":")) + "\n"
+    with _write_lock:
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.write(line)
+
+# Function to read every event from a cassette file
+def read_events(path=CASSETTE_PATH):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Function to turn an Arrow table into row tuples, as fetchall() returns them
+def table_rows(table):
+    return list(zip(*(column.to_pylist() for column in table.columns)))
+
+# Function to build an Arrow table from row tuples and a cursor description; None when there are no rows
+def rows_table(rows, description):
+    if not rows:
+        return None
+    names = [desc[0] for desc in description]
+    return pa.Table.from_arrays([pa.array(list(column)) for column in zip(*rows)], names=names)
+
+# ---- Recording ----
+
+# Function to pass OpenAI stream chunks through while recording their content and timing
+def record_stream(stream, path=CASSETTE_PATH):
+    chunks = []
+    last = time.perf_counter()
+    try:
+        for chunk in stream:
+            now = time.perf_counter()
+            content = chunk.choices[0].delta.content if chunk.choices else None
+            chunks.append([round((now - last) * 1000, 1), content or ""])
+            last = now
+            yield chunk
+    finally:
+        write_event({"type": "completion", "chunks": chunks}, path)
+
+class RecordingCompletions:
+    def __init__(self, completions, path):
+        self._completions = completions
+        self._path = path
+
+    def create(self, **kwargs):
+        response = self._completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return record_stream(response, self._path)
+        return response
+
+class RecordingOpenAI:
+    def __init__(self, client, path=CASSETTE_PATH):
+        self._client = client
+        self.chat = SimpleNamespace(completions=RecordingCompletions(client.chat.completions, path))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+class RecordingCursor:
+    def __init__(self, cursor, path):
+        self._cursor = cursor
+        self._path = path
+        self._sql = None
+        self._start = None
+        self._elapsed_ms = None
+
+    def execute(self, sql, params=None):
+        self._sql = sql
+        self._start = time.perf_counter()
+        result = self._cursor.execute(sql, params) if params is not None else self._cursor.execute(sql)
+        self._elapsed_ms = round((time.perf_counter() - self._start) * 1000, 1)
+        return result
+
+    def _record(self, rows):
+        write_event({
+            "type": "query",
+            "sql": self._sql,
+            "elapsed_ms": self._elapsed_ms,
+            "description": [list(desc) for desc in self._cursor.description or []],
+            "rows": [[encode_value(v) for v in row] for row in rows],
+        }, self._path)
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._record(rows)
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._record([row] if row is not None else [])
+        return row
+
+    def fetch_arrow_all(self):
+        table = self._cursor.fetch_arrow_all()
+        self._record(table_rows(table) if table is not None else [])
+        return table
+
+    # Batches pass through unchanged; their rows are recorded once the last batch is read
+    def fetch_arrow_batches(self):
+        rows = []
+        try:
+            for batch in self._cursor.fetch_arrow_batches():
+                rows.extend(table_rows(batch))
+                yield batch
+        finally:
+            self._record(rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class RecordingConnection:
+    def __init__(self, conn, path=CASSETTE_PATH):
+        self._conn = conn
+        self._path = path
+
+    def cursor(self):
+        return RecordingCursor(self._conn.cursor(), self._path)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+# ---- Replay ----
+
+class ReplayCassette:
+    def __init__(self, path=CASSETTE_PATH, realtime=True, repeat=False):
+        events = read_events(path)
+        self.realtime = realtime
+        # Repeating cassettes hand out the same events forever, for load tests
+        self.repeat = repeat
+        self.completions = [e for e in events if e["type"] == "completion"]
+        self.queries = [e for e in events if e["type"] == "query"]
+        self._lock = threading.Lock()
+
+    # Function to take the next recorded completion
+    def next_completion(self):
+        with self._lock:
+            if not self.completions:
+                return {"chunks": []}
+            event = self.completions.pop(0)
+            if self.repeat:
+                self.completions.append(event)
+            return event
+
+    # Function to take the recorded result for a SQL statement, preferring an exact match
+    def take_query(self, sql):
+        with self._lock:
+            for i, event in enumerate(self.queries):
+                if event["sql"] == sql:
+                    return event if self.repeat else self.queries.pop(i)
+        return None
+
+def replay_stream(cassette, event):
+    for delay_ms, content in event["chunks"]:
+        if cassette.realtime and delay_ms:
+            time.sleep(delay_ms / 1000)
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+class ReplayCompletions:
+    def __init__(self, cassette):
+        self._cassette = cassette
+
+    def create(self, **kwargs):
+        event = self._cassette.next_completion()
+        stream = replay_stream(self._cassette, event)
+        if kwargs.get("stream"):
+            return stream
+        content = "".join(chunk.choices[0].delta.content for chunk in stream)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+class ReplayOpenAI:
+    def __init__(self, cassette):
+        self.chat = SimpleNamespace(completions=ReplayCompletions(cassette))
+
+    def close(self):
+        pass
+
+class ReplayCursor:
+    def __init__(self, cassette):
+        self._cassette = cassette
+        self._rows = []
+        self.description = None
+        self.sfqid = None
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        event = self._cassette.take_query(sql)
+        # Statements that were never fetched (USE WAREHOUSE, ...) replay as empty results
+        if event is None:
+            self._rows, self.description = [], []
+        else:
+            if self._cassette.realtime and event.get("elapsed_ms"):
+                time.sleep(event["elapsed_ms"] / 1000)
+            self._rows = [tuple(decode_value(v) for v in row) for row in event["rows"]]
+            self.description = [tuple(desc) for desc in event["description"]]
+        self.rowcount = len(self._rows)
+        return self
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetch_arrow_all(self):
+        rows, self._rows = self._rows, []
+        return rows_table(rows, self.description)
+
+    # Function to hand the recorded rows back as one Arrow table, as exports read them
+    def fetch_arrow_batches(self):
+        table = self.fetch_arrow_all()
+        if table is not None:
+            yield table
+
+    def close(self):
+        pass
+
+class ReplayConnection:
+    def __init__(self, cassette):
+        self._cassette = cassette
+
+    def cursor(self):
+        return ReplayCursor(self._cassette)
+
+    def close(self):
+        pass
+
+# Function to make every replay cassette opened from now on in this process repeat its events, for load tests
+def repeat_replays():
+    global _replay_repeat
+    _replay_repeat = True
+
+# Function to wrap or replace the Snowflake connection and OpenAI client for the current mode
+def apply_cassette_mode(conn_factory, client_factory, mode=CASSETTE_MODE, path=CASSETTE_PATH):
+    if mode in ("replay", "replay_fast"):
+        cassette = ReplayCassette(path, realtime=(mode == "replay"), repeat=_replay_repeat)
+        return ReplayConnection(cassette), ReplayOpenAI(cassette)
+    conn, client = conn_factory(), client_factory()
+    if mode == "record":
+        return RecordingConnection(conn, path), RecordingOpenAI(client, path)
+    return conn, client
@@ -0,0 +1,502 @@
+import argparse
+import asyncio
+import hmac
+import json
+import math
+import os
+import secrets
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import tornado.escape
+import tornado.httpclient
+import tornado.ioloop
+import tornado.iostream
+import tornado.web
+import tornado.websocket
+from openai import OpenAI
+
+try:
+    from streamlit.testing.v1 import AppTest
+except ImportError:
+    AppTest = None
+
+from cassette import CASSETTE_MODE, CASSETTE_PATH, apply_cassette_mode, repeat_replays, ReplayCassette, ReplayConnection, ReplayOpenAI
+from intent_router import route_intent
+from loanbot_pipeline import (
+    TABLES, init_snowflake_connection, get_table_schema, build_system_prompt,
+    chat_messages, turn_examples, record_turn_outcome, generate_response, extract_sql_blocks, fetch_sql, record_result, run_sql, run_sql_blocks, make_sql_pool,
+    run_response_sql
+)
+from model_ladder import record_execution, remember_failure
+from table_layout import load_table_layout
+from warehouse_router import start_metrics_sync
+from value_dictionary import start_value_sync
+from approx_preview import approximate_sql
+from prefetch import new_prefetch_cache, start_prefetch, take_prefetched
+from session_registry import REAP_INTERVAL_SECONDS, touch_session, is_evicted, remove_session, release_session, start_reaper
+from result_export import EXPORT_DIR
+from result_store import RESULT_HISTORY
+from local_replica import disable_replica
+
+# Headless LoanBot service: streams tokens over SSE or WebSocket and serves results as Arrow IPC.
+#   GET    /sessions/<id>/chat?q=...   Server-Sent Events: model, token, escalate, sql, preview, result, error, done
+#   WS     /sessions/<id>/ws           send {"q": ..., "preview": bool}; JSON events, Arrow IPC frames as binary
+#   GET    /sessions/<id>/results/<n>  Arrow IPC stream of the n-th result
+#   POST   /sessions, DELETE /sessions/<id>
+#   GET    /exports/<file>             a finished export from the Streamlit app, streamed from disk
+# With preview=1, heavy aggregations also run an approximate query beside the exact one and send it as a
+# preview event when it finishes first. Results of the last RESULT_HISTORY turns stay downloadable.
+#
+# Every session runs queries as the server's Snowflake user, so the API is private by default:
+#   - it binds to 127.0.0.1 unless --host (or LOANBOT_API_HOST) says otherwise;
+#   - /sessions/... requires LOANBOT_API_TOKEN as "Authorization: Bearer <token>" or, for
+#     browser WebSockets, a ?token= argument. Without the variable a random token is printed at startup;
+#   - /exports/ takes no token: its unguessable file name is the credential, so links can be shared.
+
+# Blocking Snowflake and OpenAI calls run here so the event loop only moves bytes
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("LOANBOT_API_THREADS", "64")))
+
+API_TOKEN = os.environ.get("LOANBOT_API_TOKEN") or secrets.token_urlsafe(32)
+
+sessions = {}
+_prompt_cache = {}
+_prompt_lock = threading.Lock()
+_shared_cassette = None
+
+# Function to open a Snowflake connection from the environment
+def snowflake_connection():
+    return init_snowflake_connection(os.environ["LOANBOT_SNOWFLAKE_PASSWORD"])
+
+# Function to open the Snowflake connection and OpenAI client for a new session
+def connect_session():
+    if _shared_cassette is not None:
+        return ReplayConnection(_shared_cassette), ReplayOpenAI(_shared_cassette)
+    return apply_cassette_mode(snowflake_connection, lambda: OpenAI(api_key=os.environ["OPENAI_API_KEY"]))
+
+# Function to create a session; the schema prompt is built once per process
+def create_session():
+    conn, client = connect_session()
+    # Sessions are created concurrently on the executor; only the first one builds the prompt
+    with _prompt_lock:
+        if not _prompt_cache:
+            if not (CASSETTE_MODE or _shared_cassette):
+                start_value_sync(snowflake_connection, TABLES)
+                start_metrics_sync(snowflake_connection)
+            schema = {table: get_table_schema(conn, table) for table in TABLES}
+            try:
+                layout = load_table_layout(conn, schema)
+            except Exception:
+                layout = None
+            system_prompt, _ = build_system_prompt(schema, layout)
+            _prompt_cache["schema"] = schema
+            _prompt_cache["system_prompt"] = system_prompt
+    session_id = uuid.uuid4().hex
+    sessions[session_id] = {
+        "snowflake_conn": conn,
+        "sql_pool": make_sql_pool(conn, None if CASSETTE_MODE or _shared_cassette else snowflake_connection),
+        "openai_client": client,
+        "messages": [],
+        "result_store": [],
+        "results": {},
+        "result_count": 0,
+        "turn_results": [],
+        "prefetch": new_prefetch_cache(),
+    }
+    touch_session(session_id, sessions[session_id])
+    return session_id
+
+# Function to look up a live session; evicted ones carry the reaper's marker in their state
+def live_session(session_id):
+    session = sessions.get(session_id)
+    if session is None or is_evicted(session_id, session):
+        sessions.pop(session_id, None)
+        return None
+    return session
+
+# Function to forget sessions the reaper has evicted, so their state can be freed
+def prune_sessions():
+    for session_id in list(sessions):
+        live_session(session_id)
+
+# Function to check a request's API token, from the Authorization header or a token argument
+def authorized(handler):
+    header = handler.request.headers.get("Authorization", "")
+    token = header[len("Bearer "):] if header.startswith("Bearer ") else handler.get_argument("token", "")
+    return hmac.compare_digest(token.encode(), API_TOKEN.encode())
+
+# Function to serialize a result as an Arrow IPC stream
+def to_arrow_ipc(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+# Function to iterate a blocking generator on the executor without blocking the event loop
+async def iterate_in_thread(make_generator):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def worker():
+        try:
+            for item in make_generator():
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    loop.run_in_executor(EXECUTOR, worker)
+    while True:
+        item = await queue.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+# Function to describe a stored result for a result or preview event
+def result_payload(session, df):
+    index = session["result_count"]
+    session["result_count"] += 1
+    session["results"][index] = df
+    session["turn_results"][-1].append(index)
+    return {"index": index, "rows": len(df), "columns": list(map(str, df.columns)), "df": df}
+
+# Function to start a turn's list of results, dropping the results of turns older than RESULT_HISTORY
+def start_turn_results(session):
+    session["turn_results"].append([])
+    while len(session["turn_results"]) > RESULT_HISTORY:
+        for index in session["turn_results"].pop(0):
+            session["results"].pop(index, None)
+
+# Function to run a query on a connection borrowed from the session's pool
+def fetch_pooled(pool, sql, result_store):
+    conn = pool.acquire()
+    error = None
+    try:
+        return fetch_sql(conn, sql, result_store)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        pool.release(conn, error)
+
+# Function to answer a template query, from the prefetch cache when the drill-down was predicted
+def run_template(session, intent):
+    store = session["result_store"]
+    df = take_prefetched(session["prefetch"], intent)
+    if df is None:
+        df = run_sql(session["snowflake_conn"], intent["sql"], None, store)
+    else:
+        record_result(intent["sql"], df, None, store)
+    # Cassettes replay queries in order, so nothing is fetched speculatively there
+    if not (CASSETTE_MODE or _shared_cassette):
+        start_prefetch(session["prefetch"], session["sql_pool"], intent, df, lambda conn, q: fetch_sql(conn, q, store))
+    return df
+
+# Function to run one chat turn, yielding (event, payload) pairs
+async def run_turn(session, prompt, preview=False):
+    loop = asyncio.get_running_loop()
+    session["messages"].append({"role": "user", "content": prompt})
+    start_turn_results(session)
+    full_response = ""
+    intent = route_intent(prompt)
+    examples = []
+    model = None
+    ran = None
+    if intent and intent.get("sql"):
+        sql_blocks = [intent["sql"]]
+        full_response = intent["summary"]
+        yield "token", full_response
+    else:
+        examples = turn_examples(prompt, session["result_store"])
+        messages = chat_messages(_prompt_cache["system_prompt"], session["messages"], prompt, session["result_store"], examples)
+        # Heavy aggregations race a preview below, so their exact query is not run while generating
+        def run_response(response):
+            return run_response_sql(
+                session["snowflake_conn"], session["sql_pool"], response, _prompt_cache["schema"], session["result_store"],
+                lambda sql: preview and approximate_sql(sql) is not None
+            )
+
+        # Simple questions start on the cheapest model; rejected or failing SQL climbs the ladder.
+        # Cassettes record no failed queries, so recorded turns only climb on rejected SQL.
+        replaying = CASSETTE_MODE or _shared_cassette
+        compile_pool = None if replaying else session["sql_pool"]
+        async for event, payload in iterate_in_thread(lambda: generate_response(
+            session["openai_client"], compile_pool, messages, prompt, _prompt_cache["schema"], session["result_store"],
+            execute=None if replaying else run_response
+        )):
+            if event == "model":
+                model = payload
+                yield "model", model
+            elif event == "escalate":
+                # Clients discard the tokens of the rejected answer
+                full_response = ""
+                yield "escalate", payload
+            elif event == "executed":
+                ran = payload["outcomes"]
+            else:
+                full_response += payload
+                yield "token", payload
+        sql_blocks = extract_sql_blocks(full_response)
+
+    if len(sql_blocks) > 1:
+        # Independent blocks run concurrently on the session's pool
+        outcomes = ran or await loop.run_in_executor(
+            EXECUTOR, run_sql_blocks, session["sql_pool"], sql_blocks, _prompt_cache["schema"], session["result_store"]
+        )
+        blocks_ok = all(outcome["error"] is None for outcome in outcomes)
+        if model is not None:
+            record_execution(model, blocks_ok)
+        if not blocks_ok:
+            remember_failure(prompt)
+        for outcome in outcomes:
+            yield "sql", outcome["sql"]
+            if outcome["error"] is not None:
+                yield "error", str(outcome["error"])
+                continue
+            yield "result", result_payload(session, outcome["df"])
+    elif sql_blocks:
+        sql = sql_blocks[0]
+        yield "sql", sql
+        if intent and intent.get("sql"):
+            exact = loop.run_in_executor(EXECUTOR, run_template, session, intent)
+        elif ran is not None:
+            # Already run while the answer was generated
+            exact = loop.create_future()
+            if ran[0]["error"] is None:
+                exact.set_result(ran[0]["df"])
+            else:
+                exact.set_exception(ran[0]["error"])
+        else:
+            exact = loop.run_in_executor(
+                EXECUTOR, run_sql, session["snowflake_conn"], sql, _prompt_cache["schema"], session["result_store"]
+            )
+        # The estimate runs beside the exact query on a pooled connection and is only sent if it wins
+        preview_sql = approximate_sql(sql) if preview else None
+        if preview_sql:
+            estimate = loop.run_in_executor(EXECUTOR, fetch_pooled, session["sql_pool"], preview_sql, session["result_store"])
+            # A late or failed estimate is dropped; reading its exception keeps asyncio from logging it
+            estimate.add_done_callback(lambda future: future.exception())
+            await asyncio.wait([exact, estimate], return_when=asyncio.FIRST_COMPLETED)
+            if estimate.done() and not exact.done() and estimate.exception() is None:
+                yield "preview", result_payload(session, estimate.result())
+        try:
+            df = await exact
+            if not (intent and intent.get("sql")):
+                record_turn_outcome(prompt, sql, df, examples, session["result_store"], model)
+            yield "result", result_payload(session, df)
+        except Exception as e:
+            if not intent:
+                record_turn_outcome(prompt, sql, None, examples, session["result_store"], model)
+            yield "error", str(e)
+    session["messages"].append({"role": "assistant", "content": full_response})
+    yield "done", {}
+
+class SessionHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        if not authorized(self):
+            raise tornado.web.HTTPError(401)
+
+    def get_session(self, session_id):
+        session = live_session(session_id)
+        if session is None:
+            raise tornado.web.HTTPError(404)
+        touch_session(session_id, session)
+        return session
+
+class SessionsHandler(SessionHandler):
+    async def post(self):
+        session_id = await asyncio.get_running_loop().run_in_executor(EXECUTOR, create_session)
+        self.write({"session_id": session_id})
+
+class SessionItemHandler(SessionHandler):
+    def delete(self, session_id):
+        session = self.get_session(session_id)
+        release_session(session)
+        sessions.pop(session_id, None)
+        remove_session(session_id)
+        self.set_status(204)
+
+class ChatSSEHandler(SessionHandler):
+    async def get(self, session_id):
+        session = self.get_session(session_id)
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        turn = run_turn(session, self.get_argument("q"), self.get_argument("preview", "0") == "1")
+        try:
+            async for event, payload in turn:
+                if event in ("preview", "result"):
+                    payload = {k: v for k, v in payload.items() if k != "df"}
+                    payload["url"] = f"/sessions/{session_id}/results/{payload['index']}"
+                self.write(f"event: {event}\ndata: {json.dumps(payload)}\n\n")
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            # The client went away mid-turn; the rest of the turn has nobody to go to
+            pass
+        finally:
+            await turn.aclose()
+
+class ResultHandler(SessionHandler):
+    def get(self, session_id, index):
+        session = self.get_session(session_id)
+        df = session["results"].get(int(index))
+        if df is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "application/vnd.apache.arrow.stream")
+        self.write(to_arrow_ipc(df))
+
+# Streams export files from disk in chunks; the unguessable file name is the link's credential
+class ExportHandler(tornado.web.StaticFileHandler):
+    def set_extra_headers(self, path):
+        self.set_header("Content-Disposition", f'attachment; filename="loanbot_export{os.path.splitext(path)[1]}"')
+
+class ChatWebSocketHandler(tornado.websocket.WebSocketHandler):
+    def prepare(self):
+        if not authorized(self):
+            raise tornado.web.HTTPError(401)
+
+    def open(self, session_id):
+        self.session_id = session_id
+        if live_session(session_id) is None:
+            self.close(4004, "unknown session")
+
+    async def on_message(self, message):
+        session = live_session(self.session_id)
+        if session is None:
+            await self.write_message(json.dumps({"event": "error", "data": "session expired or unknown"}))
+            self.close(4004, "unknown session")
+            return
+        touch_session(self.session_id, session)
+        try:
+            request = json.loads(message)
+            prompt = request["q"]
+        except (ValueError, TypeError, KeyError):
+            await self.write_message(json.dumps({"event": "error", "data": 'expected {"q": ...}'}))
+            return
+        turn = run_turn(session, prompt, bool(request.get("preview")))
+        try:
+            async for event, payload in turn:
+                if event in ("preview", "result"):
+                    df = payload.pop("df")
+                    await self.write_message(json.dumps({"event": event, "data": payload}))
+                    await self.write_message(to_arrow_ipc(df), binary=True)
+                else:
+                    await self.write_message(json.dumps({"event": event, "data": payload}))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+        finally:
+            await turn.aclose()
+
+# Function to build the Tornado application
+def make_app():
+    return tornado.web.Application([
+        (r"/sessions", SessionsHandler),
+        (r"/sessions/([0-9a-f]+)", SessionItemHandler),
+        (r"/sessions/([0-9a-f]+)/chat", ChatSSEHandler),
+        (r"/sessions/([0-9a-f]+)/results/([0-9]+)", ResultHandler),
+        (r"/sessions/([0-9a-f]+)/ws", ChatWebSocketHandler),
+        (r"/exports/([A-Za-z0-9_-]+\.(?:parquet|csv))", ExportHandler, {"path": EXPORT_DIR}),
+    ])
+
+# Function to print throughput and latency for a benchmark run; p95 is the nearest-rank percentile
+def report(label, latencies, total, wall, cpu):
+    ordered = sorted(latencies)
+    print(f"{label}: {total / wall:.1f} turns/s, "
+          f"p50 {statistics.median(ordered) * 1000:.0f} ms, "
+          f"p95 {ordered[math.ceil(len(ordered) * 0.95) - 1] * 1000:.0f} ms, "
+          f"{total / cpu:.1f} turns per CPU-second")
+
+# Function to benchmark concurrent sessions against an in-process server replaying a cassette
+async def benchmark(port, session_count, turns, question):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=session_count)
+    base = f"http://127.0.0.1:{port}"
+    headers = {"Authorization": f"Bearer {API_TOKEN}"}
+    latencies = []
+
+    async def one_session():
+        response = await client.fetch(f"{base}/sessions", method="POST", body=b"", headers=headers)
+        session_id = json.loads(response.body)["session_id"]
+        for _ in range(turns):
+            start = time.perf_counter()
+            await client.fetch(
+                f"{base}/sessions/{session_id}/chat?q={tornado.escape.url_escape(question)}",
+                headers=headers, streaming_callback=lambda chunk: None, request_timeout=300
+            )
+            latencies.append(time.perf_counter() - start)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(one_session() for _ in range(session_count)))
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    report(f"API, {session_count} sessions x {turns} turns (client and server share this process)",
+           latencies, session_count * turns, wall, cpu)
+
+# Function to benchmark the Streamlit app on the same cassette. Each session is an AppTest that reruns
+# the whole script for every interaction, as a browser session does, on its own thread.
+def benchmark_streamlit(app_path, session_count, turns, question):
+    latencies = []
+
+    def one_session(_):
+        app = AppTest.from_file(app_path, default_timeout=300).run()
+        # Replay modes connect without credentials
+        next(button for button in app.button if button.label == "Connect").click().run()
+        for _ in range(turns):
+            start = time.perf_counter()
+            app.chat_input[0].set_value(question).run()
+            latencies.append(time.perf_counter() - start)
+
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=session_count) as executor:
+        list(executor.map(one_session, range(session_count)))
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    report(f"Streamlit ({os.path.basename(app_path)}), {session_count} sessions x {turns} turns",
+           latencies, session_count * turns, wall, cpu)
+
+async def main():
+    global _shared_cassette
+    parser = argparse.ArgumentParser(description="Headless LoanBot chat API")
+    parser.add_argument("--host", default=os.environ.get("LOANBOT_API_HOST", "127.0.0.1"),
+                        help="address to bind; anything but localhost exposes the server's Snowflake credentials")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--bench", type=int, metavar="SESSIONS", help="benchmark this many concurrent sessions")
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--question", default="which accounts have the most open opportunities")
+    parser.add_argument("--app", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "newplot_v2.py"),
+                        help="Streamlit app the benchmark compares against")
+    args = parser.parse_args()
+    # Both benchmarks replay the same cassette: the API through a shared one, the app through
+    # LOANBOT_CASSETTE_MODE, whose replay or replay_fast also picks recorded or no timing
+    if args.bench and CASSETTE_MODE not in ("replay", "replay_fast"):
+        parser.error("--bench needs LOANBOT_CASSETTE_MODE=replay or replay_fast")
+    if args.bench and AppTest is None:
+        parser.error("--bench needs streamlit to run the app it compares against")
+
+    start_reaper()
+    tornado.ioloop.PeriodicCallback(prune_sessions, REAP_INTERVAL_SECONDS * 1000).start()
+    if args.bench:
+        # Benchmarks always replay a cassette so results are repeatable and free
+        _shared_cassette = ReplayCassette(CASSETTE_PATH, realtime=CASSETTE_MODE == "replay", repeat=True)
+        repeat_replays()
+        disable_replica()
+    app = make_app()
+    app.listen(args.port, address="127.0.0.1" if args.bench else args.host)
+    if args.bench:
+        await benchmark(args.port, args.bench, args.turns, args.question)
+        await asyncio.get_running_loop().run_in_executor(
+            None, benchmark_streamlit, args.app, args.bench, args.turns, args.question
+        )
+    else:
+        print(f"LoanBot chat API listening on {args.host}:{args.port} (cassette mode: {CASSETTE_MODE or 'off'})")
+        if not os.environ.get("LOANBOT_API_TOKEN"):
+            print(f"API token for this run (set LOANBOT_API_TOKEN to fix it): {API_TOKEN}")
+        await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    asyncio.run(main())
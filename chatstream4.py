@@ -3,9 +3,31 @@ import snowflake.connector
 import pandas as pd
 from openai import OpenAI
 import re
+import time
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from warehouse_router import DEFAULT_WAREHOUSE, start_metrics_sync
+from local_replica import start_replica_sync, replica_staleness
+from cassette import CASSETTE_MODE, apply_cassette_mode
+from result_store import system_messages
+from result_summary import summarize_result
+from loanbot_pipeline import TABLES, build_system_prompt, generate_response, run_sql, turn_examples, record_turn_outcome, make_sql_pool
+from value_dictionary import start_value_sync
+from example_store import format_examples
+from result_dtypes import memory_report
+from table_layout import load_table_layout, unpruned_scans, scan_summary
+from session_registry import touch_session, is_evicted, remove_session, start_reaper, session_usage, ADMIN_VIEW_ENABLED
 
 st.title("🏦 Loan Officer Performance Chatbot")
 
+# Track this session so idle sessions get their connections closed
+start_reaper()
+session_ctx = get_script_run_ctx()
+if is_evicted(session_ctx.session_id, st.session_state):
+    st.session_state.clear()
+    remove_session(session_ctx.session_id)
+    st.warning("Your session was closed after being idle. Please reconnect.")
+touch_session(session_ctx.session_id, session_ctx.session_state)
+
 # Initialize session state variables
 if "connected" not in st.session_state:
     st.session_state.connected = False
@@ -13,6 +35,10 @@ if "snowflake_conn" not in st.session_state:
     st.session_state.snowflake_conn = None
 if "openai_client" not in st.session_state:
     st.session_state.openai_client = None
+if "result_store" not in st.session_state:
+    st.session_state.result_store = []
+if "sql_pool" not in st.session_state:
+    st.session_state.sql_pool = None
 
 # Function to initialize Snowflake connection
 def init_snowflake_connection(password):
@@ -20,7 +46,7 @@ def init_snowflake_connection(password):
         account="au02318.eu-west-2.aws",
         user="salesmachinesPOC",
         password=password,
-        warehouse="COMPUTE_WH",
+        warehouse=DEFAULT_WAREHOUSE,
         database="FIRSTDB",
         schema="PUBLIC"
     )
@@ -31,12 +57,24 @@ if not st.session_state.connected:
     openai_api_key = st.text_input("Enter OpenAI API Key:", type="password")
 
     if st.button("Connect"):
-        if not snowflake_password or not openai_api_key:
+        if CASSETTE_MODE not in ("replay", "replay_fast") and (not snowflake_password or not openai_api_key):
             st.error("Please enter both Snowflake password and OpenAI API key.")
         else:
             try:
-                st.session_state.snowflake_conn = init_snowflake_connection(snowflake_password)
-                st.session_state.openai_client = OpenAI(api_key=openai_api_key)
+                # Record or replay sessions when LOANBOT_CASSETTE_MODE is set
+                st.session_state.snowflake_conn, st.session_state.openai_client = apply_cassette_mode(
+                    lambda: init_snowflake_connection(snowflake_password),
+                    lambda: OpenAI(api_key=openai_api_key)
+                )
+                if CASSETTE_MODE not in ("replay", "replay_fast"):
+                    start_replica_sync(lambda: init_snowflake_connection(snowflake_password))
+                    start_value_sync(lambda: init_snowflake_connection(snowflake_password), TABLES)
+                    start_metrics_sync(lambda: init_snowflake_connection(snowflake_password))
+                # Generated SQL is compiled with EXPLAIN on its own connection, keeping the session connection free
+                st.session_state.sql_pool = make_sql_pool(
+                    st.session_state.snowflake_conn,
+                    None if CASSETTE_MODE else lambda: init_snowflake_connection(snowflake_password)
+                )
                 st.session_state.connected = True
                 st.success("Connected successfully!")
                 st.rerun()
@@ -61,15 +99,14 @@ else:
 
 # Generate system prompt
     if "system_prompt" not in st.session_state:
-        table_info = []
-        for table in tables:
-            columns = get_table_schema(table)
-            column_info = ", ".join([f"{col[0]} ({col[1]})" for col in columns])
-            table_info.append(f"Table: {table}\nColumns: {column_info}")
-    
-        table_context = "\n\n".join(table_info)
-    
-        st.session_state.system_prompt = f"""You are an AI Snowflake SQL expert named LoanBot. Your goal is to give correct, executable SQL queries to users asking about loan officer performance and related financial data. You will be replying to users who will be confused if you don't respond in the character of LoanBot.
+        st.session_state.schema = {table: get_table_schema(table) for table in tables}
+        try:
+            layout = load_table_layout(st.session_state.snowflake_conn, st.session_state.schema)
+        except Exception as e:
+            st.warning(f"Error reading table layout: {str(e)}")
+            layout = None
+
+        prompt_template = """You are an AI Snowflake SQL expert named LoanBot. Your goal is to give correct, executable SQL queries to users asking about loan officer performance and related financial data. You will be replying to users who will be confused if you don't respond in the character of LoanBot.
 
         The user will ask questions about loan officer performance and financial data; for each question, you should respond and include a SQL query based on the question and the available tables in FirstDB.PUBLIC schema.
 
@@ -81,7 +118,7 @@ else:
         <rules>
         1. You MUST MUST wrap the generated SQL queries within ```sql code markdown
         2. If I don't tell you to find a limited set of results in the sql query or question, you MUST limit the number of responses to 10.
-        3. Text / string where clauses must be fuzzy match e.g ilike %keyword%
+        3. Text / string where clauses must be fuzzy match e.g ilike %keyword%, except columns listed under Known values, which must use = or IN with those exact values
         4. Make sure to generate a single Snowflake SQL code snippet, not multiple. 
         5. You should only use the table columns given in the table context, you MUST NOT use columns that are not listed in the schema.
         6. DO NOT put numerical at the very front of SQL variable.
@@ -93,6 +130,10 @@ else:
 
         Now to get started, please briefly introduce yourself, describe the available data at a high level, and share some example metrics that can be analyzed in 2-3 sentences. Then provide 3 example questions using bullet points.
         """
+        # Same table context, layout and value hints as the other apps, with their tokens counted
+        st.session_state.system_prompt, st.session_state.schema_stats = build_system_prompt(
+            st.session_state.schema, layout, prompt_template
+        )
 
     # Initialize chat messages
     if "messages" not in st.session_state:
@@ -113,15 +154,53 @@ else:
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
+            turn_start = time.perf_counter()
             message_placeholder = st.empty()
             full_response = ""
-            for response in st.session_state.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": m["role"], "content": m["content"]} for m in st.session_state.messages],
-                stream=True,
+            # Closest verified question -> SQL pairs steer the model past schema quirks
+            examples = turn_examples(prompt, st.session_state.result_store)
+            messages = [
+                *system_messages(st.session_state.system_prompt, prompt, st.session_state.result_store),
+                *([{"role": "system", "content": format_examples(examples)}] if examples else []),
+                *[{"role": m["role"], "content": m["content"]} for m in st.session_state.messages if m["role"] != "system"]
+            ]
+
+            # Show where this turn is in the shared OpenAI queue while it waits
+            def show_wait(position, waited):
+                if position:
+                    message_placeholder.markdown(f"Waiting for OpenAI capacity: position {position} in queue, {waited:.0f}s so far…")
+                else:
+                    message_placeholder.markdown(f"OpenAI is busy, retrying in {waited:.0f}s…")
+
+            # Function to run the response's SQL while it is generated; returns ((df, error), problem)
+            def run_response(response):
+                sql_match = re.search(r"```sql\n(.*)\n```", response, re.DOTALL)
+                if not sql_match:
+                    return (None, None), None
+                try:
+                    return (run_sql(st.session_state.snowflake_conn, sql_match.group(1), st.session_state.schema, st.session_state.result_store), None), None
+                except Exception as e:
+                    return (None, e), str(e)
+
+            # Simple questions start on the cheapest model; rejected or failing SQL climbs the ladder.
+            # Cassettes record no failed queries, so recorded turns only climb on rejected SQL.
+            model = None
+            executed = None
+            for event, payload in generate_response(
+                st.session_state.openai_client, None if CASSETTE_MODE else st.session_state.sql_pool,
+                messages, prompt, st.session_state.schema, st.session_state.result_store, on_wait=show_wait,
+                execute=None if CASSETTE_MODE else run_response
             ):
-                full_response += (response.choices[0].delta.content or "")
-                message_placeholder.markdown(full_response + "▌")
+                if event == "model":
+                    model = payload
+                elif event == "escalate":
+                    st.caption(f"{model} answer rejected ({payload}); escalating")
+                    full_response = ""
+                elif event == "executed":
+                    executed = payload
+                else:
+                    full_response += payload
+                    message_placeholder.markdown(full_response + "▌")
             message_placeholder.markdown(full_response)
 
     
@@ -143,12 +222,17 @@ else:
 
             if sql_match:
                 sql = sql_match.group(1)
+                for warning in unpruned_scans(sql):
+                    st.caption(f"⚠️ {warning}")
                 try:
-                    cursor = st.session_state.snowflake_conn.cursor()
-                    cursor.execute(sql)
-                    results = cursor.fetchall()
-                    columns = [desc[0] for desc in cursor.description]
-                    df = pd.DataFrame(results, columns=columns)
+                    # Already run while the answer was generated, outside cassette modes
+                    if executed is None:
+                        df = run_sql(st.session_state.snowflake_conn, sql, st.session_state.schema, st.session_state.result_store)
+                    elif executed[1] is not None:
+                        raise executed[1]
+                    else:
+                        df = executed[0]
+                    record_turn_outcome(prompt, sql, df, examples, st.session_state.result_store, model)
         
                 # Generate a human-like response with the actual results
                     if not df.empty:
@@ -157,26 +241,56 @@ else:
                             human_response = f"Great question! I've analyzed your book of business, and I'm excited to share the results with you. The total value of your closed and funded loans under management is ${value:,.2f}. This represents the cumulative amount of all your successfully closed opportunities. It's an impressive figure that showcases your performance and the trust your clients place in you. Is there anything specific about this value you'd like to know more about, such as how it compares to previous periods or your goals?"
                         else:
                 # General case for other types of queries
-                            human_response = f"I've got the results for you! Here's what I found:\n\n{df.to_string(index=False)}\n\nWould you like me to explain any part of these results in more detail?"
+                            human_response = f"I've got the results for you! Here's what I found:\n\n{summarize_result(df)}\n\nWould you like me to explain any part of these results in more detail?"
                     else:
                         human_response = "I've run the query, but it looks like there were no results matching the criteria. This could mean that there are no closed and won opportunities in the system yet. Would you like me to modify the query or check something else for you?"
         
                     full_response += f"\n\n{human_response}"
                     message_placeholder.markdown(full_response)
                     st.dataframe(df)
-                    cursor.close()
+                    report = memory_report(df)
+                    if report:
+                        st.caption(report)
                 except Exception as e:
+                    record_turn_outcome(prompt, sql, None, examples, st.session_state.result_store, model)
                     error_message = f"I apologize, but I encountered an error while trying to fetch that information for you. The specific error was: {str(e)}. Could you please rephrase your question or ask about a different aspect of loan officer performance? I'm here to help in any way I can."
                     full_response += f"\n\n{error_message}"
                     message_placeholder.markdown(full_response)
                     st.error(f"Error executing SQL: {e}")
 
         st.session_state.messages.append({"role": "assistant", "content": full_response})
+        if CASSETTE_MODE:
+            st.caption(f"Turn processed in {(time.perf_counter() - turn_start) * 1000:.0f} ms ({CASSETTE_MODE})")
 
 
     # Add a disconnect button
     if st.button("Disconnect"):
         if st.session_state.snowflake_conn:
             st.session_state.snowflake_conn.close()
+        if st.session_state.sql_pool:
+            st.session_state.sql_pool.close()
         st.session_state.clear()
-        st.rerun()
\ No newline at end of file
+        remove_session(session_ctx.session_id)
+        st.rerun()
+
+# How far behind Snowflake the local replica is
+for table, status in replica_staleness().items():
+    if status["error"]:
+        st.sidebar.warning(f"Local {table} replica sync failed: {status['error']}")
+    if status["age"] is not None:
+        st.sidebar.caption(f"Local {table} replica: synced {status['age'] / 60:.0f} min ago")
+
+# Prompt size of the compiled schema
+if "schema_stats" in st.session_state:
+    stats = st.session_state.schema_stats
+    st.sidebar.caption(f"Schema prompt: {stats['tokens_before']:,} → {stats['tokens_after']:,} tokens")
+
+# Scan volume of generated queries
+scans = scan_summary()
+if scans:
+    st.sidebar.caption(f"Generated queries: {scans['avg_size']} scanned on average, {scans['unpruned_share']:.0%} without pruning")
+
+# Admin view of resources held by every session in this process
+if ADMIN_VIEW_ENABLED:
+    with st.sidebar.expander("Session usage (admin)"):
+        st.dataframe(pd.DataFrame(session_usage()))
@@ -0,0 +1,117 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+# Verified question -> SQL pairs, captured when a generated query returned rows
+EXAMPLES_PATH = os.environ.get("LOANBOT_EXAMPLES", "sql_examples.json")
+MAX_EXAMPLES = 2000
+
+# Examples injected per request, and the BM25 score an example needs to be worth the tokens
+TOP_K = 3
+MIN_SCORE = 1.0
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOPWORDS = {
+    "a", "an", "the", "of", "for", "in", "on", "by", "to", "and", "or", "is", "are", "was", "were",
+    "me", "show", "give", "list", "what", "which", "who", "how", "many", "much", "with", "from", "all",
+    "do", "does", "we", "our", "my", "i", "can", "you", "please", "that", "this", "these", "those",
+}
+
+# First-try outcomes of generated SQL, split by whether examples were injected
+generation_stats = Counter()
+
+_store = {"examples": [], "index": None, "mtime": None}
+_store_lock = threading.Lock()
+
+def tokenize(text):
+    return [word for word in re.findall(r"[a-z0-9_]+", text.lower()) if word not in STOPWORDS]
+
+# Function to build a BM25 inverted index over the example questions
+def build_index(examples):
+    postings = {}
+    lengths = []
+    for i, example in enumerate(examples):
+        terms = Counter(tokenize(example["question"]))
+        lengths.append(sum(terms.values()))
+        for term, count in terms.items():
+            postings.setdefault(term, []).append((i, count))
+    return {
+        "postings": postings,
+        "lengths": lengths,
+        "average_length": sum(lengths) / len(lengths) if lengths else 0,
+    }
+
+# Function to load the examples, re-reading the file when another process has changed it
+def load_examples(path=EXAMPLES_PATH):
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    with _store_lock:
+        if _store["index"] is None or mtime != _store["mtime"]:
+            examples = []
+            if mtime is not None:
+                with open(path) as f:
+                    examples = json.load(f)
+            _store["examples"], _store["index"], _store["mtime"] = examples, build_index(examples), mtime
+        return _store["examples"], _store["index"]
+
+# Function to find the k examples whose questions are lexically closest to a prompt
+def similar_examples(prompt, k=TOP_K, path=EXAMPLES_PATH):
+    examples, index = load_examples(path)
+    if not examples:
+        return []
+    scores = Counter()
+    for term in set(tokenize(prompt)):
+        postings = index["postings"].get(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (len(examples) - len(postings) + 0.5) / (len(postings) + 0.5))
+        for i, count in postings:
+            norm = 1 - BM25_B + BM25_B * index["lengths"][i] / index["average_length"]
+            scores[i] += idf * count * (BM25_K1 + 1) / (count + BM25_K1 * norm)
+    return [examples[i] for i, score in scores.most_common(k) if score >= MIN_SCORE]
+
+# Function to render examples as a system message for the model
+def format_examples(examples):
+    if not examples:
+        return None
+    lines = ["Verified examples of questions and the SQL that answered them correctly:"]
+    for example in examples:
+        lines.append(f"Q: {example['question']}\n```sql\n{example['sql']}\n```")
+    return "\n\n".join(lines)
+
+# Function to save a question -> SQL pair after the query ran and returned rows
+def record_example(question, sql, rows, path=EXAMPLES_PATH):
+    key = " ".join(tokenize(question))
+    if not key or not rows:
+        return
+    with _store_lock:
+        examples = []
+        if os.path.exists(path):
+            with open(path) as f:
+                examples = json.load(f)
+        # A newer answer to the same question replaces the old one
+        examples = [example for example in examples if " ".join(tokenize(example["question"])) != key]
+        examples.append({"question": question.strip(), "sql": sql.strip(), "rows": int(rows), "added_at": time.time()})
+        del examples[:-MAX_EXAMPLES]
+        with open(path, "w") as f:
+            json.dump(examples, f)
+        _store["index"] = None
+
+# Function to count whether a turn's first generated SQL worked
+def record_generation(used_examples, success):
+    group = "with_examples" if used_examples else "without_examples"
+    generation_stats[f"{group}_turns"] += 1
+    generation_stats[f"{group}_success"] += bool(success)
+
+# Function to summarise first-try success with and without injected examples
+def generation_summary():
+    summary = {}
+    for group in ("with_examples", "without_examples"):
+        turns = generation_stats[f"{group}_turns"]
+        if turns:
+            summary[group] = {"turns": turns, "success_rate": generation_stats[f"{group}_success"] / turns}
+    return summary
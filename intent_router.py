@@ -0,0 +1,343 @@
+import math
+import re
+from collections import Counter
+
+# Parameterized, pre-validated SQL templates for common question shapes.
+# Slots: {period} and {officer} expand to extra AND predicates, {loan_type} likewise, {n} to an int.
+# "words" (with the template's training phrasings) is what a question may say beyond its slots;
+# any other word is a constraint the template cannot express, so the question goes to the LLM.
+# "requires" names a slot the question must fill for the template to answer it.
+TEMPLATES = {
+    "kpi_scores": {
+        "words": "kpi kpis score scores loan officer officers performance",
+        "patterns": [r"\bkpi scores?\b", r"\bloan officer performance\b"],
+        "sql": None,
+    },
+    "top_officers_volume": {
+        "words": "top officer officers lo los producer producers volume amount dollar dollars value",
+        "patterns": [r"\btop\b.*\b(officers?|los?|producers?)\b.*\b(volume|amount|dollars?|value)\b"],
+        "sql": """SELECT OWNERID AS OFFICER, SUM(AMOUNT) AS CLOSED_VOLUME
+FROM FirstDB.PUBLIC.OPPORTUNITY
+WHERE STAGENAME = 'Closed Won'{period}{loan_type}{officer}
+GROUP BY OWNERID
+ORDER BY CLOSED_VOLUME DESC
+LIMIT {n}""",
+        "summary": "Here are the top {n} loan officers by closed loan volume{period_text}.",
+    },
+    "top_officers_count": {
+        "words": "top officer officers lo los producer producers count number most loans loan closed",
+        "patterns": [r"\btop\b.*\b(officers?|los?|producers?)\b.*\b(count|number|most loans|loans closed)\b"],
+        "sql": """SELECT OWNERID AS OFFICER, COUNT(*) AS LOANS_CLOSED
+FROM FirstDB.PUBLIC.OPPORTUNITY
+WHERE STAGENAME = 'Closed Won'{period}{loan_type}{officer}
+GROUP BY OWNERID
+ORDER BY LOANS_CLOSED DESC
+LIMIT {n}""",
+        "summary": "Here are the top {n} loan officers by number of loans closed{period_text}.",
+    },
+    "pipeline_by_stage": {
+        "words": "pipeline by per each stage stages",
+        "patterns": [r"\bpipeline\b.*\b(by|per|each)\s+stage\b", r"\b(by|per|each)\s+stage\b.*\bpipeline\b"],
+        "sql": """SELECT STAGENAME, COUNT(*) AS OPPORTUNITIES, SUM(AMOUNT) AS PIPELINE_VALUE
+FROM FirstDB.PUBLIC.OPPORTUNITY
+WHERE STAGENAME NOT IN ('Closed Won', 'Closed Lost'){period}{loan_type}{officer}
+GROUP BY STAGENAME
+ORDER BY PIPELINE_VALUE DESC""",
+        "summary": "Here is the open pipeline by stage{period_text}.",
+    },
+    "loan_type_mix": {
+        "words": "loan loans type types mix breakdown split distribution share",
+        "patterns": [r"\bloan types?\b.*\b(mix|breakdown|split|distribution|share)\b",
+                     r"\b(mix|breakdown|split|distribution|share)\b.*\bloan types?\b"],
+        "sql": """SELECT LOANTYPE__C AS LOAN_TYPE, COUNT(*) AS LOANS, SUM(AMOUNT) AS VOLUME
+FROM FirstDB.PUBLIC.OPPORTUNITY
+WHERE STAGENAME = 'Closed Won'{period}{loan_type}{officer}
+GROUP BY LOANTYPE__C
+ORDER BY LOANS DESC""",
+        "summary": "Here is the closed loan type mix{period_text}.",
+    },
+    "officer_monthly_trend": {
+        "words": "monthly by per month over trend officer loan loans closed volume",
+        # A monthly/trend word, an officer reference and loan or volume wording, in any order
+        "patterns": [r"^(?=.*\b(monthly|by month|per month|month over month|trend)\b)"
+                     r"(?=.*(\b(loan officer|officer|lo)\b|\b005[a-z0-9]{12}))"
+                     r"(?=.*\b(loans?|volume|closed)\b)"],
+        "requires": "officer",
+        "sql": """SELECT DATE_TRUNC('month', CLOSEDATE) AS MONTH, COUNT(*) AS LOANS_CLOSED, SUM(AMOUNT) AS CLOSED_VOLUME
+FROM FirstDB.PUBLIC.OPPORTUNITY
+WHERE STAGENAME = 'Closed Won'{period}{loan_type}{officer}
+GROUP BY MONTH
+ORDER BY MONTH""",
+        "summary": "Here is the monthly closed loan trend{period_text}.",
+    },
+}
+
+# Example phrasings used to train the bag-of-words classifier; "none" goes to the LLM
+TRAINING_EXAMPLES = {
+    "kpi_scores": [
+        "show me the kpi scores", "how are loan officers performing overall", "kpi summary",
+        "what are our kpis", "overall loan officer performance scores",
+    ],
+    "top_officers_volume": [
+        "top 10 loan officers by closed volume", "which officers closed the most dollars",
+        "best producers by loan amount this year", "highest volume loan officers last quarter",
+        "who brought in the most loan value", "rank officers by funded volume",
+    ],
+    "top_officers_count": [
+        "top 5 officers by number of loans", "which officers closed the most loans",
+        "loan officers with the highest loan count", "rank officers by loans closed this month",
+        "who closed the most deals",
+    ],
+    "pipeline_by_stage": [
+        "pipeline by stage", "how much is in each stage of the pipeline", "open opportunities per stage",
+        "stage breakdown of open deals", "what does the pipeline look like",
+    ],
+    "loan_type_mix": [
+        "loan type mix", "breakdown of loans by type", "how many fixed vs arm vs fha loans",
+        "distribution of loan types this year", "share of each loan type",
+    ],
+    "officer_monthly_trend": [
+        "monthly trend for this officer", "closed volume by month for an officer",
+        "month over month loans for one officer", "how has this officer trended each month",
+    ],
+    "none": [
+        "show accounts in london", "list contacts created yesterday", "what tasks are overdue",
+        "average commission fee per referral", "which leads came from the website",
+        "show me the assets for account acme", "events scheduled next week",
+        "liabilities over 100k", "real estate owned by clients", "outbound referrals by partner",
+    ],
+}
+
+# Classifier confidence needed to answer from a template without a regex hit
+CLASSIFIER_THRESHOLD = 0.85
+
+LOAN_TYPES = {"fixed": "Fixed", "arm": "ARM", "fha": "FHA", "va": "VA", "jumbo": "Jumbo", "usda": "USDA"}
+
+# Words that carry no constraint in any template question
+FILLER_WORDS = {
+    "a", "about", "all", "an", "and", "are", "can", "display", "do", "does", "for", "from", "get", "give", "how",
+    "i", "in", "is", "list", "me", "my", "of", "on", "our", "please", "s", "see", "show", "tell", "the", "to",
+    "us", "was", "we", "were", "what", "whats", "which", "who", "with", "you",
+}
+
+# Held-out labelled questions for measuring routing precision; none of them appear in TRAINING_EXAMPLES
+EVAL_EXAMPLES = [
+    ("top 10 loan officers by closed volume this year", "top_officers_volume"),
+    ("show me the top 5 producers by dollar amount in 2023", "top_officers_volume"),
+    ("top 20 LOs by loan value last quarter", "top_officers_volume"),
+    ("top 3 officers by number of loans closed last month", "top_officers_count"),
+    ("who are the top officers by loans closed in Q2 2024", "top_officers_count"),
+    ("show the pipeline by stage", "pipeline_by_stage"),
+    ("pipeline by stage for FHA loans", "pipeline_by_stage"),
+    ("loan type mix for Q1 2024", "loan_type_mix"),
+    ("what is the loan type breakdown this year", "loan_type_mix"),
+    ("what are the kpi scores", "kpi_scores"),
+    ("monthly closed loan trend for officer Jane Doe", "officer_monthly_trend"),
+    ("loan volume by month for 005Ak000001XyZaQAK", "officer_monthly_trend"),
+    ("which accounts have the most contacts", None),
+    ("list tasks due today", None),
+    ("average origination fee by loan type for John Smith", None),
+    ("top 5 officers by volume for accounts in Texas", None),
+    ("show the loan type breakdown for officers with more than 10 loans", None),
+    ("compare pipeline by stage for 2023 vs 2024", None),
+    ("top 10 officers by volume excluding refinances", None),
+    ("top officers by volume for Texas Accounts", None),
+    ("pipeline by stage for opportunities created by the web team", None),
+    ("loan type mix of loans over 500k", None),
+    ("what is the trend of referrals for each partner", None),
+    ("how many leads converted last month for officer Jane Doe", None),
+    ("show loan officers that closed more than 10 loans", None),
+    ("top 5 officers by volume with their average loan size", None),
+    ("which officers have no closed loans this year", None),
+    ("pipeline by stage and owner", None),
+    ("loan type split by branch", None),
+    ("monthly trend for Texas accounts", None),
+    ("monthly closed loan volume trend", None),
+    ("closed volume by month for each officer", None),
+]
+
+routing_stats = Counter()
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+# Function to train a multinomial naive Bayes model on the example phrasings
+def train_classifier(examples=TRAINING_EXAMPLES):
+    vocabulary = {word for phrases in examples.values() for phrase in phrases for word in tokenize(phrase)}
+    total = sum(len(phrases) for phrases in examples.values())
+    model = {"vocabulary": vocabulary, "classes": {}}
+    for label, phrases in examples.items():
+        counts = Counter(word for phrase in phrases for word in tokenize(phrase))
+        model["classes"][label] = {
+            "prior": math.log(len(phrases) / total),
+            "counts": counts,
+            "total": sum(counts.values()),
+        }
+    return model
+
+CLASSIFIER = train_classifier()
+
+# Function to score a question against every class; returns (label, probability)
+def classify(text, model=CLASSIFIER):
+    words = [word for word in tokenize(text) if word in model["vocabulary"]]
+    vocabulary_size = len(model["vocabulary"])
+    scores = {}
+    for label, stats in model["classes"].items():
+        scores[label] = stats["prior"] + sum(
+            math.log((stats["counts"][word] + 1) / (stats["total"] + vocabulary_size)) for word in words
+        )
+    best = max(scores, key=scores.get)
+    norm = sum(math.exp(score - scores[best]) for score in scores.values())
+    return best, 1 / norm
+
+# Function to turn a period phrase into a CLOSEDATE predicate and a readable label, with the span it was read from
+def extract_period(text):
+    text = text.lower()
+    match = re.search(r"\bq([1-4])\s*(\d{4})\b", text)
+    if match:
+        quarter, year = int(match.group(1)), int(match.group(2))
+        start = f"{year}-{3 * quarter - 2:02d}-01"
+        end = f"{year + 1}-01-01" if quarter == 4 else f"{year}-{3 * quarter + 1:02d}-01"
+        return f" AND CLOSEDATE >= '{start}' AND CLOSEDATE < '{end}'", f" in Q{quarter} {year}", match.span()
+    match = re.search(r"\b(?:in|for|during)\s+(\d{4})\b", text)
+    if match:
+        year = int(match.group(1))
+        return f" AND CLOSEDATE >= '{year}-01-01' AND CLOSEDATE < '{year + 1}-01-01'", f" in {year}", match.span()
+    match = re.search(r"\b(?:last|past)\s+(\d+)\s+(day|week|month|year)s?\b", text)
+    if match:
+        amount, unit = int(match.group(1)), match.group(2)
+        return f" AND CLOSEDATE >= DATEADD({unit}, -{amount}, CURRENT_DATE())", f" in the last {amount} {unit}s", match.span()
+    for unit in ("month", "quarter", "year"):
+        match = re.search(rf"\b(?:this|current)\s+{unit}\b", text)
+        if match is None and unit == "year":
+            match = re.search(r"\bytd\b|\byear to date\b", text)
+        if match:
+            return f" AND CLOSEDATE >= DATE_TRUNC('{unit}', CURRENT_DATE())", f" this {unit}", match.span()
+        match = re.search(rf"\b(?:last|previous|prior)\s+{unit}\b", text)
+        if match:
+            return (
+                f" AND CLOSEDATE >= DATEADD({unit}, -1, DATE_TRUNC('{unit}', CURRENT_DATE()))"
+                f" AND CLOSEDATE < DATE_TRUNC('{unit}', CURRENT_DATE())",
+                f" last {unit}",
+                match.span(),
+            )
+    return "", "", None
+
+# Function to read "top N" from a question, with its span
+def extract_n(text, default=10):
+    match = re.search(r"\btop\s+(\d{1,3})\b", text.lower())
+    return (min(int(match.group(1)), 100), match.span()) if match else (default, None)
+
+# Function to read a loan type from a question, with its span
+def extract_loan_type(text):
+    for match in re.finditer(r"\b([a-z0-9]+)(?:\s+loans?)?\b", text.lower()):
+        if match.group(1) in LOAN_TYPES:
+            return f" AND LOANTYPE__C = '{LOAN_TYPES[match.group(1)]}'", match.span()
+    return "", None
+
+# Salesforce user IDs, as shown in the OFFICER column of officer rankings
+OFFICER_ID_PATTERN = r"\b005[A-Za-z0-9]{12}(?:[A-Za-z0-9]{3})?\b"
+
+def officer_id_predicate(officer_id):
+    return f" AND OWNERID = '{officer_id}'"
+
+# Names that pick out exactly this officer under extract_officer's ILIKE predicate
+OFFICER_NAMES_SQL = """SELECT m.NAME
+FROM (SELECT DISTINCT NAME FROM FirstDB.PUBLIC.OPPORTUNITYTEAMMEMBER WHERE USERID = '{officer_id}') m
+JOIN FirstDB.PUBLIC.OPPORTUNITYTEAMMEMBER o ON o.NAME ILIKE CONCAT('%', m.NAME, '%')
+GROUP BY m.NAME
+HAVING COUNT(DISTINCT o.USERID) = 1"""
+
+# Function to read an officer ID or name ("officer Jane Doe") from a question, with its span
+# and a key ("id:..." or "name:...") identifying the officer independently of the predicate.
+# A bare "for Two Words" is not taken as a name: it is as likely a place or an account.
+def extract_officer(text):
+    match = re.search(OFFICER_ID_PATTERN, text)
+    if match:
+        return officer_id_predicate(match.group(0)), match.span(), f"id:{match.group(0)}"
+    match = re.search(r"\b(?:loan officer|officer|LO)\s+([A-Z][a-z]+(?:\s+[A-Z][a-z']+)+)", text)
+    if not match:
+        return "", None, ""
+    name = match.group(1).replace("'", "''")
+    return (
+        " AND OWNERID IN (SELECT USERID FROM FirstDB.PUBLIC.OPPORTUNITYTEAMMEMBER"
+        f" WHERE NAME ILIKE '%{name}%')",
+        match.span(),
+        f"name:{match.group(1).lower()}",
+    )
+
+# Words each template's questions may use, from its phrasings plus the filler words
+TEMPLATE_VOCABULARY = {
+    name: FILLER_WORDS | set(template["words"].split()) | {
+        word for phrase in TRAINING_EXAMPLES.get(name, []) for word in tokenize(phrase)
+    }
+    for name, template in TEMPLATES.items()
+}
+
+# Function to list the words of a question that neither the slots nor the template account for
+def unconsumed_words(prompt, template_name, spans):
+    text = prompt
+    for start, end in sorted((span for span in spans if span), reverse=True):
+        text = text[:start] + " " + text[end:]
+    return [word for word in tokenize(text) if word not in TEMPLATE_VOCABULARY[template_name]]
+
+# Function to match a question to a template and fill its slots, without touching routing_stats.
+# Returns None to use the LLM, including when the question says anything the template cannot express.
+def match_intent(prompt):
+    template_name = None
+    for name, template in TEMPLATES.items():
+        if any(re.search(pattern, prompt, re.IGNORECASE) for pattern in template["patterns"]):
+            template_name = name
+            break
+    if template_name is None:
+        label, probability = classify(prompt)
+        if label != "none" and probability >= CLASSIFIER_THRESHOLD:
+            template_name = label
+    if template_name is None:
+        return None
+
+    template = TEMPLATES[template_name]
+    if template["sql"] is None:
+        return None if unconsumed_words(prompt, template_name, []) else {"template": template_name}
+    period, period_text, period_span = extract_period(prompt)
+    n, n_span = extract_n(prompt)
+    loan_type, loan_type_span = extract_loan_type(prompt)
+    officer, officer_span, officer_key = extract_officer(prompt)
+    if unconsumed_words(prompt, template_name, [period_span, n_span, loan_type_span, officer_span]):
+        return None
+    slots = {"n": n, "period": period, "loan_type": loan_type, "officer": officer, "officer_key": officer_key}
+    if template.get("requires") and not slots[template["requires"]]:
+        return None
+    return render_template(template_name, slots, period_text)
+
+# Function to route a question, counting template answers and LLM fallbacks for the sidebar
+def route_intent(prompt):
+    intent = match_intent(prompt)
+    routing_stats[intent["template"] if intent else "llm"] += 1
+    return intent
+
+# Function to fill a template's SQL and summary from its slots
+def render_template(template_name, slots, period_text=""):
+    template = TEMPLATES[template_name]
+    return {
+        "template": template_name,
+        "sql": template["sql"].format(**slots),
+        "summary": template["summary"].format(n=slots["n"], period_text=period_text),
+        "slots": slots,
+        "period_text": period_text,
+    }
+
+# Function to measure routing precision and recall on held-out labelled questions
+def evaluate_router(examples=EVAL_EXAMPLES):
+    hits = correct = expected = 0
+    for question, label in examples:
+        intent = match_intent(question)
+        predicted = intent["template"] if intent else None
+        expected += label is not None
+        if predicted is not None:
+            hits += 1
+            correct += predicted == label
+    return {
+        "precision": correct / hits if hits else 1.0,
+        "recall": correct / expected if expected else 1.0,
+    }
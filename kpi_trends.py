@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+
+import pandas as pd
+
+from local_replica import execute_query
+from openai_limiter import wait_for_background_turn
+
+KPI_TRENDS_PATH = os.environ.get("LOANBOT_KPI_TRENDS", "kpi_trends.parquet")
+
+# First month computed when the store is empty
+HISTORY_START = "2015-01-01"
+
+# A stored series younger than this is used as is; an older one is served while it refreshes in the background
+KPI_TRENDS_TTL_SECONDS = 15 * 60
+
+# Every monthly KPI for every officer (and the all-officer total) in one grouped pass. The sums and
+# counts behind each average are kept too, so any span of months can be averaged exactly. Months
+# after the current one hold the open pipeline, which the rate KPIs count.
+MONTHLY_KPI_SQL = """
+SELECT
+    DATE_TRUNC('month', CLOSEDATE) AS MONTH,
+    OWNERID,
+    GROUPING(OWNERID) AS IS_TOTAL,
+    COUNT(*) AS OPPORTUNITIES,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN 1 END) AS LOANS_CLOSED,
+    SUM(CASE WHEN STAGENAME = 'Closed Won' THEN AMOUNT END) AS CLOSED_VOLUME,
+    AVG(CASE WHEN STAGENAME = 'Closed Won' THEN AMOUNT END) AS AVG_LOAN_SIZE,
+    AVG(CASE WHEN STAGENAME = 'Closed Won' THEN DATEDIFF('day', CREATEDDATE, CLOSEDATE) END) AS DAYS_TO_CLOSE,
+    COUNT(CASE WHEN STAGENAME = 'Closed Lost' AND TYPE = 'Default' THEN 1 END) AS DEFAULTS,
+    COUNT(CASE WHEN ISCOMPLIANT__C = TRUE THEN 1 END) AS COMPLIANT,
+    AVG(CASE WHEN STAGENAME = 'Closed Won' THEN REVENUE__C - COST__C END) AS PROFIT_PER_LOAN,
+    AVG(CASE WHEN STAGENAME = 'Closed Won' THEN ORIGINATION_FEES__C END) AS ORIGINATION_FEES,
+    COUNT(CASE WHEN STAGENAME IN ('Prospecting', 'Qualification') THEN 1 END) AS EARLY_STAGE,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' AND LOANTYPE__C = 'Fixed' THEN 1 END) AS FIXED_LOANS,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' AND LOANTYPE__C = 'ARM' THEN 1 END) AS ARM_LOANS,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' AND LOANTYPE__C = 'FHA' THEN 1 END) AS FHA_LOANS,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN AMOUNT END) AS AMOUNT_COUNT,
+    SUM(CASE WHEN STAGENAME = 'Closed Won' THEN AMOUNT * AMOUNT END) AS AMOUNT_SQUARES,
+    SUM(CASE WHEN STAGENAME = 'Closed Won' THEN DATEDIFF('day', CREATEDDATE, CLOSEDATE) END) AS CLOSE_DAYS_SUM,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN DATEDIFF('day', CREATEDDATE, CLOSEDATE) END) AS CLOSE_DAYS_COUNT,
+    SUM(CASE WHEN STAGENAME = 'Closed Won' THEN REVENUE__C - COST__C END) AS PROFIT_SUM,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN REVENUE__C - COST__C END) AS PROFIT_COUNT,
+    SUM(CASE WHEN STAGENAME = 'Closed Won' THEN ORIGINATION_FEES__C END) AS FEES_SUM,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN ORIGINATION_FEES__C END) AS FEES_COUNT,
+    SUM(CASE WHEN STAGENAME = 'Closed Won' THEN NUMBER_OF_PRODUCTS__C END) AS PRODUCTS_SUM,
+    COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN NUMBER_OF_PRODUCTS__C END) AS PRODUCTS_COUNT
+FROM FirstDB.PUBLIC.OPPORTUNITY
+WHERE CLOSEDATE >= '{start}'
+GROUP BY GROUPING SETS ((DATE_TRUNC('month', CLOSEDATE), OWNERID), (DATE_TRUNC('month', CLOSEDATE)))
+"""
+
+METRICS = [
+    "OPPORTUNITIES", "LOANS_CLOSED", "CLOSED_VOLUME", "AVG_LOAN_SIZE", "DAYS_TO_CLOSE",
+    "DEFAULTS", "COMPLIANT", "PROFIT_PER_LOAN", "ORIGINATION_FEES",
+    "EARLY_STAGE", "FIXED_LOANS", "ARM_LOANS", "FHA_LOANS", "AMOUNT_COUNT", "AMOUNT_SQUARES",
+    "CLOSE_DAYS_SUM", "CLOSE_DAYS_COUNT", "PROFIT_SUM", "PROFIT_COUNT", "FEES_SUM", "FEES_COUNT",
+    "PRODUCTS_SUM", "PRODUCTS_COUNT",
+]
+
+_trends_lock = threading.Lock()
+_background_lock = threading.Lock()
+_loaded = {"trends": None, "mtime": None}
+
+# Function to load the stored monthly series, re-reading the file only when it has changed
+def load_trends(path=KPI_TRENDS_PATH):
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    if mtime != _loaded["mtime"]:
+        _loaded["trends"], _loaded["mtime"] = pd.read_parquet(path), mtime
+    return _loaded["trends"]
+
+# Function to compute monthly KPIs from a given month onward
+def compute_months(conn, start):
+    cursor = execute_query(conn, MONTHLY_KPI_SQL.format(start=start))
+    results = cursor.fetchall()
+    columns = [desc[0].upper() for desc in cursor.description]
+    cursor.close()
+    df = pd.DataFrame(results, columns=columns)
+    df["MONTH"] = pd.to_datetime(df["MONTH"])
+    df["OWNERID"] = df["OWNERID"].where(df["IS_TOTAL"] == 0, "ALL")
+    df[METRICS] = df[METRICS].apply(pd.to_numeric, errors="coerce")
+    return df.drop(columns=["IS_TOTAL"])
+
+# Function to check that a stored series exists and has every metric (older files lack the newer ones)
+def is_complete(trends):
+    return trends is not None and not trends.empty and set(METRICS) <= set(trends.columns)
+
+# Function to refresh the store; only the current month and later (still open) months are recomputed
+def refresh_kpi_trends(conn, path=KPI_TRENDS_PATH):
+    with _trends_lock:
+        trends = load_trends(path)
+        if not is_complete(trends):
+            trends = compute_months(conn, HISTORY_START)
+        else:
+            open_month = min(trends["MONTH"].max(), current_month())
+            fresh = compute_months(conn, open_month.strftime("%Y-%m-%d"))
+            trends = pd.concat([trends[trends["MONTH"] < open_month], fresh], ignore_index=True)
+        trends = trends.sort_values(["OWNERID", "MONTH"], ignore_index=True)
+        trends.to_parquet(path, index=False)
+        return trends
+
+def _background_refresh(conn_factory, path):
+    conn = None
+    try:
+        # Users waiting on OpenAI capacity go first
+        wait_for_background_turn()
+        conn = conn_factory()
+        refresh_kpi_trends(conn, path)
+    except Exception:
+        # The stored series stays in use; the next request past the TTL tries again
+        pass
+    finally:
+        if conn is not None:
+            conn.close()
+        _background_lock.release()
+
+# Function to get the monthly series without waiting on Snowflake unless nothing is stored yet.
+# A stale series is refreshed in the background on a connection from conn_factory, so the
+# session connection stays free; without a factory (cassette modes) it is refreshed in place.
+def get_kpi_trends(conn, conn_factory=None, path=KPI_TRENDS_PATH, ttl=KPI_TRENDS_TTL_SECONDS):
+    trends = load_trends(path)
+    if not is_complete(trends):
+        return refresh_kpi_trends(conn, path)
+    if time.time() - os.path.getmtime(path) <= ttl:
+        return trends
+    if conn_factory is None:
+        return refresh_kpi_trends(conn, path)
+    if _background_lock.acquire(blocking=False):
+        threading.Thread(target=_background_refresh, args=(conn_factory, path), daemon=True).start()
+    return trends
+
+# Function to add MoM and YoY deltas for a metric from the stored series (no extra scans)
+def add_deltas(trends, metric):
+    previous = trends[["OWNERID", "MONTH", metric]].copy()
+    result = trends.copy()
+    for label, months in (("MOM", 1), ("YOY", 12)):
+        shifted = previous.copy()
+        shifted["MONTH"] = shifted["MONTH"] + pd.DateOffset(months=months)
+        shifted = shifted.rename(columns={metric: f"{metric}_PREV"})
+        result = result.merge(shifted, on=["OWNERID", "MONTH"], how="left")
+        # A zero prior month has no meaningful percentage change
+        prior = result[f"{metric}_PREV"].where(result[f"{metric}_PREV"] != 0)
+        result[f"{metric}_{label}_PCT"] = (result[metric] / prior - 1) * 100
+        result = result.drop(columns=[f"{metric}_PREV"])
+    return result
+
+# Function to get the first day of the current month
+def current_month():
+    return pd.Timestamp.today().normalize().replace(day=1)
+
+# Function to get the all-officer monthly series up to the current month
+def total_series(trends):
+    totals = trends[(trends["OWNERID"] == "ALL") & (trends["MONTH"] <= current_month())]
+    return totals.sort_values("MONTH", ignore_index=True)
+
+def _ratio(numerator, denominator):
+    return float(numerator) / float(denominator) if denominator else 0
+
+# Function to read the headline KPIs off the all-officer series. Averages and rates are rebuilt from
+# their monthly sums and counts; market share growth compares closed loans in the 12 months up to
+# and including the current one with the 12 months before.
+def overall_kpis(trends):
+    totals = trends[trends["OWNERID"] == "ALL"]
+    sums = totals[METRICS].sum()
+    mean = _ratio(sums["CLOSED_VOLUME"], sums["AMOUNT_COUNT"])
+    variance = _ratio(
+        sums["AMOUNT_SQUARES"] - sums["CLOSED_VOLUME"] * mean, sums["AMOUNT_COUNT"] - 1
+    )
+    year_start = current_month() - pd.DateOffset(months=11)
+    recent = totals.loc[totals["MONTH"] >= year_start, "LOANS_CLOSED"].sum()
+    prior = totals.loc[
+        (totals["MONTH"] < year_start) & (totals["MONTH"] >= year_start - pd.DateOffset(months=12)), "LOANS_CLOSED"
+    ].sum()
+    return {
+        "Total Number of Loans Closed": sums["LOANS_CLOSED"],
+        "Total Dollar Value of Loans Closed": sums["CLOSED_VOLUME"],
+        "Loan Types": sums["FIXED_LOANS"],
+        "Average Loan Size": mean,
+        "Loan Approval Rate": _ratio(sums["LOANS_CLOSED"], sums["OPPORTUNITIES"]) * 100,
+        "Time to Close": _ratio(sums["CLOSE_DAYS_SUM"], sums["CLOSE_DAYS_COUNT"]),
+        "Default Rates": sums["DEFAULTS"],
+        "Market Share Growth": _ratio(recent, prior) * 100 - 100 if prior else 0,
+        "Regulatory Compliance": sums["COMPLIANT"],
+        "Profitability per Loan": _ratio(sums["PROFIT_SUM"], sums["PROFIT_COUNT"]),
+        "Adaptability to Market Changes": _ratio(max(variance, 0) ** 0.5, mean) * 100,
+        "Cross-Selling Ratio": _ratio(sums["PRODUCTS_SUM"], sums["PRODUCTS_COUNT"]),
+        "Conversion Rate": _ratio(sums["LOANS_CLOSED"], sums["EARLY_STAGE"]) * 100,
+        "Loan Origination Fees": _ratio(sums["FEES_SUM"], sums["FEES_COUNT"]),
+    }
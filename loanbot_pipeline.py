@@ -0,0 +1,267 @@
+import re
+import time
+
+import pandas as pd
+import snowflake.connector
+
+from warehouse_router import DEFAULT_WAREHOUSE
+from local_replica import execute_query
+from schema_compiler import build_table_context, load_column_usage, record_column_usage, count_tokens
+from openai_limiter import INTERACTIVE, LIMITER, limited_call
+from result_dtypes import normalize_frame
+from parallel_sql import ConnectionPool, run_parallel
+from table_layout import layout_hints, record_scan
+from value_dictionary import load_value_dictionary, value_hints, exact_predicates
+from result_store import remember_result, system_messages, uses_result_tables, query_results, looks_like_follow_up
+from example_store import similar_examples, format_examples, record_example, record_generation
+from model_ladder import MODEL_LADDER, choose_tier, validate_sql, remember_failure, record_attempt, record_execution
+
+# The LoanBot pipeline (completion -> SQL extraction -> execution) without any UI,
+# shared by the Streamlit app and the headless chat API.
+
+# Response length assumed when reserving tokens-per-minute budget
+EXPECTED_RESPONSE_TOKENS = 500
+
+# List of tables
+TABLES = [
+    "OPPORTUNITY", "ACCOUNT", "CONTACT", "REFERRAL__C", "TASK", "EVENT",
+    "COMMISSIONFEE__C", "ADDITIONAL_LOAN__C", "OUTBOUND_REFERRAL__C",
+    "LOAN_REFERRAL__C", "REAL_ESTATE_OWNED__C", "ASSET__C", "LIABILITY__C", "LEAD", "Offer__c",
+    "OPPORTUNITYTEAMMEMBER"
+]
+
+SYSTEM_PROMPT_TEMPLATE = """You are an AI Snowflake SQL expert named LoanBot. Your goal is to give correct, executable SQL queries to users asking about loan officer performance. You will be replying to users who will be confused if you don't respond in the character of LoanBot.
+
+        The user will ask questions about loan officer performance; for each question, you should respond and include a SQL query based on the question and the available tables in FirstDB.PUBLIC schema.
+
+        <table_context>
+        {table_context}
+        </table_context>
+
+        Here are 7 critical rules for the interaction you must abide:
+        <rules>
+        1. You MUST MUST wrap the generated SQL queries within ```sql code markdown
+        2. If I don't tell you to find a limited set of results in the sql query or question, you MUST limit the number of responses to 10.
+        3. Text / string where clauses must be fuzzy match e.g ilike %keyword%, except columns listed under Known values, which must use = or IN with those exact values
+        4. Make sure to generate a single Snowflake SQL code snippet, unless the question asks for independent results (e.g. comparing two periods); then give one ```sql block per result, each runnable on its own.
+        5. You should only use the table columns given in the table context, you MUST NOT use columns that are not listed in the schema.
+        6. DO NOT put numerical at the very front of SQL variable.
+        7. Use only valid Snowflake SQL syntax.
+        7. For boolean conditions, use the actual boolean values 'true' or 'false' without quotes, not string representations.
+        </rules>
+
+        Now to get started, please briefly introduce yourself, describe the available data at a high level, and share some example metrics that can be analyzed in 2-3 sentences. Then provide 3 example questions using bullet points.
+    """
+
+# Function to initialize Snowflake connection
+def init_snowflake_connection(password):
+    return snowflake.connector.connect(
+        account="au02318.eu-west-2.aws",
+        user="salesmachinesPOC",
+        password=password,
+        warehouse=DEFAULT_WAREHOUSE,
+        database="FIRSTDB",
+        schema="PUBLIC"
+    )
+
+# Function to get table schema
+def get_table_schema(conn, table_name):
+    cursor = conn.cursor()
+    cursor.execute(f"DESCRIBE TABLE FirstDB.PUBLIC.{table_name}")
+    columns = cursor.fetchall()
+    cursor.close()
+    return [(col[0], col[1]) for col in columns]
+
+# Function to build the system prompt from the table schemas and physical layout; returns the prompt and token stats
+def build_system_prompt(schema, layout=None, template=SYSTEM_PROMPT_TEMPLATE):
+    table_context, stats = build_table_context(schema, load_column_usage())
+    for hints in (layout_hints(layout) if layout else "", value_hints(load_value_dictionary())):
+        if hints:
+            table_context += "\n" + hints
+            stats["tokens_after"] += count_tokens(hints)
+    return template.format(table_context=table_context), stats
+
+# Function to pick verified examples for a turn; follow-ups over local results get none
+def turn_examples(prompt, result_store):
+    if looks_like_follow_up(prompt, result_store):
+        return []
+    return similar_examples(prompt)
+
+# Function to assemble the messages for a turn from the recent history and any verified examples
+def chat_messages(system_prompt, history, prompt, result_store, examples=None):
+    messages = system_messages(system_prompt, prompt, result_store)
+    if examples:
+        messages.append({"role": "system", "content": format_examples(examples)})
+    return [
+        *messages,
+        *[{"role": m["role"], "content": m["content"]} for m in history[-5:] if m["role"] != "system"]
+    ]
+
+# Function to learn from a turn's generated SQL: first-try and per-model stats always, an example
+# when it ran on Snowflake and returned rows (df is None when it failed)
+def record_turn_outcome(prompt, sql, df, examples, result_store, model=None):
+    record_generation(bool(examples), df is not None)
+    if model is not None:
+        record_execution(model, df is not None)
+    if df is None:
+        remember_failure(prompt)
+    if df is not None and not uses_result_tables(sql, result_store):
+        record_example(prompt, sql, len(df))
+
+# Function to stream the completion for a turn as text deltas, under the shared rate limiter
+def stream_completion(client, messages, priority=INTERACTIVE, on_wait=None, model=MODEL_LADDER[0]):
+    estimated_tokens = sum(count_tokens(m["content"]) for m in messages) + EXPECTED_RESPONSE_TOKENS
+    stream = limited_call(
+        lambda: client.chat.completions.create(
+            model=model, messages=messages, stream=True, stream_options={"include_usage": True}
+        ),
+        estimated_tokens, priority, on_wait
+    )
+    for response in stream:
+        # The final chunk has no choices, only the usage the reservation is settled against
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            LIMITER.reconcile(estimated_tokens, usage.total_tokens)
+        if response.choices:
+            yield response.choices[0].delta.content or ""
+
+# Function to pull the SQL block out of a response
+def extract_sql(text):
+    sql_match = re.search(r"```sql\n(.*?)\n```", text, re.DOTALL)
+    return sql_match.group(1).strip() if sql_match else None
+
+# Function to pull every SQL block out of a response
+def extract_sql_blocks(text):
+    return [block.strip() for block in re.findall(r"```sql\n(.*?)\n```", text, re.DOTALL) if block.strip()]
+
+# Function to check a response's SQL against the schema, then compile it with EXPLAIN on a pooled
+# connection when a pool is given, so the session connection stays free; returns a problem description or None
+def check_response_sql(pool, response, schema, result_store):
+    for sql in extract_sql_blocks(response):
+        problem = validate_sql(sql, schema, result_store)
+        if problem:
+            return problem
+        if pool is not None and not uses_result_tables(sql, result_store):
+            conn = pool.acquire()
+            error = None
+            try:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(f"EXPLAIN {sql}")
+                finally:
+                    cursor.close()
+            except Exception as e:
+                error = e
+            finally:
+                pool.release(conn, error)
+            if error is not None:
+                return str(error)
+    return None
+
+# Function to generate a turn's response on the model ladder. Starts on the rung the question's
+# complexity calls for and climbs while its SQL fails validation; yields ("model", name),
+# ("delta", text) and ("escalate", problem) events. With execute(response), which runs the response's
+# SQL and returns (outcome, problem), a failed run climbs too and the last run is yielded as ("executed", outcome).
+def generate_response(client, pool, messages, prompt, schema, result_store, on_wait=None, execute=None):
+    tier = choose_tier(prompt)
+    while True:
+        model = MODEL_LADDER[tier]
+        top = tier == len(MODEL_LADDER) - 1
+        yield "model", model
+        start = time.perf_counter()
+        response = ""
+        for delta in stream_completion(client, messages, on_wait=on_wait, model=model):
+            response += delta
+            yield "delta", delta
+        # The top rung has nothing to escalate to, so it skips the checks
+        problem = None if top else check_response_sql(pool, response, schema, result_store)
+        run_failed = False
+        if problem is None and execute is not None:
+            outcome, problem = execute(response)
+            run_failed = problem is not None
+        record_attempt(
+            model, time.perf_counter() - start,
+            sum(count_tokens(m["content"]) for m in messages), count_tokens(response), problem is not None and not top
+        )
+        if problem is None or top:
+            if execute is not None:
+                yield "executed", outcome
+            return
+        if run_failed:
+            record_execution(model, False)
+        yield "escalate", problem
+        messages = [
+            *messages,
+            {"role": "assistant", "content": response},
+            {"role": "user", "content": f"That SQL is not valid: {problem}. Please correct it."},
+        ]
+        tier += 1
+
+# Function to execute a SQL query and return the result as a DataFrame, without side effects
+def fetch_sql(conn, sql, result_store):
+    # Follow-ups over earlier results run locally instead of on Snowflake
+    if uses_result_tables(sql, result_store):
+        results, description = query_results(result_store, sql)
+        query_id = None
+    else:
+        # Fuzzy filters on columns with known values become exact, prunable predicates
+        cursor = execute_query(conn, exact_predicates(sql))
+        try:
+            results = cursor.fetchall()
+            description = cursor.description
+        finally:
+            cursor.close()
+        query_id = getattr(cursor, "sfqid", None)
+    # Decimal/object columns from fetchall() become compact numeric, datetime and categorical dtypes
+    df = normalize_frame(pd.DataFrame(results, columns=[desc[0] for desc in description]), description)
+    # Snowflake reports bytes scanned for this id in the background; replica queries have none
+    df.attrs["query_id"] = query_id
+    return df
+
+# Function to record a successful result for usage stats and follow-up questions
+def record_result(sql, df, schema, result_store):
+    if schema:
+        record_column_usage(sql, schema)
+        record_scan(sql, df.attrs.get("query_id"))
+    remember_result(result_store, df, sql)
+
+# Function to execute a SQL query and return the result as a DataFrame
+def run_sql(conn, sql, schema, result_store):
+    df = fetch_sql(conn, sql, result_store)
+    record_result(sql, df, schema, result_store)
+    return df
+
+# Function to build a session's pool for parallel SQL blocks; without a factory
+# (cassette modes) blocks share the session connection one at a time
+def make_sql_pool(conn, conn_factory=None):
+    if conn_factory is None:
+        return ConnectionPool(lambda: conn, max_size=1, counts_logins=False)
+    return ConnectionPool(conn_factory)
+
+# Function to execute several independent SQL blocks concurrently on pooled connections
+def run_sql_blocks(pool, sqls, schema, result_store):
+    outcomes = run_parallel(pool, sqls, lambda conn, sql: fetch_sql(conn, sql, result_store))
+    for outcome in outcomes:
+        if outcome["error"] is None:
+            record_result(outcome["sql"], outcome["df"], schema, result_store)
+    return outcomes
+
+# Function to run a response's SQL while it is generated, so a failing query climbs the model ladder.
+# Several blocks run concurrently on the pool and a single one on the session connection; a single block
+# deferred(sql) accepts (e.g. one shown behind a preview) is left to the caller. Returns ({"outcomes",
+# "wall"}, problem) with run_parallel-style outcomes, or outcomes None when nothing ran.
+def run_response_sql(conn, pool, response, schema, result_store, deferred=None):
+    sql_blocks = extract_sql_blocks(response)
+    if not sql_blocks or (len(sql_blocks) == 1 and deferred is not None and deferred(sql_blocks[0])):
+        return {"outcomes": None, "wall": 0.0}, None
+    start = time.perf_counter()
+    if len(sql_blocks) > 1:
+        outcomes = run_sql_blocks(pool, sql_blocks, schema, result_store)
+    else:
+        try:
+            df, error = run_sql(conn, sql_blocks[0], schema, result_store), None
+        except Exception as e:
+            df, error = None, e
+        outcomes = [{"sql": sql_blocks[0], "df": df, "error": error, "elapsed": time.perf_counter() - start}]
+    errors = [str(outcome["error"]) for outcome in outcomes if outcome["error"] is not None]
+    return {"outcomes": outcomes, "wall": time.perf_counter() - start}, errors[0] if errors else None
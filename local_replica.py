@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import time
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from cassette import CASSETTE_MODE
+from warehouse_router import execute_routed, referenced_tables
+
+# Hot tables kept in a local DuckDB replica, refreshed incrementally on SYSTEMMODSTAMP
+REPLICATED_TABLES = ["OPPORTUNITY", "ACCOUNT"]
+REPLICA_DIR = os.environ.get("LOANBOT_REPLICA_DIR", "replica")
+SYNC_INTERVAL_SECONDS = 300
+
+# Cassettes only hold Snowflake results, so recording and replaying bypass the replica
+REPLICA_ENABLED = duckdb is not None and not CASSETTE_MODE
+
+_replica = None
+_replica_lock = threading.Lock()
+_sync_thread = None
+last_synced = {}
+# Last sync failure per table, cleared by the next successful sync
+sync_errors = {}
+routing_stats = {"replica": 0, "snowflake": 0, "fallback": 0}
+
+# Function to turn the replica off for this process, e.g. for a benchmark replaying a cassette
+def disable_replica():
+    global REPLICA_ENABLED
+    REPLICA_ENABLED = False
+
+# Function to open the process-wide replica, loading any Parquet snapshots from disk
+def get_replica():
+    global _replica
+    if not REPLICA_ENABLED:
+        return None
+    with _replica_lock:
+        if _replica is None:
+            _replica = duckdb.connect()
+            # Snowflake sorts NULLs as the largest value; GLOBAL so every replica cursor inherits it
+            _replica.execute("SET GLOBAL default_null_order = 'nulls_last_on_asc_first_on_desc'")
+            for table in REPLICATED_TABLES:
+                path = snapshot_path(table)
+                if os.path.exists(path):
+                    # A snapshot may be days old, so queries only move to it after its first incremental sync
+                    _replica.execute(f"CREATE TABLE {table} AS SELECT * FROM read_parquet('{path}')")
+        return _replica
+
+def snapshot_path(table):
+    return os.path.join(REPLICA_DIR, f"{table}.parquet")
+
+# Function to open a cursor on the replica; each thread works on its own cursor
+def replica_cursor():
+    replica = get_replica()
+    if replica is None:
+        return None
+    with _replica_lock:
+        return replica.cursor()
+
+def replica_has_table(cursor, table):
+    return cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?", [table]
+    ).fetchone()[0] > 0
+
+# Function to pull rows changed since the last sync and merge them into the replica
+def sync_table(conn, table):
+    replica = replica_cursor()
+    if replica is None:
+        return 0
+    try:
+        cursor = conn.cursor()
+        try:
+            if replica_has_table(replica, table):
+                watermark = replica.execute(f"SELECT MAX(SYSTEMMODSTAMP) FROM {table}").fetchone()[0]
+                cursor.execute(f"SELECT * FROM FirstDB.PUBLIC.{table} WHERE SYSTEMMODSTAMP > %s", (watermark,))
+            else:
+                watermark = None
+                cursor.execute(f"SELECT * FROM FirstDB.PUBLIC.{table}")
+            # None when the query returned no rows
+            delta = cursor.fetch_arrow_all()
+        finally:
+            cursor.close()
+
+        changed = delta.num_rows if delta is not None else 0
+        if watermark is None and delta is None:
+            # Nothing to build the table from yet, so the table stays unsynced and queries stay on Snowflake
+            return 0
+        if watermark is None:
+            replica.register("delta", delta)
+            replica.execute(f"CREATE TABLE {table} AS SELECT * FROM delta")
+            replica.unregister("delta")
+        elif changed:
+            # Readers see either the old rows or the new ones, never the gap between DELETE and INSERT
+            replica.register("delta", delta)
+            replica.execute("BEGIN TRANSACTION")
+            try:
+                replica.execute(f"DELETE FROM {table} WHERE ID IN (SELECT ID FROM delta)")
+                # A row edited twice between syncs keeps only its latest version
+                replica.execute(
+                    f"INSERT INTO {table} SELECT * FROM delta "
+                    "QUALIFY ROW_NUMBER() OVER (PARTITION BY ID ORDER BY SYSTEMMODSTAMP DESC) = 1"
+                )
+                replica.execute("COMMIT")
+            except Exception:
+                replica.execute("ROLLBACK")
+                raise
+            finally:
+                replica.unregister("delta")
+        if changed:
+            os.makedirs(REPLICA_DIR, exist_ok=True)
+            replica.execute(f"COPY {table} TO '{snapshot_path(table)}' (FORMAT PARQUET)")
+    finally:
+        replica.close()
+    last_synced[table] = time.time()
+    return changed
+
+# Function to sync every replicated table; a table that fails keeps its error for replica_staleness
+def sync_replica(conn):
+    changed = {}
+    for table in REPLICATED_TABLES:
+        try:
+            changed[table] = sync_table(conn, table)
+            sync_errors.pop(table, None)
+        except Exception as e:
+            sync_errors[table] = str(e)
+            changed[table] = None
+    return changed
+
+def _sync_loop(conn_factory):
+    conn = None
+    while True:
+        try:
+            conn = conn or conn_factory()
+            if any(sync_replica(conn)[table] is None for table in REPLICATED_TABLES):
+                # The connection may be the problem, so the next round opens a fresh one
+                conn = None
+        except Exception as e:
+            for table in REPLICATED_TABLES:
+                sync_errors[table] = str(e)
+            conn = None
+        time.sleep(SYNC_INTERVAL_SECONDS)
+
+# Function to start background syncing once per process, on its own Snowflake connection
+def start_replica_sync(conn_factory):
+    global _sync_thread
+    if not REPLICA_ENABLED:
+        return
+    with _replica_lock:
+        if _sync_thread is None:
+            _sync_thread = threading.Thread(target=_sync_loop, args=(conn_factory,), daemon=True)
+            _sync_thread.start()
+
+# Function to check whether a query only touches synced, replicated tables
+def can_use_replica(sql):
+    tables = referenced_tables(sql)
+    return bool(tables) and all(table in last_synced for table in tables) and tables <= set(REPLICATED_TABLES)
+
+# Function to strip database/schema qualifiers so Snowflake SQL runs against the replica
+def to_replica_sql(sql):
+    return re.sub(r"\bFirstDB\.PUBLIC\.", "", sql, flags=re.IGNORECASE)
+
+# Function to name a replica result column the way Snowflake names it: unquoted identifiers upper-cased
+def snowflake_column_name(name):
+    return "COUNT(*)" if name == "count_star()" else name.upper()
+
+# A DuckDB cursor whose description uses Snowflake's column names, so callers can read columns by name
+class ReplicaCursor:
+    sfqid = None
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @property
+    def description(self):
+        return [(snowflake_column_name(desc[0]), *desc[1:]) for desc in self._cursor.description or []]
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def close(self):
+        self._cursor.close()
+
+# Function to execute a query on the replica when possible, otherwise on Snowflake; returns an open cursor
+def execute_query(conn, sql):
+    if REPLICA_ENABLED and can_use_replica(sql):
+        cursor = replica_cursor()
+        try:
+            cursor.execute(to_replica_sql(sql))
+            routing_stats["replica"] += 1
+            return ReplicaCursor(cursor)
+        except Exception:
+            # Snowflake-only syntax (DATEADD, QUALIFY on some forms, ...) falls back to the warehouse
+            cursor.close()
+            routing_stats["fallback"] += 1
+    routing_stats["snowflake"] += 1
+    return execute_routed(conn, sql)
+
+# Function to report how stale each replicated table is, in seconds (None before its first sync),
+# with the error of its last failed sync
+def replica_staleness():
+    now = time.time()
+    return {
+        table: {"age": now - last_synced[table] if table in last_synced else None, "error": sync_errors.get(table)}
+        for table in REPLICATED_TABLES if table in last_synced or table in sync_errors
+    }
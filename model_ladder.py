@@ -0,0 +1,152 @@
+import os
+import re
+import threading
+
+from warehouse_router import referenced_tables, table_aliases
+from result_store import result_name, RESULT_HISTORY
+
+# Models from fastest/cheapest to most capable, e.g. LOANBOT_MODEL_LADDER="gpt-4o-mini,gpt-4o";
+# an empty setting falls back to the default ladder
+DEFAULT_MODEL_LADDER = "gpt-4o-mini,gpt-4o"
+MODEL_LADDER = (
+    [name.strip() for name in os.environ.get("LOANBOT_MODEL_LADDER", "").split(",") if name.strip()]
+    or [name.strip() for name in DEFAULT_MODEL_LADDER.split(",")]
+)
+
+# USD per million input / output tokens, for the per-tier cost stats
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+}
+
+# Question words that point at each table; more distinct tables means more joins
+TABLE_KEYWORDS = {
+    "OPPORTUNITY": r"\b(loans?|opportunit(y|ies)|deals?|pipeline|volume|closed|funded|stage)\b",
+    "ACCOUNT": r"\b(accounts?|clients?|customers?|borrowers?)\b",
+    "CONTACT": r"\bcontacts?\b",
+    "REFERRAL__C": r"\breferr(al|als|ed)\b",
+    "TASK": r"\btasks?\b",
+    "EVENT": r"\b(events?|meetings?|appointments?)\b",
+    "COMMISSIONFEE__C": r"\b(commissions?|fees?)\b",
+    "ASSET__C": r"\bassets?\b",
+    "LIABILITY__C": r"\bliabilit(y|ies)\b",
+    "LEAD": r"\bleads?\b",
+    "OPPORTUNITYTEAMMEMBER": r"\bteams?\b",
+}
+ANALYTIC_PATTERN = re.compile(
+    r"\b(compare|comparison|versus|vs|ratio|percent(age)?|share|growth|trend|rank(ing)?|over time|"
+    r"year over year|month over month|yoy|mom|correlat\w*|cohort|conversion)\b",
+    re.IGNORECASE,
+)
+
+# Questions that recently failed start one tier higher when asked again
+FAILURE_MEMORY = 200
+FAILURE_SIMILARITY = 0.6
+
+tier_stats = {}
+_recent_failures = []
+_stats_lock = threading.Lock()
+
+def question_terms(prompt):
+    return set(re.findall(r"[a-z0-9]+", prompt.lower()))
+
+# Function to score how hard a question is to turn into SQL
+def estimate_complexity(prompt):
+    tables = sum(bool(re.search(pattern, prompt, re.IGNORECASE)) for pattern in TABLE_KEYWORDS.values())
+    score = max(0, tables - 1) * 2
+    score += len(ANALYTIC_PATTERN.findall(prompt))
+    score += len(prompt.split()) > 25
+    return score
+
+def failed_before(prompt):
+    terms = question_terms(prompt)
+    with _stats_lock:
+        return any(len(terms & failed) / max(1, len(terms | failed)) >= FAILURE_SIMILARITY for failed in _recent_failures)
+
+# Function to pick the starting rung for a question: single-table questions go to the cheapest model
+def choose_tier(prompt):
+    score = estimate_complexity(prompt)
+    tier = 0 if score <= 1 else 1 if score <= 3 else len(MODEL_LADDER) - 1
+    if failed_before(prompt):
+        tier += 1
+    return min(tier, len(MODEL_LADDER) - 1)
+
+# Function to remember a question whose SQL failed, so a retry starts higher on the ladder
+def remember_failure(prompt):
+    with _stats_lock:
+        _recent_failures.append(question_terms(prompt))
+        del _recent_failures[:-FAILURE_MEMORY]
+
+# Comments and string literals, matched together so "--" inside a string is not taken for a comment
+COMMENT_OR_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+# Function to check generated SQL locally against the schema; returns a problem description or None
+def validate_sql(sql, schema, result_store=()):
+    # Literals are emptied so their parentheses, keywords and dots are not read as SQL
+    body = COMMENT_OR_LITERAL_PATTERN.sub(lambda m: "''" if m.group(0).startswith("'") else "", sql).strip()
+    if not re.match(r"(SELECT|WITH)\b", body, re.IGNORECASE):
+        return "only SELECT queries can be run"
+    if body.count("'") % 2:
+        return "unterminated string literal"
+    if body.count("(") != body.count(")"):
+        return "unbalanced parentheses"
+
+    columns = {table.upper(): {name.upper() for name, _ in cols} for table, cols in schema.items()}
+    ctes = {name.upper() for name in re.findall(r"(?:\bWITH|,)\s*([A-Za-z_][A-Za-z0-9_]*)\s+AS\s*\(", body, re.IGNORECASE)}
+    results = {result_name(i).upper() for i in range(min(len(result_store), RESULT_HISTORY))}
+    unknown = referenced_tables(body) - set(columns) - ctes - results
+    # EXTRACT(... FROM col) and TRIM(... FROM col) read like table references
+    unknown = {name for name in unknown if not any(name in cols for cols in columns.values())}
+    if unknown:
+        return "unknown table " + ", ".join(sorted(unknown))
+
+    # alias.COLUMN references must exist on the aliased table
+    aliases = {qualifier: table for qualifier, table in table_aliases(body).items() if table in columns}
+    for qualifier, column in re.findall(r"\b([A-Za-z_][A-Za-z0-9_]*)\.\"?([A-Za-z_][A-Za-z0-9_]*)\"?", body):
+        table = aliases.get(qualifier.upper())
+        if table and column.upper() not in columns[table]:
+            return f"unknown column {table}.{column.upper()}"
+    return None
+
+# Function to estimate the USD cost of a completion
+def completion_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+def _stats(model):
+    return tier_stats.setdefault(model, {
+        "attempts": 0, "escalated": 0, "latency_s": 0.0, "cost_usd": 0.0, "executions": 0, "succeeded": 0,
+    })
+
+# Function to record one generation attempt on a rung; escalated when its SQL was rejected
+def record_attempt(model, latency_s, prompt_tokens, completion_tokens, escalated):
+    with _stats_lock:
+        stats = _stats(model)
+        stats["attempts"] += 1
+        stats["escalated"] += bool(escalated)
+        stats["latency_s"] += latency_s
+        stats["cost_usd"] += completion_cost(model, prompt_tokens, completion_tokens)
+
+# Function to record whether the SQL a rung produced ran successfully
+def record_execution(model, success):
+    with _stats_lock:
+        stats = _stats(model)
+        stats["executions"] += 1
+        stats["succeeded"] += bool(success)
+
+# Function to summarise per-tier latency, cost and success for tuning the ladder
+def tier_summary():
+    with _stats_lock:
+        return [
+            {
+                "Model": model,
+                "Attempts": stats["attempts"],
+                "Escalated": stats["escalated"],
+                "Avg Latency (s)": stats["latency_s"] / stats["attempts"] if stats["attempts"] else 0.0,
+                "Cost (USD)": stats["cost_usd"],
+                "Success Rate": stats["succeeded"] / stats["executions"] if stats["executions"] else None,
+            }
+            for model, stats in ((model, tier_stats[model]) for model in MODEL_LADDER if model in tier_stats)
+        ]
@@ -4,6 +4,7 @@ import pandas as pd
 from openai import OpenAI
 import re
 import plotly.express as px
+from result_summary import summarize_result
 
 st.set_page_config(page_title="Loan Officer Performance Chatbot", page_icon="🏦", layout="wide")
 
@@ -147,7 +148,7 @@ else:
                             human_response = f"Great question! I've analyzed your book of business, and I'm excited to share the results with you. The total value of your closed and funded loans under management is ${value:,.2f}. This represents the cumulative amount of all your successfully closed opportunities. It's an impressive figure that showcases your performance and the trust your clients place in you. Is there anything specific about this value you'd like to know more about, such as how it compares to previous periods or your goals?"
                         else:
                             # General case for other types of queries
-                            human_response = f"I've got the results for you! Here's what I found:\n\n{df.to_string(index=False)}\n\nWould you like me to explain any part of these results in more detail?"
+                            human_response = f"I've got the results for you! Here's what I found:\n\n{summarize_result(df)}\n\nWould you like me to explain any part of these results in more detail?"
                         
                         # Create a chart if applicable
                         if len(df.columns) >= 2 and df[df.columns[1]].dtype in ['int64', 'float64']:
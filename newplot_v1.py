@@ -4,6 +4,7 @@ import pandas as pd
 from openai import OpenAI
 import re
 import plotly.express as px
+from result_summary import summarize_result
 
 st.set_page_config(page_title="Loan Officer Performance Chatbot", page_icon="🏦", layout="wide")
 
@@ -218,7 +219,7 @@ else:
 
                 # Generate a human-like response with the actual results
                     if not df.empty:
-                        human_response = f"Great! I've executed the query and here are the results:\n\n{df.to_string(index=False)}\n\nWould you like me to explain any part of these results in more detail?"
+                        human_response = f"Great! I've executed the query and here are the results:\n\n{summarize_result(df)}\n\nWould you like me to explain any part of these results in more detail?"
                         st.dataframe(df)
                     
                     # Visualization (if applicable)
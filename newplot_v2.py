@@ -1,104 +1,105 @@
 import streamlit as st
-import snowflake.connector
 import pandas as pd
 from openai import OpenAI
-import re
+import time
 import plotly.express as px
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from warehouse_router import warehouse_summary, start_metrics_sync
+from local_replica import execute_query, start_replica_sync, replica_staleness
+from cassette import CASSETTE_MODE, apply_cassette_mode
+from loanbot_pipeline import (
+    TABLES, init_snowflake_connection, get_table_schema, build_system_prompt,
+    chat_messages, turn_examples, record_turn_outcome, generate_response, extract_sql_blocks, fetch_sql, record_result,
+    run_sql, run_sql_blocks, make_sql_pool, run_response_sql
+)
+from intent_router import route_intent, routing_stats
+from kpi_trends import get_kpi_trends, overall_kpis, total_series, add_deltas
+from openai_limiter import LIMITER
+from result_dtypes import memory_report
+from session_registry import touch_session, is_evicted, remove_session, start_reaper, session_usage, ADMIN_VIEW_ENABLED
+from result_export import start_export, cancel_export, discard_export, export_progress, export_url
+from table_layout import load_table_layout, unpruned_scans, scan_summary
+from approx_preview import approximate_sql, start_refinement
+from prefetch import new_prefetch_cache, start_prefetch, take_prefetched, prefetch_summary
+from example_store import record_generation, generation_summary
+from model_ladder import record_execution, remember_failure, tier_summary
+from value_dictionary import start_value_sync, rewrite_stats
 
 st.set_page_config(page_title="Loan Officer Performance Chatbot", page_icon="🏦", layout="wide")
 
 st.title("🏦 Loan Officer Performance Chatbot")
 
+# Track this session so idle sessions get their connections closed
+start_reaper()
+session_ctx = get_script_run_ctx()
+if is_evicted(session_ctx.session_id, st.session_state):
+    st.session_state.clear()
+    remove_session(session_ctx.session_id)
+    st.warning("Your session was closed after being idle. Please reconnect.")
+touch_session(session_ctx.session_id, session_ctx.session_state)
+
 # Initialize session state variables
 if "connected" not in st.session_state:
     st.session_state.connected = False
 if "snowflake_conn" not in st.session_state:
     st.session_state.snowflake_conn = None
+if "sql_pool" not in st.session_state:
+    st.session_state.sql_pool = None
+if "conn_factory" not in st.session_state:
+    st.session_state.conn_factory = None
 if "openai_client" not in st.session_state:
     st.session_state.openai_client = None
 if "kpi_scores" not in st.session_state:
     st.session_state.kpi_scores = None
-
-# Function to initialize Snowflake connection
-def init_snowflake_connection(password):
-    return snowflake.connector.connect(
-        account="au02318.eu-west-2.aws",
-        user="salesmachinesPOC",
-        password=password,
-        warehouse="COMPUTE_WH",
-        database="FIRSTDB",
-        schema="PUBLIC"
-    )
-
-def calculate_kpi_scores(conn):
-    cursor = conn.cursor()
-    
+if "last_sql" not in st.session_state:
+    st.session_state.last_sql = None
+if "exports" not in st.session_state:
+    st.session_state.exports = []
+if "result_store" not in st.session_state:
+    st.session_state.result_store = []
+if "kpi_trends" not in st.session_state:
+    st.session_state.kpi_trends = None
+if "prefetch" not in st.session_state:
+    st.session_state.prefetch = new_prefetch_cache()
+if "preview_mode" not in st.session_state:
+    st.session_state.preview_mode = True
+
+# Function to score the KPIs: most are read off the stored monthly series, the rest (other tables,
+# distinct counts) are queried directly. A stale series refreshes on a connection from conn_factory.
+def calculate_kpi_scores(conn, conn_factory=None):
     kpi_queries = {
-        "Total Number of Loans Closed": "SELECT COUNT(*) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'",
-        "Total Dollar Value of Loans Closed": "SELECT SUM(AMOUNT) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'",
-        "Loan Types": """
-            SELECT 
-                COUNT(CASE WHEN LOANTYPE__C = 'Fixed' THEN 1 END) AS Fixed,
-                COUNT(CASE WHEN LOANTYPE__C = 'ARM' THEN 1 END) AS ARM,
-                COUNT(CASE WHEN LOANTYPE__C = 'FHA' THEN 1 END) AS FHA
-            FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'
-        """,
-        "Average Loan Size": "SELECT AVG(AMOUNT) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'",
-        "Loan Approval Rate": """
-            SELECT 
-                CAST(COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN 1 END) AS FLOAT) / 
-                NULLIF(COUNT(*), 0) * 100 
-            FROM OPPORTUNITY
-        """,
         "Customer Satisfaction Scores": "SELECT AVG(REVIEWSTARRATING__C) FROM ACCOUNT",
         "Referral Rates": "SELECT COUNT(*) FROM REFERRAL__C",
-        "Time to Close": """
-            SELECT AVG(DATEDIFF('day', CREATEDDATE, CLOSEDATE)) 
-            FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'
-        """,
-        "Default Rates": "SELECT COUNT(*) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Lost' AND TYPE = 'Default'",
-        "Market Share Growth": """
-            SELECT 
-                (SELECT COUNT(*) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won' AND CLOSEDATE >= DATEADD(year, -1, CURRENT_DATE())) /
-                NULLIF((SELECT COUNT(*) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won' AND CLOSEDATE < DATEADD(year, -1, CURRENT_DATE()) AND CLOSEDATE >= DATEADD(year, -2, CURRENT_DATE())), 0) * 100 - 100
-        """,
-        "Regulatory Compliance": "SELECT COUNT(*) FROM OPPORTUNITY WHERE ISCOMPLIANT__C = TRUE",
-        "Profitability per Loan": "SELECT AVG(REVENUE__C - COST__C) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'",
-        "Adaptability to Market Changes": """
-            SELECT STDDEV(AMOUNT) / AVG(AMOUNT) * 100
-            FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'
-        """,
-        "Cross-Selling Ratio": """
-            SELECT AVG(NUMBER_OF_PRODUCTS__C) 
-            FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'
-        """,
         "Repeat Business Rate": """
             SELECT 
                 COUNT(DISTINCT CASE WHEN NUMBER_OF_CLOSED_OPPORTUNITIES__C > 1 THEN ACCOUNTID END) * 100.0 / 
                 NULLIF(COUNT(DISTINCT ACCOUNTID), 0)
             FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'
         """,
-        "Conversion Rate": """
-            SELECT 
-                COUNT(CASE WHEN STAGENAME = 'Closed Won' THEN 1 END) * 100.0 / 
-                NULLIF(COUNT(CASE WHEN STAGENAME IN ('Prospecting', 'Qualification') THEN 1 END), 0)
-            FROM OPPORTUNITY
-        """,
-        "Loan Origination Fees": "SELECT AVG(ORIGINATION_FEES__C) FROM OPPORTUNITY WHERE STAGENAME = 'Closed Won'"
     }
     
     kpi_scores = {}
+    try:
+        st.session_state.kpi_trends = get_kpi_trends(conn, conn_factory)
+        kpi_scores.update(overall_kpis(st.session_state.kpi_trends))
+    except Exception as e:
+        st.warning(f"Error refreshing KPI trends: {str(e)}")
+        st.session_state.kpi_trends = None
+
     for kpi, query in kpi_queries.items():
         try:
-            cursor.execute(query)
-            result = cursor.fetchone()
+            cursor = execute_query(conn, query)
+            try:
+                result = cursor.fetchone()
+            finally:
+                cursor.close()
             kpi_scores[kpi] = result[0] if result and result[0] is not None else 0
         except Exception as e:
             st.warning(f"Error calculating {kpi}: {str(e)}")
             kpi_scores[kpi] = 0
     
-    cursor.close()
-    return kpi_scores
+    # The score table lines KPIs up by position, so they keep the impact scores' order
+    return {kpi: kpi_scores.get(kpi, 0) for kpi in calculate_lo_impact_scores()}
 
 def calculate_lo_impact_scores():
     # This would typically be based on business logic or predefined weightings
@@ -164,6 +165,16 @@ def calculate_lo_ranking_scores(impact_scores, achievement_scores):
         ranking_scores[kpi] = (impact_scores[kpi] * achievement_scores[kpi]) / 10
     return ranking_scores
 
+# Function to show one of several SQL blocks in an answer with its result or error
+def show_sql_block(block):
+    st.code(block["sql"], language="sql")
+    if block["error"] is not None:
+        st.error(f"Error executing SQL: {block['error']}")
+    elif block["df"].empty:
+        st.info("No results matching the criteria.")
+    else:
+        st.dataframe(block["df"])
+
 # Connection interface
 if not st.session_state.connected:
     with st.form("connection_form"):
@@ -172,13 +183,26 @@ if not st.session_state.connected:
         submit_button = st.form_submit_button("Connect")
 
     if submit_button:
-        if not snowflake_password or not openai_api_key:
+        if CASSETTE_MODE not in ("replay", "replay_fast") and (not snowflake_password or not openai_api_key):
             st.error("Please enter both Snowflake password and OpenAI API key.")
         else:
             try:
-                st.session_state.snowflake_conn = init_snowflake_connection(snowflake_password)
-                st.session_state.openai_client = OpenAI(api_key=openai_api_key)
-                st.session_state.kpi_scores = calculate_kpi_scores(st.session_state.snowflake_conn)
+                # Record or replay sessions when LOANBOT_CASSETTE_MODE is set
+                st.session_state.snowflake_conn, st.session_state.openai_client = apply_cassette_mode(
+                    lambda: init_snowflake_connection(snowflake_password),
+                    lambda: OpenAI(api_key=openai_api_key)
+                )
+                if CASSETTE_MODE not in ("replay", "replay_fast"):
+                    start_replica_sync(lambda: init_snowflake_connection(snowflake_password))
+                    start_value_sync(lambda: init_snowflake_connection(snowflake_password), TABLES)
+                    start_metrics_sync(lambda: init_snowflake_connection(snowflake_password))
+                # Extra connections let independent SQL blocks in one answer run concurrently and
+                # keep background KPI refreshes off the session connection
+                st.session_state.conn_factory = None if CASSETTE_MODE else lambda: init_snowflake_connection(snowflake_password)
+                st.session_state.sql_pool = make_sql_pool(st.session_state.snowflake_conn, st.session_state.conn_factory)
+                st.session_state.kpi_scores = calculate_kpi_scores(
+                    st.session_state.snowflake_conn, st.session_state.conn_factory
+                )
                 st.session_state.connected = True
                 st.success("Connected successfully!")
                 st.rerun()
@@ -187,53 +211,19 @@ if not st.session_state.connected:
 else:
     # Function to get table schema
     @st.cache_data
-    def get_table_schema(table_name):
-        cursor = st.session_state.snowflake_conn.cursor()
-        cursor.execute(f"DESCRIBE TABLE FirstDB.PUBLIC.{table_name}")
-        columns = cursor.fetchall()
-        cursor.close()
-        return [(col[0], col[1]) for col in columns]
-
-    # List of tables
-    tables = [
-        "OPPORTUNITY", "ACCOUNT", "CONTACT", "REFERRAL__C", "TASK", "EVENT",
-        "COMMISSIONFEE__C", "ADDITIONAL_LOAN__C", "OUTBOUND_REFERRAL__C",
-        "LOAN_REFERRAL__C", "REAL_ESTATE_OWNED__C", "ASSET__C", "LIABILITY__C", "LEAD", "Offer__c",
-        "OPPORTUNITYTEAMMEMBER"
-    ]
+    def get_cached_table_schema(table_name):
+        return get_table_schema(st.session_state.snowflake_conn, table_name)
 
     # Generate system prompt (only once)
     if "system_prompt" not in st.session_state:
-        table_info = []
-        for table in tables:
-            columns = get_table_schema(table)
-            column_info = ", ".join([f"{col[0]} ({col[1]})" for col in columns])
-            table_info.append(f"Table: {table}\nColumns: {column_info}")
-    
-        table_context = "\n\n".join(table_info)
-    
-        st.session_state.system_prompt = f"""You are an AI Snowflake SQL expert named LoanBot. Your goal is to give correct, executable SQL queries to users asking about loan officer performance. You will be replying to users who will be confused if you don't respond in the character of LoanBot.
-
-        The user will ask questions about loan officer performance; for each question, you should respond and include a SQL query based on the question and the available tables in FirstDB.PUBLIC schema.
-
-        <table_context>
-        {table_context}
-        </table_context>
-
-        Here are 7 critical rules for the interaction you must abide:
-        <rules>
-        1. You MUST MUST wrap the generated SQL queries within ```sql code markdown
-        2. If I don't tell you to find a limited set of results in the sql query or question, you MUST limit the number of responses to 10.
-        3. Text / string where clauses must be fuzzy match e.g ilike %keyword%
-        4. Make sure to generate a single Snowflake SQL code snippet, not multiple. 
-        5. You should only use the table columns given in the table context, you MUST NOT use columns that are not listed in the schema.
-        6. DO NOT put numerical at the very front of SQL variable.
-        7. Use only valid Snowflake SQL syntax.
-        7. For boolean conditions, use the actual boolean values 'true' or 'false' without quotes, not string representations.
-        </rules>
-
-        Now to get started, please briefly introduce yourself, describe the available data at a high level, and share some example metrics that can be analyzed in 2-3 sentences. Then provide 3 example questions using bullet points.
-    """
+        st.session_state.schema = {table: get_cached_table_schema(table) for table in TABLES}
+        # Row counts, clustering keys and date ranges steer generated queries toward pruning
+        try:
+            layout = load_table_layout(st.session_state.snowflake_conn, st.session_state.schema)
+        except Exception as e:
+            st.warning(f"Error reading table layout: {str(e)}")
+            layout = None
+        st.session_state.system_prompt, st.session_state.schema_stats = build_system_prompt(st.session_state.schema, layout)
 
     # Initialize chat messages
     if "messages" not in st.session_state:
@@ -245,7 +235,13 @@ else:
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
                 if "results" in message:
+                    if message.get("estimate"):
+                        st.caption("Estimate from a sample or approximate aggregates" + (" — exact result loading…" if "refinement" in message else ""))
                     st.dataframe(message["results"])
+                if "blocks" in message:
+                    for column, block in zip(st.columns(len(message["blocks"])), message["blocks"]):
+                        with column:
+                            show_sql_block(block)
                 if "chart" in message:
                     st.plotly_chart(message["chart"])
 
@@ -257,12 +253,16 @@ else:
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
+            turn_start = time.perf_counter()
             message_placeholder = st.empty()
             full_response = ""
+            assistant_message = {}
 
-            if "kpi scores" in prompt.lower() or "loan officer performance" in prompt.lower():
+            # Common question shapes are answered from SQL templates without calling the LLM
+            intent = route_intent(prompt)
+            if intent and intent["template"] == "kpi_scores":
                 try:
-                    kpi_scores = calculate_kpi_scores(st.session_state.snowflake_conn)
+                    kpi_scores = calculate_kpi_scores(st.session_state.snowflake_conn, st.session_state.conn_factory)
                     impact_scores = calculate_lo_impact_scores()
                     achievement_scores = calculate_dino_lo_percentage_achievement(kpi_scores)
                     ranking_scores = calculate_lo_ranking_scores(impact_scores, achievement_scores)
@@ -285,41 +285,166 @@ else:
                     fig = px.bar(df, x='KPI', y='LO Ranking Score', title='Loan Officer KPI Ranking Scores')
                     st.plotly_chart(fig)
 
+                    # Monthly trend with month-over-month change, from the stored series
+                    if st.session_state.kpi_trends is not None:
+                        monthly = add_deltas(total_series(st.session_state.kpi_trends), "CLOSED_VOLUME")
+                        trend_fig = px.line(monthly, x='MONTH', y='CLOSED_VOLUME', hover_data=['CLOSED_VOLUME_MOM_PCT', 'CLOSED_VOLUME_YOY_PCT'], title='Closed Loan Volume by Month')
+                        st.plotly_chart(trend_fig)
+
                 except Exception as e:
                     error_message = f"I apologize, but I encountered an error while calculating the KPI scores. The specific error was: {str(e)}. Please check the database connection and try again."
                     full_response = error_message
                     message_placeholder.markdown(full_response)
                     st.error(f"Error calculating KPI scores: {e}")
+            elif intent:
+                sql = intent["sql"]
+                try:
+                    df = take_prefetched(st.session_state.prefetch, intent)
+                    if df is None:
+                        df = run_sql(st.session_state.snowflake_conn, sql, None, st.session_state.result_store)
+                    else:
+                        record_result(sql, df, None, st.session_state.result_store)
+                    st.session_state.last_sql = sql
+
+                    # Warm the likely drill-downs while the user reads this answer (cassettes replay in order, so not there)
+                    if not CASSETTE_MODE:
+                        store = st.session_state.result_store
+                        start_prefetch(st.session_state.prefetch, st.session_state.sql_pool, intent, df, lambda conn, q: fetch_sql(conn, q, store))
+
+                    full_response = intent["summary"]
+                    if not df.empty:
+                        st.dataframe(df)
+                        if len(df.columns) >= 2 and pd.api.types.is_numeric_dtype(df[df.columns[-1]]):
+                            fig = px.bar(df, x=df.columns[0], y=df.columns[-1], title=f"{df.columns[-1]} by {df.columns[0]}")
+                            st.plotly_chart(fig)
+                    else:
+                        full_response += "\n\nThere were no results matching the criteria. Would you like me to check something else for you?"
+                    message_placeholder.markdown(full_response)
+                except Exception as e:
+                    full_response = f"I apologize, but I encountered an error while running that report. The specific error was: {str(e)}. Please try rephrasing your question."
+                    message_placeholder.markdown(full_response)
+                    st.error(f"Error executing SQL: {e}")
             else:
                 # Existing chat completion logic for other types of questions
-                for response in st.session_state.openai_client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": st.session_state.system_prompt},
-                        *[{"role": m["role"], "content": m["content"]} for m in st.session_state.messages[-5:]]
-                    ],
-                    stream=True,
+                # Closest verified question -> SQL pairs steer the model past schema quirks
+                examples = turn_examples(prompt, st.session_state.result_store)
+                messages = chat_messages(st.session_state.system_prompt, st.session_state.messages, prompt, st.session_state.result_store, examples)
+                # Show where this turn is in the shared OpenAI queue while it waits
+                def show_wait(position, waited):
+                    if position:
+                        message_placeholder.markdown(f"Waiting for OpenAI capacity: position {position} in queue, {waited:.0f}s so far…")
+                    else:
+                        message_placeholder.markdown(f"OpenAI is busy, retrying in {waited:.0f}s…")
+
+                # Heavy aggregations are previewed below, so their exact query is not run while generating
+                def run_response(response):
+                    return run_response_sql(
+                        st.session_state.snowflake_conn, st.session_state.sql_pool, response,
+                        st.session_state.schema, st.session_state.result_store,
+                        lambda sql: st.session_state.preview_mode and approximate_sql(sql) is not None
+                    )
+
+                # Simple questions start on the cheapest model; rejected or failing SQL climbs the ladder.
+                # Cassettes record no failed queries, so recorded turns only climb on rejected SQL.
+                model = None
+                executed = None
+                for event, payload in generate_response(
+                    st.session_state.openai_client, None if CASSETTE_MODE else st.session_state.sql_pool,
+                    messages, prompt, st.session_state.schema, st.session_state.result_store, on_wait=show_wait,
+                    execute=None if CASSETTE_MODE else run_response
                 ):
-                    full_response += (response.choices[0].delta.content or "")
-                    message_placeholder.markdown(full_response + "▌")
+                    if event == "model":
+                        model = payload
+                    elif event == "escalate":
+                        st.caption(f"{model} answer rejected ({payload}); escalating")
+                        full_response = ""
+                    elif event == "executed":
+                        executed = payload
+                    else:
+                        full_response += payload
+                        message_placeholder.markdown(full_response + "▌")
                 message_placeholder.markdown(full_response)
 
-            # Check if the response contains a SQL query
-                sql_match = re.search(r"```sql\n(.*?)\n```", full_response, re.DOTALL)
-                if sql_match:
-                    sql = sql_match.group(1).strip()
+            # Check if the response contains SQL queries
+                sql_blocks = extract_sql_blocks(full_response)
+                ran = executed["outcomes"] if executed else None
+                if len(sql_blocks) > 1:
+                    # Independent queries in one answer run side by side instead of back to back
+                    if ran is None:
+                        wall_start = time.perf_counter()
+                        ran = run_sql_blocks(st.session_state.sql_pool, sql_blocks, st.session_state.schema, st.session_state.result_store)
+                        wall = time.perf_counter() - wall_start
+                    else:
+                        wall = executed["wall"]
+                    outcomes = ran
+                    # Kept on the message so the blocks are still shown after a rerun
+                    assistant_message["blocks"] = [
+                        {"sql": outcome["sql"], "df": outcome["df"], "error": None if outcome["error"] is None else str(outcome["error"])}
+                        for outcome in outcomes
+                    ]
+                    for column, block in zip(st.columns(len(outcomes)), assistant_message["blocks"]):
+                        with column:
+                            show_sql_block(block)
+                            for warning in unpruned_scans(block["sql"]):
+                                st.caption(f"⚠️ {warning}")
+                            if block["error"] is not None:
+                                full_response += f"\n\nOne of the queries failed: {block['error']}"
+                            elif not block["df"].empty:
+                                st.session_state.last_sql = block["sql"]
+                    st.caption(f"Ran {len(outcomes)} queries in {wall:.1f}s (back to back: {sum(o['elapsed'] for o in outcomes):.1f}s)")
+                    blocks_ok = all(outcome["error"] is None for outcome in outcomes)
+                    record_generation(bool(examples), blocks_ok)
+                    record_execution(model, blocks_ok)
+                    if not blocks_ok:
+                        remember_failure(prompt)
+                    message_placeholder.markdown(full_response)
+
+                sql = sql_blocks[0] if len(sql_blocks) == 1 else None
+                if sql:
+                    for warning in unpruned_scans(sql):
+                        st.caption(f"⚠️ {warning}")
+
+                # Heavy aggregations show a fast estimate first; the exact query swaps in when it finishes
+                preview_sql = approximate_sql(sql) if sql and st.session_state.preview_mode else None
+                if preview_sql:
                     try:
-                        cursor = st.session_state.snowflake_conn.cursor()
-                        cursor.execute(sql)
-                        results = cursor.fetchall()
-                        columns = [desc[0] for desc in cursor.description]
-                        df = pd.DataFrame(results, columns=columns)
+                        preview = fetch_sql(st.session_state.snowflake_conn, preview_sql, st.session_state.result_store)
+                        st.caption("Estimate from a sample or approximate aggregates — exact result loading…")
+                        st.dataframe(preview)
+                        full_response += "\n\nHere's a quick estimate; I'll swap in the exact figures as soon as they're ready."
+                        message_placeholder.markdown(full_response)
+                        store = st.session_state.result_store
+                        assistant_message = {
+                            "results": preview,
+                            "estimate": True,
+                            "refinement": start_refinement(st.session_state.sql_pool, sql, lambda conn, q: fetch_sql(conn, q, store)),
+                        }
+                        assistant_message["refinement"].update(question=prompt, examples=examples, model=model)
+                        st.session_state.last_sql = sql
+                        sql = None
+                    except Exception as e:
+                        st.caption(f"Preview unavailable ({e}); running the exact query")
+
+                if sql:
+                    try:
+                        # Already run while the answer was generated, unless it was deferred to a preview
+                        if ran is None:
+                            df = run_sql(st.session_state.snowflake_conn, sql, st.session_state.schema, st.session_state.result_store)
+                        elif ran[0]["error"] is not None:
+                            raise ran[0]["error"]
+                        else:
+                            df = ran[0]["df"]
+                        st.session_state.last_sql = sql
+                        record_turn_outcome(prompt, sql, df, examples, st.session_state.result_store, model)
 
                         if not df.empty:
                             st.dataframe(df)
+                            report = memory_report(df)
+                            if report:
+                                st.caption(report)
                         
                         # Visualization (if applicable)
-                            if len(df.columns) >= 2 and df[df.columns[1]].dtype in ['int64', 'float64']:
+                            if len(df.columns) >= 2 and pd.api.types.is_numeric_dtype(df[df.columns[1]]):
                                 fig = px.bar(df, x=df.columns[0], y=df.columns[1], title=f"{df.columns[1]} by {df.columns[0]}")
                                 st.plotly_chart(fig)
                                 full_response += "\n\nI've also created a bar chart to visualize this data for you. Does this help illustrate the information more clearly?"
@@ -327,20 +452,92 @@ else:
                             full_response += "\n\nI've run the query, but it looks like there were no results matching the criteria. Would you like me to modify the query or check something else for you?"
                 
                         message_placeholder.markdown(full_response)
-                        cursor.close()
                     except Exception as e:
+                        record_turn_outcome(prompt, sql, None, examples, st.session_state.result_store, model)
                         error_message = f"\n\nI apologize, but I encountered an error while trying to execute the SQL query. The specific error was: {str(e)}. Let me try to rephrase the query to address this issue."
                         full_response += error_message
                         message_placeholder.markdown(full_response)
                         st.error(f"Error executing SQL: {e}")
 
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
+            st.session_state.messages.append({"role": "assistant", "content": full_response, **assistant_message})
+            if CASSETTE_MODE:
+                st.caption(f"Turn processed in {(time.perf_counter() - turn_start) * 1000:.0f} ms ({CASSETTE_MODE})")
+
+    # Export the full result behind the last answer without loading it into memory
+    if st.session_state.last_sql:
+        with st.expander("Export full result"):
+            export_format = st.radio("Format", ["parquet", "csv"], horizontal=True)
+            if st.button("Start export"):
+                st.session_state.exports.append(
+                    start_export(st.session_state.snowflake_conn, st.session_state.last_sql, export_format)
+                )
+
+    # Poll progress only while an export is running; files are downloaded from disk, never loaded here
+    def show_exports():
+        touch_session(session_ctx.session_id, session_ctx.session_state)
+        finished = False
+        for i, job in enumerate(st.session_state.exports):
+            st.progress(export_progress(job), text=f"Export {i + 1} ({job['format']}): {job['status']}, {job['rows']:,} rows")
+            if job["status"] == "running":
+                if st.button("Cancel", key=f"cancel_export_{i}"):
+                    cancel_export(st.session_state.snowflake_conn, job)
+            elif not job.get("shown"):
+                job["shown"] = True
+                finished = True
+            if job["status"] == "done":
+                url = export_url(job)
+                if url:
+                    st.link_button("Download", url)
+                else:
+                    st.caption(f"Saved on the server at `{job['path']}`")
+            elif job["status"] == "error":
+                st.error(f"Export failed: {job['error']}")
+        # A full rerun re-creates the fragment without polling once nothing is running
+        if finished:
+            st.rerun()
+
+    if st.session_state.exports:
+        running = any(job["status"] == "running" for job in st.session_state.exports)
+        st.fragment(show_exports, run_every=1 if running else None)()
+
+    # Swap exact results in for the estimates once their background queries finish
+    @st.fragment(run_every=1)
+    def show_refinements():
+        touch_session(session_ctx.session_id, session_ctx.session_state)
+        swapped = False
+        for message in st.session_state.messages:
+            job = message.get("refinement")
+            if job is None or job["status"] == "running":
+                continue
+            del message["refinement"]
+            if job["status"] == "done":
+                message["results"] = job["df"]
+                message["estimate"] = False
+                message["content"] += f"\n\nExact result ready after {job['finished_at'] - job['started_at']:.1f}s."
+                record_result(job["sql"], job["df"], st.session_state.schema, st.session_state.result_store)
+                record_turn_outcome(job["question"], job["sql"], job["df"], job["examples"], st.session_state.result_store, job["model"])
+            else:
+                record_turn_outcome(job["question"], job["sql"], None, job["examples"], st.session_state.result_store, job["model"])
+                message["content"] += f"\n\nThe exact query failed ({job['error']}), so the figures above remain estimates."
+            swapped = True
+        if swapped:
+            st.rerun()
+
+    if any("refinement" in message for message in st.session_state.messages):
+        show_refinements()
 
     # Add a disconnect button
     if st.button("Disconnect"):
+        for job in st.session_state.exports:
+            if job["status"] == "running":
+                cancel_export(st.session_state.snowflake_conn, job)
+            discard_export(job)
         if st.session_state.snowflake_conn:
             st.session_state.snowflake_conn.close()
+        if st.session_state.sql_pool:
+            st.session_state.sql_pool.close()
         st.session_state.clear()
+        remove_session(session_ctx.session_id)
         st.rerun()
 
 # Add a sidebar with additional information or controls
@@ -352,7 +549,61 @@ with st.sidebar:
     if st.session_state.connected:
         st.success("Connected to Snowflake")
         st.success("KPI Scores Calculated")
+        st.toggle("Instant estimates for heavy aggregations", key="preview_mode")
     else:
         st.warning("Not connected to Snowflake")
         st.warning("KPI Scores Not Available")
+
+    # Show how long queries wait on each warehouse
+    if warehouse_summary():
+        st.subheader("Warehouse Usage")
+        st.dataframe(pd.DataFrame(warehouse_summary()))
+
+    # How far behind Snowflake the local replica is
+    for table, status in replica_staleness().items():
+        if status["error"]:
+            st.warning(f"Local {table} replica sync failed: {status['error']}")
+        if status["age"] is not None:
+            st.caption(f"Local {table} replica: synced {status['age'] / 60:.0f} min ago")
+
+    # Prompt size of the compiled schema
+    if "schema_stats" in st.session_state:
+        stats = st.session_state.schema_stats
+        st.caption(f"Schema prompt: {stats['tokens_before']:,} → {stats['tokens_after']:,} tokens")
+
+    # Scan volume of generated queries
+    scans = scan_summary()
+    if scans:
+        st.caption(f"Generated queries: {scans['avg_size']} scanned on average, {scans['unpruned_share']:.0%} without pruning")
+
+    # How often questions are answered from templates
+    if routing_stats:
+        template_hits = sum(count for name, count in routing_stats.items() if name != "llm")
+        st.caption(f"Template answers: {template_hits} of {sum(routing_stats.values())} questions")
+
+    # First-try success of generated SQL with and without verified examples
+    for group, outcome in generation_summary().items():
+        st.caption(f"First-try SQL success {group.replace('_', ' ')}: {outcome['success_rate']:.0%} of {outcome['turns']} turns")
+
+    # Fuzzy filters turned into exact predicates by the value dictionary
+    if rewrite_stats["queries"]:
+        st.caption(f"Exact-value rewrites: {rewrite_stats['rewritten']} of {rewrite_stats['queries']} queries ({rewrite_stats['predicates']} predicates)")
+
+    # Latency, cost and success per model rung
+    if tier_summary():
+        with st.expander("Model tiers"):
+            st.dataframe(pd.DataFrame(tier_summary()))
+
+    # How often prefetched drill-downs were actually asked for
+    prefetches = prefetch_summary()
+    if prefetches["issued"]:
+        st.caption(f"Prefetch: {prefetches['hits']} of {prefetches['issued']} used ({prefetches['hit_rate']:.0%}), {prefetches['skipped']} skipped over budget")
+
+    # Shared OpenAI queue
+    st.caption(f"OpenAI queue: {LIMITER.queue_length()} waiting, {LIMITER.stats['retries']} retries so far")
+
+    # Admin view of resources held by every session in this process
+    if ADMIN_VIEW_ENABLED:
+        with st.expander("Session usage (admin)"):
+            st.dataframe(pd.DataFrame(session_usage()))
            
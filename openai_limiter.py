@@ -0,0 +1,150 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+import openai
+
+# Process-wide OpenAI budget shared by every session
+REQUESTS_PER_MINUTE = int(os.environ.get("LOANBOT_OPENAI_RPM", "500"))
+TOKENS_PER_MINUTE = int(os.environ.get("LOANBOT_OPENAI_TPM", "160000"))
+
+# Lower numbers are served first. Background work (prefetches, KPI refreshes) queues behind every
+# interactive turn, so it only starts while no user is waiting for capacity
+INTERACTIVE = 0
+BACKGROUND = 1
+
+MAX_RETRIES = 5
+BASE_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 30.0
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Function to estimate how long until the bucket holds this many tokens
+    def wait_time(self, amount):
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self.stats = {"granted": 0, "waited_s": 0.0, "retries": 0}
+
+    # Function to block until both buckets can cover a request; on_wait(position, waited_s) reports progress.
+    # requests=0 only waits for its turn in the queue, without spending any budget.
+    def acquire(self, estimated_tokens, priority=INTERACTIVE, on_wait=None, requests=1):
+        ticket = (priority, next(self._counter))
+        start = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            granted = False
+            try:
+                while True:
+                    if self._queue[0] == ticket:
+                        wait = max(self.requests.wait_time(requests), self.tokens.wait_time(estimated_tokens))
+                        if wait == 0:
+                            heapq.heappop(self._queue)
+                            granted = True
+                            self.requests.tokens -= requests
+                            self.tokens.tokens -= min(estimated_tokens, self.tokens.capacity)
+                            self._cond.notify_all()
+                            break
+                    else:
+                        wait = 0.5
+                    if on_wait is not None:
+                        position = sorted(self._queue).index(ticket) + 1
+                        self._cond.release()
+                        try:
+                            on_wait(position, time.monotonic() - start)
+                        finally:
+                            self._cond.acquire()
+                    self._cond.wait(timeout=min(wait, 1.0))
+            finally:
+                # A waiter interrupted by on_wait (e.g. a Streamlit rerun) must not block the queue behind it
+                if not granted:
+                    self._queue.remove(ticket)
+                    heapq.heapify(self._queue)
+                    self._cond.notify_all()
+            waited = time.monotonic() - start
+            self.stats["granted"] += 1
+            self.stats["waited_s"] += waited
+        return waited
+
+    # Function to settle a request's reservation against the tokens the API reports it used
+    def reconcile(self, estimated_tokens, used_tokens):
+        with self._cond:
+            self.tokens.refill()
+            reserved = min(estimated_tokens, self.tokens.capacity)
+            self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens + reserved - used_tokens)
+            # A refund may let the head of the queue through now
+            self._cond.notify_all()
+
+    def record_retry(self):
+        with self._cond:
+            self.stats["retries"] += 1
+
+    # Function to shrink the token budget after a 429 so other sessions back off too
+    def penalize(self):
+        with self._cond:
+            self.tokens.refill()
+            self.tokens.tokens = min(self.tokens.tokens, 0)
+            self.requests.tokens = min(self.requests.tokens, 0)
+
+    def queue_length(self):
+        with self._cond:
+            return len(self._queue)
+
+LIMITER = RateLimiter()
+
+# Function to hold background work until no interactive caller is queued ahead of it
+def wait_for_background_turn(limiter=LIMITER):
+    limiter.acquire(0, BACKGROUND, requests=0)
+
+# Function to compute a jittered exponential backoff, honouring Retry-After when present
+def backoff_seconds(attempt, error=None):
+    retry_after = None
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+    delay = min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    return max(delay, retry_after or 0)
+
+# Function to call the OpenAI API under the shared limiter with jittered retries
+def limited_call(fn, estimated_tokens, priority=INTERACTIVE, on_wait=None, limiter=LIMITER):
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(estimated_tokens, priority, on_wait)
+        try:
+            return fn()
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            if isinstance(e, openai.RateLimitError):
+                limiter.penalize()
+            limiter.record_retry()
+            delay = backoff_seconds(attempt, e)
+            if on_wait is not None:
+                on_wait(0, delay)
+            time.sleep(delay)
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from snowflake.connector.errors import InterfaceError, OperationalError
+
+# Most queries a single response may run at once
+MAX_PARALLEL_QUERIES = 4
+
+# Extra Snowflake logins across every session's pool in the process
+MAX_POOLED_CONNECTIONS = int(os.environ.get("LOANBOT_MAX_POOLED_CONNECTIONS", "16"))
+# Longest acquire() waits for a connection once the process-wide cap is reached
+POOL_WAIT_SECONDS = 60
+
+# Errors after which a connection is closed instead of going back to the pool
+CONNECTION_ERRORS = (ConnectionError, TimeoutError, InterfaceError, OperationalError)
+
+_logins = threading.BoundedSemaphore(MAX_POOLED_CONNECTIONS)
+
+# Function to tell whether a failed query left its connection unusable
+def is_broken(conn, error):
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    is_closed = getattr(conn, "is_closed", None)
+    return callable(is_closed) and is_closed()
+
+# A session's connections for concurrent queries. counts_logins=False for a pool that only hands
+# out an existing connection, which costs no extra login.
+class ConnectionPool:
+    def __init__(self, factory, max_size=MAX_PARALLEL_QUERIES, counts_logins=True):
+        self.factory = factory
+        self.max_size = max_size
+        self.counts_logins = counts_logins
+        self._idle = []
+        self._all = []
+        self._cond = threading.Condition()
+        self._available = threading.Semaphore(max_size)
+
+    # Function to borrow a connection, opening a new one while under max_size and the process-wide cap.
+    # At the cap it takes the next connection this pool gets back or a login freed by another pool.
+    def acquire(self):
+        self._available.acquire()
+        deadline = time.monotonic() + POOL_WAIT_SECONDS
+        with self._cond:
+            while not self._idle:
+                if not self.counts_logins or _logins.acquire(blocking=False):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._available.release()
+                    raise RuntimeError(f"All {MAX_POOLED_CONNECTIONS} pooled Snowflake connections are in use")
+                self._cond.wait(min(remaining, 1.0))
+            else:
+                return self._idle.pop()
+        try:
+            conn = self.factory()
+        except Exception:
+            if self.counts_logins:
+                _logins.release()
+            self._available.release()
+            raise
+        with self._cond:
+            self._all.append(conn)
+        return conn
+
+    # Function to return a borrowed connection; error is what its query raised, if anything.
+    # A connection left broken by a network or session error is closed rather than reused.
+    def release(self, conn, error=None):
+        broken = error is not None and is_broken(conn, error)
+        with self._cond:
+            owned = conn in self._all
+            if broken and owned:
+                self._all.remove(conn)
+            elif not broken:
+                self._idle.append(conn)
+            self._cond.notify()
+        if broken:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            if owned and self.counts_logins:
+                _logins.release()
+        self._available.release()
+
+    def close(self):
+        with self._cond:
+            connections, self._all, self._idle = self._all, [], []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            if self.counts_logins:
+                _logins.release()
+
+# Function to run independent queries concurrently on pooled connections.
+# fetch(conn, sql) returns a DataFrame; results come back in the order of sqls as
+# {"sql", "df", "error", "elapsed"} dicts.
+def run_parallel(pool, sqls, fetch):
+    def run_one(sql):
+        start = time.perf_counter()
+        conn = None
+        error = None
+        try:
+            conn = pool.acquire()
+            return {"sql": sql, "df": fetch(conn, sql), "error": None, "elapsed": time.perf_counter() - start}
+        except Exception as e:
+            error = e
+            return {"sql": sql, "df": None, "error": e, "elapsed": time.perf_counter() - start}
+        finally:
+            if conn is not None:
+                pool.release(conn, error)
+
+    with ThreadPoolExecutor(max_workers=min(len(sqls), pool.max_size)) as executor:
+        return list(executor.map(run_one, sqls))
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import Counter
+
+from warehouse_router import estimate_query_cost
+from intent_router import OFFICER_NAMES_SQL, render_template, officer_id_predicate
+from openai_limiter import wait_for_background_turn
+
+# Likely next questions after each template; drill-downs take the top officer from the result
+FOLLOW_UPS = {
+    "top_officers_volume": ["officer_monthly_trend", "pipeline_by_stage"],
+    "top_officers_count": ["officer_monthly_trend", "pipeline_by_stage"],
+    "pipeline_by_stage": ["loan_type_mix"],
+    "loan_type_mix": ["pipeline_by_stage"],
+}
+DRILL_DOWN_SOURCES = {"top_officers_volume", "top_officers_count"}
+
+# Per-session budget in estimate_query_cost points, and how many prefetches may run at once
+PREFETCH_SESSION_BUDGET = 30
+MAX_PREFETCH_PER_SESSION = 2
+# Prefetches across all sessions; beyond this they are skipped rather than queued
+MAX_PREFETCH_QUERIES = 4
+PREFETCH_CACHE_SIZE = 6
+PREFETCH_TTL_SECONDS = 10 * 60
+# Longest a template answer waits on an in-flight prefetch before running its own query
+PREFETCH_WAIT_SECONDS = 5
+
+# Shared by every session in the process so the budget can be tuned from hit rates
+prefetch_stats = Counter()
+_prefetch_slots = threading.BoundedSemaphore(MAX_PREFETCH_QUERIES)
+
+# Function to create a session's prefetch cache
+def new_prefetch_cache():
+    return {"entries": {}, "spent": 0, "lock": threading.Lock()}
+
+def cache_key(sql):
+    return " ".join(sql.strip().rstrip(";").split())
+
+# Function to key a template query by its SQL without the officer predicate, plus the officer it is for,
+# so a drill-down prefetched by officer id can answer the same question asked by the officer's name
+def prefetch_key(intent):
+    slots = dict(intent["slots"], officer="")
+    return cache_key(render_template(intent["template"], slots)["sql"]), intent["slots"].get("officer_key", "")
+
+# Function to predict one or two likely follow-up template queries from a template answer and its result
+def predict_follow_ups(intent, df):
+    predictions = []
+    for template_name in FOLLOW_UPS.get(intent["template"], []):
+        slots = dict(intent["slots"])
+        period_text = intent.get("period_text", "")
+        if intent["template"] in DRILL_DOWN_SOURCES:
+            if df.empty or "OFFICER" not in df.columns:
+                continue
+            # Drill down on the top officer across all periods and loan types
+            officer_id = df["OFFICER"].iloc[0]
+            slots.update(period="", loan_type="", officer=officer_id_predicate(officer_id), officer_key=f"id:{officer_id}")
+            period_text = ""
+        predictions.append(render_template(template_name, slots, period_text))
+    return predictions
+
+# Function to drop expired entries, counting prefetches nobody asked for
+def expire_entries(cache):
+    now = time.time()
+    entries = cache["entries"]
+    for key in [key for key, entry in entries.items() if entry["status"] != "running" and now - entry["started_at"] > PREFETCH_TTL_SECONDS]:
+        prefetch_stats["wasted"] += 1
+        del entries[key]
+    while len(entries) > PREFETCH_CACHE_SIZE:
+        oldest = min((key for key, entry in entries.items() if entry["status"] != "running"), key=lambda k: entries[k]["started_at"], default=None)
+        if oldest is None:
+            break
+        prefetch_stats["wasted"] += 1
+        del entries[oldest]
+
+# Function to run one prefetch on a pooled connection; called on a background thread.
+# For an officer drill-down, the names that identify the officer are resolved first.
+def run_prefetch(pool, fetch, entry):
+    conn = None
+    error = None
+    try:
+        # Users waiting on OpenAI capacity go first
+        wait_for_background_turn()
+        conn = pool.acquire()
+        if entry["names_sql"]:
+            try:
+                names = fetch(conn, entry["names_sql"])
+                entry["names"] = {str(name).lower() for name in names.iloc[:, 0].dropna()}
+            except Exception:
+                pass
+            entry["resolved"].set()
+        entry["df"] = fetch(conn, entry["sql"])
+        entry["status"] = "done"
+        prefetch_stats["completed"] += 1
+    except Exception as e:
+        error = e
+        entry["status"] = "error"
+        entry["error"] = str(e)
+        prefetch_stats["failed"] += 1
+    finally:
+        entry["resolved"].set()
+        if conn is not None:
+            pool.release(conn, error)
+        _prefetch_slots.release()
+
+# Function to prefetch likely follow-ups into the session cache, within its budget.
+# fetch(conn, sql) returns a DataFrame; returns the SQL that was started.
+def start_prefetch(cache, pool, intent, df, fetch):
+    started = []
+    with cache["lock"]:
+        expire_entries(cache)
+        for prediction in predict_follow_ups(intent, df):
+            sql = prediction["sql"]
+            key = prefetch_key(prediction)
+            if key in cache["entries"]:
+                continue
+            officer_key = key[1]
+            names_sql = OFFICER_NAMES_SQL.format(officer_id=officer_key[3:]) if officer_key.startswith("id:") else None
+            cost = estimate_query_cost(sql) + (estimate_query_cost(names_sql) if names_sql else 0)
+            running = sum(entry["status"] == "running" for entry in cache["entries"].values())
+            if cache["spent"] + cost > PREFETCH_SESSION_BUDGET or running >= MAX_PREFETCH_PER_SESSION:
+                prefetch_stats["skipped_budget"] += 1
+                continue
+            if not _prefetch_slots.acquire(blocking=False):
+                prefetch_stats["skipped_busy"] += 1
+                continue
+            cache["spent"] += cost
+            entry = {
+                "sql": sql, "status": "running", "df": None, "error": None, "started_at": time.time(), "cost": cost,
+                "names_sql": names_sql, "names": set(), "resolved": threading.Event(),
+            }
+            cache["entries"][key] = entry
+            prefetch_stats["issued"] += 1
+            entry["thread"] = threading.Thread(target=run_prefetch, args=(pool, fetch, entry), daemon=True)
+            entry["thread"].start()
+            started.append(sql)
+    return started
+
+# Function to find the cache key answering a template query; an officer asked for by name matches
+# a drill-down prefetched by id once the prefetch has resolved the names that pick out that officer
+def find_prefetched(cache, intent, deadline):
+    base, officer_key = prefetch_key(intent)
+    with cache["lock"]:
+        candidates = [(key, entry) for key, entry in cache["entries"].items() if key[0] == base]
+    for key, entry in candidates:
+        if key[1] == officer_key:
+            return key
+    if officer_key.startswith("name:"):
+        for key, entry in candidates:
+            if entry["names_sql"] and entry["resolved"].wait(max(0.0, deadline - time.monotonic())):
+                if officer_key[5:] in entry["names"]:
+                    return key
+    return None
+
+# Function to answer a template query from the prefetch cache; waits a bounded time for a prefetch
+# still in flight. Returns None on a miss, and the caller runs the query itself.
+def take_prefetched(cache, intent, wait=PREFETCH_WAIT_SECONDS):
+    deadline = time.monotonic() + wait
+    key = find_prefetched(cache, intent, deadline)
+    with cache["lock"]:
+        entry = cache["entries"].pop(key, None) if key else None
+    if entry is None:
+        prefetch_stats["misses"] += 1
+        return None
+    if entry["status"] == "running":
+        entry["thread"].join(max(0.0, deadline - time.monotonic()))
+    if entry["status"] == "running":
+        # Left to finish on its own; its slot and pooled connection are released when it does
+        prefetch_stats["late"] += 1
+        prefetch_stats["misses"] += 1
+        return None
+    if entry["status"] != "done":
+        prefetch_stats["misses"] += 1
+        return None
+    prefetch_stats["hits"] += 1
+    # A prefetch that paid off does not count against the budget
+    with cache["lock"]:
+        cache["spent"] -= entry["cost"]
+    return entry["df"]
+
+# Function to summarise prefetch effectiveness for tuning the budget
+def prefetch_summary():
+    issued = prefetch_stats["issued"]
+    return {
+        "issued": issued,
+        "hits": prefetch_stats["hits"],
+        "hit_rate": prefetch_stats["hits"] / issued if issued else 0.0,
+        "wasted": prefetch_stats["wasted"],
+        "late": prefetch_stats["late"],
+        "skipped": prefetch_stats["skipped_budget"] + prefetch_stats["skipped_busy"],
+    }
@@ -0,0 +1,83 @@
+import pandas as pd
+
+# Snowflake cursor.description type codes
+FIXED, REAL, TEXT, DATE, TIMESTAMP, VARIANT, TIMESTAMP_LTZ, TIMESTAMP_TZ, TIMESTAMP_NTZ = range(9)
+BOOLEAN = 13
+TIMESTAMP_TYPES = {TIMESTAMP, TIMESTAMP_NTZ}
+ZONED_TIMESTAMP_TYPES = {TIMESTAMP_LTZ, TIMESTAMP_TZ}
+
+# Text columns become categorical when they repeat at least this much
+CATEGORY_MAX_RATIO = 0.5
+CATEGORY_MIN_ROWS = 20
+
+# Function to turn a NUMBER(p,0) column into int64, nullable when the column has nulls. Narrower
+# ints would overflow silently in later elementwise arithmetic (products, differences); values
+# beyond int64 fall back to float64
+def compact_int(column):
+    numeric = pd.to_numeric(column, errors="coerce")
+    if numeric.abs().max() >= 2 ** 63:
+        return numeric.astype("float64")
+    return numeric.astype("Int64") if numeric.isna().any() else numeric.astype("int64")
+
+# Function to turn repetitive text (STAGENAME, LOANTYPE__C, ...) into a categorical
+def compact_text(column):
+    if len(column) >= CATEGORY_MIN_ROWS and column.nunique(dropna=True) <= len(column) * CATEGORY_MAX_RATIO:
+        return column.astype("category")
+    return column
+
+# Function to convert one column using its Snowflake type, scale and precision
+def convert_column(column, description):
+    type_code = description[1]
+    scale = description[5] if len(description) > 5 else None
+    if type_code == FIXED:
+        if scale == 0:
+            return compact_int(column)
+        return pd.to_numeric(column, errors="coerce").astype("float64")
+    if type_code == REAL:
+        return pd.to_numeric(column, errors="coerce").astype("float64")
+    if type_code == TEXT:
+        return compact_text(column)
+    if type_code == DATE or type_code in TIMESTAMP_TYPES:
+        return pd.to_datetime(column, errors="coerce")
+    if type_code in ZONED_TIMESTAMP_TYPES:
+        return pd.to_datetime(column, errors="coerce", utc=True)
+    if type_code == BOOLEAN:
+        return column.astype("boolean") if column.isna().any() else column.astype("bool")
+    return column
+
+# Function to convert object columns when the description carries no Snowflake type (local results)
+def infer_column(column):
+    if column.dtype != object:
+        return column
+    numeric = pd.to_numeric(column, errors="coerce")
+    if numeric.notna().sum() == column.notna().sum() and column.notna().any():
+        return numeric
+    return compact_text(column)
+
+# Function to map a result to compact dtypes; reports memory before and after in df.attrs
+def normalize_frame(df, description):
+    before = int(df.memory_usage(deep=True).sum())
+    converted = []
+    # Columns are taken by position: join results can repeat a name
+    for i in range(len(df.columns)):
+        column = df.iloc[:, i]
+        desc = description[i] if description and i < len(description) else None
+        try:
+            if desc is not None and isinstance(desc[1], int):
+                converted.append(convert_column(column, desc))
+            else:
+                converted.append(infer_column(column))
+        except (TypeError, ValueError, OverflowError):
+            converted.append(column)
+    result = pd.concat(converted, axis=1, ignore_index=True) if converted else df.copy()
+    result.columns = df.columns
+    result.index = df.index
+    result.attrs["memory_before"] = before
+    result.attrs["memory_after"] = int(result.memory_usage(deep=True).sum())
+    return result
+
+# Function to describe the memory saving for display
+def memory_report(df):
+    if "memory_before" not in df.attrs:
+        return None
+    return f"Result memory: {df.attrs['memory_before'] / 1024:,.1f} KB → {df.attrs['memory_after'] / 1024:,.1f} KB"
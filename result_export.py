@@ -0,0 +1,161 @@
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from result_dtypes import FIXED, REAL, TEXT, DATE, BOOLEAN, TIMESTAMP_TYPES, ZONED_TIMESTAMP_TYPES
+
+EXPORT_DIR = os.environ.get("LOANBOT_EXPORT_DIR", os.path.join(tempfile.gettempdir(), "loanbot_exports"))
+# Finished exports are streamed from disk by the chat API's /exports endpoint, e.g.
+# LOANBOT_EXPORT_URL="https://loanbot.example.com:8600/exports"; unset, the app shows the server path instead
+EXPORT_URL = os.environ.get("LOANBOT_EXPORT_URL", "").rstrip("/")
+# Files left behind by sessions that ended without cleaning up (e.g. a restart) are deleted after this
+EXPORT_TTL_SECONDS = 24 * 60 * 60
+
+# Function to drop the trailing LIMIT so the export covers the full result
+def strip_limit(sql):
+    return re.sub(r"\s+LIMIT\s+\d+\s*;?\s*$", "", sql.strip(), flags=re.IGNORECASE)
+
+# Function to map a Snowflake column description to the Arrow type every batch is cast to
+def arrow_type(description):
+    type_code = description[1]
+    precision = description[4] if len(description) > 4 else None
+    scale = description[5] if len(description) > 5 else None
+    if type_code == FIXED:
+        return pa.int64() if scale == 0 and (precision or 0) <= 18 else pa.float64()
+    if type_code == REAL:
+        return pa.float64()
+    if type_code == DATE:
+        return pa.date32()
+    if type_code in TIMESTAMP_TYPES:
+        return pa.timestamp("us")
+    if type_code in ZONED_TIMESTAMP_TYPES:
+        return pa.timestamp("us", tz="UTC")
+    if type_code == BOOLEAN:
+        return pa.bool_()
+    return pa.string()
+
+# Function to build the export schema from the cursor description; batches can differ in
+# integer width and nullability, so each one is cast to this single schema
+def export_schema(description):
+    return pa.schema([pa.field(desc[0], arrow_type(desc), nullable=True) for desc in description])
+
+# Function to stream Arrow batches from a cursor into a Parquet or CSV file.
+# Only one batch is held in memory at a time, whatever the row count; an empty result
+# still gives a valid file with the result's columns.
+def write_batches(cursor, path, file_format, job):
+    schema = export_schema(cursor.description)
+    writer = pq.ParquetWriter(path, schema) if file_format == "parquet" else pa_csv.CSVWriter(path, schema)
+    try:
+        for batch in cursor.fetch_arrow_batches():
+            if job["cancel"].is_set():
+                break
+            if not batch.schema.equals(schema):
+                batch = pa.Table.from_arrays(
+                    [column.cast(field.type) for column, field in zip(batch.columns, schema)], schema=schema
+                )
+            writer.write_table(batch)
+            job["rows"] += batch.num_rows
+            job["bytes"] = os.path.getsize(path)
+    finally:
+        writer.close()
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# Function to run an export job; called on a background thread
+def run_export(conn, job):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(job["sql"])
+        job["query_id"] = cursor.sfqid
+        job["total_rows"] = cursor.rowcount
+        write_batches(cursor, job["path"], job["format"], job)
+        if job["cancel"].is_set():
+            job["status"] = "cancelled"
+            _remove_file(job["path"])
+        else:
+            job["status"] = "done"
+    except Exception as e:
+        job["status"] = "cancelled" if job["cancel"].is_set() else "error"
+        job["error"] = str(e)
+        _remove_file(job["path"])
+    finally:
+        job["finished_at"] = time.time()
+        cursor.close()
+
+# Function to delete export files older than the TTL
+def sweep_exports(ttl=EXPORT_TTL_SECONDS):
+    now = time.time()
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError:
+            pass
+
+# Function to start exporting the full result of a query in the background
+def start_export(conn, sql, file_format="parquet"):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    sweep_exports()
+    extension = "parquet" if file_format == "parquet" else "csv"
+    # The file name is the only credential for its download link, so it must not be guessable
+    fd, path = tempfile.mkstemp(prefix=secrets.token_urlsafe(24), suffix=f".{extension}", dir=EXPORT_DIR)
+    os.close(fd)
+    job = {
+        "sql": strip_limit(sql),
+        "format": file_format,
+        "path": path,
+        "status": "running",
+        "rows": 0,
+        "bytes": 0,
+        "total_rows": None,
+        "query_id": None,
+        "error": None,
+        "started_at": time.time(),
+        "finished_at": None,
+        "cancel": threading.Event(),
+    }
+    job["thread"] = threading.Thread(target=run_export, args=(conn, job), daemon=True)
+    job["thread"].start()
+    return job
+
+# Function to cancel a running export, including the query still running in Snowflake
+def cancel_export(conn, job):
+    job["cancel"].set()
+    if job["query_id"] and job["status"] == "running":
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT SYSTEM$CANCEL_QUERY('{job['query_id']}')")
+        except Exception:
+            pass
+        finally:
+            cursor.close()
+
+# Function to stop an export and delete its file; a running export deletes its own file once it sees the cancel
+def discard_export(job):
+    job["cancel"].set()
+    if job["status"] != "running":
+        _remove_file(job["path"])
+
+# Function to describe export progress for display
+def export_progress(job):
+    if job["total_rows"]:
+        return min(1.0, job["rows"] / job["total_rows"])
+    return 1.0 if job["status"] == "done" else 0.0
+
+# Function to build the download link of a finished export; None when no download endpoint is configured
+def export_url(job):
+    if not EXPORT_URL or job["status"] != "done":
+        return None
+    return f"{EXPORT_URL}/{os.path.basename(job['path'])}"
@@ -0,0 +1,109 @@
+import re
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from warehouse_router import referenced_tables
+
+# Number of recent result frames kept queryable per session
+RESULT_HISTORY = 3
+
+# Phrasings that refer back to the previous answer: a leading "only show those" / "sort by" style refinement,
+# "of those" / "the ones" anywhere, or an explicit mention of a stored result. Bare "that" or "above"
+# inside a question is not enough.
+FOLLOW_UP_PATTERN = re.compile(
+    r"^\s*(?:(?:and |so )?(?:now|then),? )?(?:"
+    r"(?:(?:only|just) )?(?:show|keep|list|give me|return)(?: me)?(?: only| just)? (?:the ones|those|these|them)\b"
+    r"|(?:sort|order|filter|group|narrow|limit|rank|break|split) "
+    r"(?:by|to|down|on|it|that|those|these|them|the results?|the (?:above|previous|last) results?)\b)"
+    r"|\b(?:of|from|among|within) (?:those|these|them|the ones|that result|the (?:above|previous|last) results?)\b"
+    r"|\b(?:only|just) (?:the ones|those|these)\b"
+    r"|\b(?:last_result|result_[0-9]+|(?:the )?(?:above|previous|last) (?:results?|table|answer)|(?:that|this) result)\b",
+    re.IGNORECASE,
+)
+
+# Regression cases for FOLLOW_UP_PATTERN: (question, whether it refines the previous result)
+FOLLOW_UP_EXAMPLES = [
+    ("now only show the ones over $500k", True),
+    ("only show those over 500k", True),
+    ("sort that by close date", True),
+    ("now sort by amount", True),
+    ("filter to closed won", True),
+    ("which of those closed last year", True),
+    ("group them by loan type", True),
+    ("how many of them are FHA loans", True),
+    ("break down the previous result by month", True),
+    ("top 10 loan officers by closed volume this year", False),
+    ("show the pipeline by stage", False),
+    ("rank officers by number of loans closed", False),
+    ("what happened to that loan for John Smith", False),
+    ("list opportunities above $1M", False),
+]
+
+FOLLOW_UP_PROMPT = """You are LoanBot, a SQL expert helping users refine results they already have.
+Answer with a single ```sql code block that queries only the local tables listed below, using DuckDB SQL.
+Text where clauses must be fuzzy matches, e.g. ILIKE '%keyword%'."""
+
+# Function to name the stored results: newest is last_result, then result_2, result_3, ...
+def result_name(index):
+    return "last_result" if index == 0 else f"result_{index + 1}"
+
+# Function to keep a fetched result as a local table for follow-up questions
+def remember_result(store, df, sql):
+    if df.empty:
+        return
+    store.insert(0, {"df": df, "sql": sql})
+    del store[RESULT_HISTORY:]
+
+# Function to describe the stored results for the model
+def describe_results(store):
+    if duckdb is None or not store:
+        return None
+    lines = [
+        "Results already fetched in this conversation are available as local tables. "
+        "For follow-ups that only filter, sort, group or re-aggregate these rows, query them "
+        "directly (e.g. SELECT ... FROM last_result) instead of FirstDB.PUBLIC tables; "
+        "such queries run locally in DuckDB SQL:"
+    ]
+    for i, entry in enumerate(store):
+        df = entry["df"]
+        lines.append(f"{result_name(i)} ({len(df)} rows): " + ", ".join(df.columns))
+    return "\n".join(lines)
+
+# Function to check whether a question refines the previous result
+def looks_like_follow_up(prompt, store):
+    return duckdb is not None and bool(store) and bool(FOLLOW_UP_PATTERN.search(prompt))
+
+# Function to list the FOLLOW_UP_EXAMPLES questions the pattern classifies wrongly
+def follow_up_misses(examples=FOLLOW_UP_EXAMPLES):
+    return [question for question, expected in examples if bool(FOLLOW_UP_PATTERN.search(question)) != expected]
+
+# Function to build the system messages for a turn; follow-ups skip the large schema prompt
+def system_messages(system_prompt, prompt, store):
+    results = describe_results(store)
+    if results is None:
+        return [{"role": "system", "content": system_prompt}]
+    if looks_like_follow_up(prompt, store):
+        return [{"role": "system", "content": f"{FOLLOW_UP_PROMPT}\n\n{results}"}]
+    return [{"role": "system", "content": system_prompt}, {"role": "system", "content": results}]
+
+# Function to check whether a query reads only from stored results
+def uses_result_tables(sql, store):
+    if duckdb is None or not store:
+        return False
+    tables = referenced_tables(sql)
+    names = {result_name(i).upper() for i in range(len(store))}
+    return bool(tables) and tables <= names
+
+# Function to run a follow-up query in-process over the stored results; returns the rows and description
+def query_results(store, sql):
+    con = duckdb.connect()
+    try:
+        for i, entry in enumerate(store):
+            con.register(result_name(i), entry["df"])
+        cursor = con.execute(sql)
+        return cursor.fetchall(), cursor.description
+    finally:
+        con.close()
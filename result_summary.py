@@ -0,0 +1,64 @@
+import numbers
+
+import pandas as pd
+
+# Bounds that keep the digest the same size whatever the result size
+MAX_PREVIEW_ROWS = 5
+MAX_COLUMNS = 20
+TOP_K = 3
+MAX_VALUE_CHARS = 40
+
+def short(value):
+    text = str(value)
+    return text if len(text) <= MAX_VALUE_CHARS else text[:MAX_VALUE_CHARS - 1] + "…"
+
+# Function to treat object columns holding Decimals or other numbers as numeric
+def as_numeric(column):
+    if pd.api.types.is_bool_dtype(column):
+        return None
+    if pd.api.types.is_numeric_dtype(column):
+        return column
+    sample = column.dropna().head(20)
+    if len(sample) and all(isinstance(v, numbers.Number) and not isinstance(v, bool) for v in sample):
+        return pd.to_numeric(column, errors="coerce")
+    return None
+
+# Function to make VARIANT/ARRAY values (lists, dicts) countable
+def hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return str(value)
+
+# Function to describe a single column in one line
+def describe_column(name, column):
+    nulls = int(column.isna().sum())
+    numeric = as_numeric(column)
+    if numeric is not None:
+        stats = f"min {numeric.min():,.2f}, max {numeric.max():,.2f}, mean {numeric.mean():,.2f}"
+    elif pd.api.types.is_datetime64_any_dtype(column):
+        stats = f"from {column.min()} to {column.max()}"
+    else:
+        if column.dtype == object:
+            column = column.map(hashable)
+        counts = column.value_counts(dropna=True).head(TOP_K)
+        stats = f"{column.nunique(dropna=True):,} distinct; top: " + ", ".join(
+            f"{short(value)} ({count:,})" for value, count in counts.items()
+        )
+    null_text = f", {nulls:,} nulls" if nulls else ""
+    return f"- {name}: {stats}{null_text}"
+
+# Function to build a bounded-size digest of a result for the chat text and history
+def summarize_result(df):
+    lines = [f"{len(df):,} rows × {len(df.columns)} columns."]
+    # Columns are taken by position: join results can repeat a name
+    for i, name in enumerate(df.columns[:MAX_COLUMNS]):
+        lines.append(describe_column(name, df.iloc[:, i]))
+    if len(df.columns) > MAX_COLUMNS:
+        lines.append(f"- … {len(df.columns) - MAX_COLUMNS} more columns")
+    preview = df.iloc[:MAX_PREVIEW_ROWS, :MAX_COLUMNS].map(short)
+    lines.append("")
+    lines.append(f"First {len(preview)} rows:")
+    lines.append(preview.to_string(index=False))
+    return "\n".join(lines)
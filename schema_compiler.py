@@ -0,0 +1,197 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Short codes for Snowflake types; the legend is emitted once at the top of the context
+TYPE_CODES = [
+    (r"^(VARCHAR|TEXT|STRING|CHAR)", "s"),
+    (r"^NUMBER\(\d+,0\)", "i"),
+    (r"^(NUMBER|DECIMAL|NUMERIC)", "n"),
+    (r"^(FLOAT|DOUBLE|REAL)", "f"),
+    (r"^BOOLEAN", "b"),
+    (r"^DATE$", "d"),
+    (r"^TIMESTAMP", "ts"),
+    (r"^TIME", "t"),
+    (r"^(VARIANT|OBJECT|ARRAY)", "v"),
+]
+TYPE_LEGEND = "s=text i=int n=decimal f=float b=bool d=date ts=timestamp t=time v=variant"
+
+# Salesforce system columns that repeat in every table
+SYSTEM_COLUMNS = [
+    "ID", "ISDELETED", "CREATEDDATE", "CREATEDBYID", "LASTMODIFIEDDATE", "LASTMODIFIEDBYID",
+    "SYSTEMMODSTAMP", "LASTACTIVITYDATE", "LASTVIEWEDDATE", "LASTREFERENCEDDATE", "OWNERID",
+]
+
+# Columns that are always kept, whatever the usage stats say
+ALWAYS_KEEP = {"ID", "NAME", "AMOUNT", "STAGENAME", "CLOSEDATE", "CREATEDDATE", "OWNERID", "LOANTYPE__C", "TYPE"}
+
+# Usage stats are only trusted for pruning once this many queries have been seen
+MIN_QUERIES_FOR_PRUNING = 50
+# Every this many queries all counts are halved, so columns that stopped being used can be pruned again
+USAGE_DECAY_QUERIES = 500
+
+# Usage is counted in memory and written out in batches
+USAGE_FLUSH_QUERIES = 20
+USAGE_FLUSH_SECONDS = 60
+
+# Polymorphic Salesforce references and where they usually point
+POLYMORPHIC_FKS = {"WHOID": ["CONTACT", "LEAD"], "WHATID": ["OPPORTUNITY", "ACCOUNT"]}
+
+COLUMN_USAGE_PATH = os.environ.get("LOANBOT_COLUMN_USAGE", "column_usage.json")
+_usage_lock = threading.Lock()
+_pending_usage = {"queries": 0, "columns": Counter(), "since": time.time()}
+
+# Function to map a Snowflake type string to its short code
+def type_code(snowflake_type):
+    upper = snowflake_type.upper().replace(" ", "")
+    for pattern, code in TYPE_CODES:
+        if re.match(pattern, upper):
+            return code
+    return upper.lower()
+
+# Function to count prompt tokens, falling back to a rough estimate without tiktoken
+def count_tokens(text, model="gpt-3.5-turbo"):
+    if tiktoken is not None:
+        return len(tiktoken.encoding_for_model(model).encode(text))
+    return len(text) // 4
+
+# Function to load per-column usage counts
+def load_column_usage(path=COLUMN_USAGE_PATH):
+    if not os.path.exists(path):
+        return {"queries": 0, "columns": {}}
+    with open(path) as f:
+        return json.load(f)
+
+# Function to merge the pending counts into the usage file, halving old counts every USAGE_DECAY_QUERIES queries
+def flush_column_usage(path=COLUMN_USAGE_PATH):
+    with _usage_lock:
+        if not _pending_usage["queries"]:
+            return
+        usage = load_column_usage(path)
+        before = usage["queries"]
+        usage["queries"] += _pending_usage["queries"]
+        if usage["queries"] // USAGE_DECAY_QUERIES > before // USAGE_DECAY_QUERIES:
+            usage["columns"] = {key: count / 2 for key, count in usage["columns"].items() if count >= 1}
+        for key, count in _pending_usage["columns"].items():
+            usage["columns"][key] = usage["columns"].get(key, 0) + count
+        with open(path, "w") as f:
+            json.dump(usage, f)
+        _pending_usage.update(queries=0, columns=Counter(), since=time.time())
+
+atexit.register(flush_column_usage)
+
+# Function to count which schema columns a successful query referenced
+def record_column_usage(sql, schema, path=COLUMN_USAGE_PATH):
+    words = set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", sql.upper()))
+    with _usage_lock:
+        _pending_usage["queries"] += 1
+        for table, columns in schema.items():
+            if table.upper() not in words:
+                continue
+            for name, _ in columns:
+                if name.upper() in words:
+                    _pending_usage["columns"][f"{table.upper()}.{name.upper()}"] += 1
+        due = (
+            _pending_usage["queries"] >= USAGE_FLUSH_QUERIES
+            or time.time() - _pending_usage["since"] >= USAGE_FLUSH_SECONDS
+        )
+    if due:
+        flush_column_usage(path)
+
+# Function to tell whether a column is a key that joins and filters depend on
+def is_key_column(name):
+    return bool(re.search(r"ID(__C)?$", name.upper()))
+
+# Function to guess the table a reference column points to
+def fk_target(column, table_names):
+    name = column.upper()
+    if name in POLYMORPHIC_FKS:
+        return [t for t in POLYMORPHIC_FKS[name] if t in table_names]
+    base = re.sub(r"(__C)?$", "", name)
+    if not base.endswith("ID") or base in ("ID", "CREATEDBYID", "LASTMODIFIEDBYID", "OWNERID"):
+        return []
+    base = base[:-2].rstrip("_")
+    for candidate in (base, f"{base}__C"):
+        if candidate in table_names:
+            return [candidate]
+    return []
+
+# Function to render the original, verbose table context (kept for token comparisons)
+def verbose_schema(schema):
+    return "\n\n".join(
+        f"Table: {table}\nColumns: " + ", ".join(f"{col[0]} ({col[1]})" for col in columns)
+        for table, columns in schema.items()
+    )
+
+# Function to compile a {table: [(column, type), ...]} schema into a token-minimal context
+def compile_schema(schema, usage=None):
+    table_names = {table.upper() for table in schema}
+    prune = usage is not None and usage.get("queries", 0) >= MIN_QUERIES_FOR_PRUNING
+    used = usage["columns"] if prune else {}
+
+    # Factor out system columns shared by at least half the tables
+    system_types, system_counts = {}, {}
+    for columns in schema.values():
+        for name, col_type in columns:
+            if name.upper() in SYSTEM_COLUMNS:
+                system_types.setdefault(name.upper(), type_code(col_type))
+                system_counts[name.upper()] = system_counts.get(name.upper(), 0) + 1
+    system_types = {name: code for name, code in system_types.items() if system_counts[name] * 2 >= len(schema)}
+
+    lines = [f"Types: {TYPE_LEGEND}"]
+    if system_types:
+        common = ", ".join(f"{name} {system_types[name]}" for name in SYSTEM_COLUMNS if name in system_types)
+        lines.append(f"Every table also has: {common} (unless listed as -COL)")
+
+    fk_hints = []
+    omitted = 0
+    for table, columns in schema.items():
+        names = {name.upper() for name, _ in columns}
+        parts = []
+        other = []
+        for name, col_type in columns:
+            upper = name.upper()
+            if upper in system_types:
+                continue
+            targets = fk_target(upper, table_names)
+            for target in targets:
+                fk_hints.append(f"{table}.{upper}->{target}.ID")
+            # Unused columns keep only their name, so the prompt stays the same between runs and
+            # every column can still be queried (and so earn its type back through the usage stats)
+            if (
+                prune and upper not in ALWAYS_KEEP and not is_key_column(upper)
+                and not used.get(f"{table.upper()}.{upper}")
+            ):
+                other.append(upper)
+                continue
+            parts.append(f"{upper} {type_code(col_type)}")
+        parts.extend(f"-{name}" for name in system_types if name not in names)
+        line = f"{table}: " + ", ".join(parts)
+        if other:
+            line += "; other: " + ", ".join(other)
+            omitted += len(other)
+        lines.append(line)
+
+    if fk_hints:
+        lines.append("FK: " + "; ".join(fk_hints))
+    if omitted:
+        lines.append("(columns after \"other:\" are rarely used; they are valid, their types are omitted)")
+    return "\n".join(lines)
+
+# Function to build the compact table context and report the token saving
+def build_table_context(schema, usage=None):
+    compact = compile_schema(schema, usage)
+    stats = {
+        "tokens_before": count_tokens(verbose_schema(schema)),
+        "tokens_after": count_tokens(compact),
+    }
+    return compact, stats
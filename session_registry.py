@@ -0,0 +1,169 @@
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from result_export import discard_export
+
+# Sessions idle for longer than this are evicted
+SESSION_TTL_SECONDS = 30 * 60
+REAP_INTERVAL_SECONDS = 60
+# Evicted entries are kept this long so a returning user is told why; later returns see the marker in their state
+EVICTED_GRACE_SECONDS = SESSION_TTL_SECONDS
+EVICTED_MARKER = "loanbot_evicted"
+
+# The per-session admin view lists every session in the process, so it is off unless LOANBOT_ADMIN_VIEW=1
+ADMIN_VIEW_ENABLED = os.environ.get("LOANBOT_ADMIN_VIEW", "") == "1"
+
+# Process-wide registry of live sessions, keyed by Streamlit session id
+sessions = {}
+_registry_lock = threading.Lock()
+_reaper_thread = None
+
+# Function to register a session or mark it as active
+def touch_session(session_id, session_state):
+    with _registry_lock:
+        entry = sessions.setdefault(session_id, {"created_at": time.time(), "evicted": False})
+        entry["state"] = session_state
+        entry["last_active"] = time.time()
+        return entry
+
+# Function to check whether the reaper already closed this session's resources
+def is_evicted(session_id, session_state=None):
+    with _registry_lock:
+        entry = sessions.get(session_id)
+        if entry and entry["evicted"]:
+            return True
+    return session_state is not None and bool(state_get(session_state, EVICTED_MARKER))
+
+# Function to read a key from a session state object, which may be used off the script thread
+def state_get(session_state, key, default=None):
+    try:
+        return session_state[key] if key in session_state else default
+    except Exception:
+        return default
+
+# Function to estimate the memory held by a single value
+def value_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, "to_plotly_json"):
+        return len(str(value.to_plotly_json()))
+    return sys.getsizeof(value)
+
+# Function to estimate the memory held by a session's messages, frames and figures
+def session_footprint(session_state):
+    messages = state_get(session_state, "messages") or []
+    message_bytes = sum(sys.getsizeof(m.get("content", "")) for m in messages)
+    frame_bytes = sum(value_size(m["results"]) for m in messages if "results" in m)
+    frame_bytes += sum(value_size(block["df"]) for m in messages for block in m.get("blocks", []) if block["df"] is not None)
+    frame_bytes += sum(value_size(entry["df"]) for entry in state_get(session_state, "result_store") or [])
+    # API sessions also keep their recent results downloadable
+    frame_bytes += sum(value_size(df) for df in (state_get(session_state, "results") or {}).values())
+    figure_bytes = sum(value_size(m["chart"]) for m in messages if "chart" in m)
+    return {
+        "messages": len(messages),
+        "message_bytes": message_bytes,
+        "frame_bytes": frame_bytes,
+        "figure_bytes": figure_bytes,
+    }
+
+# Function to cancel outstanding queries and close a session's connections
+def release_session(session_state):
+    conn = state_get(session_state, "snowflake_conn")
+    if conn is not None:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT SYSTEM$CANCEL_ALL_QUERIES(CURRENT_SESSION())")
+            cursor.close()
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+    pool = state_get(session_state, "sql_pool")
+    if pool is not None:
+        pool.close()
+    client = state_get(session_state, "openai_client")
+    if client is not None:
+        try:
+            client.close()
+        except Exception:
+            pass
+    # Export files are only reachable through this session, so they go with it
+    for job in state_get(session_state, "exports") or []:
+        discard_export(job)
+
+# Function to evict every session that has been idle past the TTL, and forget evictions past the grace period
+def reap_idle_sessions(ttl=SESSION_TTL_SECONDS, grace=EVICTED_GRACE_SECONDS):
+    now = time.time()
+    with _registry_lock:
+        for session_id in [
+            session_id for session_id, entry in sessions.items()
+            if entry["evicted"] and now - entry["evicted_at"] > grace
+        ]:
+            del sessions[session_id]
+        idle = [
+            (session_id, entry) for session_id, entry in sessions.items()
+            if not entry["evicted"] and now - entry["last_active"] > ttl
+        ]
+        for _, entry in idle:
+            entry["evicted"] = True
+            entry["evicted_at"] = now
+    for _, entry in idle:
+        release_session(entry["state"])
+        # Drop the heavy state; the rest is cleared when its user comes back
+        for key in (
+            "snowflake_conn", "sql_pool", "openai_client", "messages", "result_store", "results", "prefetch", "exports",
+        ):
+            try:
+                del entry["state"][key]
+            except Exception:
+                pass
+        try:
+            entry["state"][EVICTED_MARKER] = True
+        except Exception:
+            pass
+        entry["state"] = {}
+    return [session_id for session_id, _ in idle]
+
+# Function to forget a session that disconnected or was cleared after eviction
+def remove_session(session_id):
+    with _registry_lock:
+        sessions.pop(session_id, None)
+
+def _reaper_loop():
+    while True:
+        time.sleep(REAP_INTERVAL_SECONDS)
+        reap_idle_sessions()
+
+# Function to start the background reaper once per process
+def start_reaper():
+    global _reaper_thread
+    with _registry_lock:
+        if _reaper_thread is None:
+            _reaper_thread = threading.Thread(target=_reaper_loop, daemon=True)
+            _reaper_thread.start()
+
+# Function to summarise per-session usage for the admin view
+def session_usage():
+    now = time.time()
+    with _registry_lock:
+        entries = list(sessions.items())
+    rows = []
+    for session_id, entry in entries:
+        footprint = session_footprint(entry["state"])
+        rows.append({
+            "Session": session_id[:8],
+            "Connected": state_get(entry["state"], "snowflake_conn") is not None,
+            "Idle (s)": int(now - entry["last_active"]),
+            "Messages": footprint["messages"],
+            "Message KB": footprint["message_bytes"] / 1024,
+            "Frames KB": footprint["frame_bytes"] / 1024,
+            "Figures KB": footprint["figure_bytes"] / 1024,
+            "Evicted": entry["evicted"],
+        })
+    return rows
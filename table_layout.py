@@ -0,0 +1,175 @@
+import re
+import threading
+import time
+
+from warehouse_router import METRICS_HISTORY, referenced_tables, collected_metrics
+from schema_compiler import type_code
+
+# Tables at least this big get cost hints and pruning checks
+LARGE_TABLE_ROWS = 1_000_000
+LARGE_TABLE_BYTES = 1024 ** 3
+
+# Date columns tried, in order, when a table is not clustered on a date
+DATE_COLUMNS = ["CLOSEDATE", "CREATEDDATE", "ACTIVITYDATE", "LASTMODIFIEDDATE"]
+
+# Layout is re-read after this long; row counts and date ranges drift slowly
+LAYOUT_TTL_SECONDS = 6 * 60 * 60
+
+# Bytes scanned by generated queries, shared by every session in the process
+scan_stats = {"queries": 0, "measured": 0, "bytes_scanned": 0, "unpruned": 0}
+# Query ids whose bytes scanned are still being looked up
+_pending_scans = []
+_layout = {"tables": {}, "loaded_at": 0}
+_layout_lock = threading.Lock()
+
+# Function to split a Snowflake CLUSTERING_KEY such as "LINEAR(CLOSEDATE, OWNERID)" into columns
+def clustering_columns(clustering_key):
+    if not clustering_key:
+        return []
+    inner = re.sub(r"^\s*LINEAR\s*\((.*)\)\s*$", r"\1", clustering_key, flags=re.IGNORECASE)
+    return [part.strip().strip('"').upper() for part in inner.split(",") if part.strip()]
+
+def is_large(info):
+    return info["rows"] >= LARGE_TABLE_ROWS or info["bytes"] >= LARGE_TABLE_BYTES
+
+# Function to pick the date column a table should be filtered on
+def pick_date_column(columns, cluster_by):
+    date_columns = {name.upper() for name, col_type in columns if type_code(col_type) in ("d", "ts")}
+    for name in cluster_by + DATE_COLUMNS:
+        if name in date_columns:
+            return name
+    return None
+
+# Function to read row counts, sizes, clustering keys and date ranges for the schema's tables
+def fetch_table_layout(conn, schema):
+    columns_by_table = {table.upper(): columns for table, columns in schema.items()}
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT TABLE_NAME, ROW_COUNT, BYTES, CLUSTERING_KEY FROM FIRSTDB.INFORMATION_SCHEMA.TABLES "
+            "WHERE TABLE_SCHEMA = 'PUBLIC'"
+        )
+        rows = cursor.fetchall()
+        layout = {}
+        for name, row_count, size, clustering_key in rows:
+            if name.upper() not in columns_by_table:
+                continue
+            cluster_by = clustering_columns(clustering_key)
+            layout[name.upper()] = {
+                "rows": row_count or 0,
+                "bytes": size or 0,
+                "cluster_by": cluster_by,
+                "date_column": pick_date_column(columns_by_table[name.upper()], cluster_by),
+                "date_range": None,
+            }
+        # MIN/MAX come from micro-partition metadata, so this stays cheap on large tables
+        for table, info in layout.items():
+            if is_large(info) and info["date_column"]:
+                cursor.execute(f"SELECT MIN({info['date_column']}), MAX({info['date_column']}) FROM {table}")
+                low, high = cursor.fetchone()
+                if low is not None:
+                    info["date_range"] = (str(low)[:10], str(high)[:10])
+    finally:
+        cursor.close()
+    return layout
+
+# Function to return the cached layout, reloading it once it is older than the TTL
+def load_table_layout(conn, schema, ttl=LAYOUT_TTL_SECONDS):
+    with _layout_lock:
+        if _layout["tables"] and time.time() - _layout["loaded_at"] < ttl:
+            return _layout["tables"]
+    tables = fetch_table_layout(conn, schema)
+    with _layout_lock:
+        _layout["tables"], _layout["loaded_at"] = tables, time.time()
+    return tables
+
+# Function to return the last loaded layout without touching Snowflake
+def current_layout():
+    with _layout_lock:
+        return _layout["tables"]
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+def format_rows(rows):
+    if rows >= 1_000_000:
+        return f"{rows / 1_000_000:.1f}M"
+    if rows >= 1_000:
+        return f"{rows / 1_000:.0f}K"
+    return str(rows)
+
+# Function to render short cost hints for the large tables
+def layout_hints(layout):
+    lines = []
+    for table, info in sorted(layout.items(), key=lambda item: -item[1]["bytes"]):
+        if not is_large(info):
+            continue
+        parts = [f"{table}: ~{format_rows(info['rows'])} rows, {format_size(info['bytes'])}"]
+        if info["cluster_by"]:
+            parts.append("clustered by " + ", ".join(info["cluster_by"]))
+        if info["date_range"]:
+            parts.append(f"{info['date_column']} {info['date_range'][0]}..{info['date_range'][1]}")
+        lines.append("; ".join(parts))
+    if not lines:
+        return ""
+    return "\n".join([
+        "Cost hints (large tables; filter on the clustering or date column whenever the question implies a period, "
+        "and prefer = or IN over ILIKE on clustering columns):",
+        *lines,
+    ])
+
+# Function to list large tables a query reads without a predicate Snowflake can prune on
+def unpruned_scans(sql, layout=None):
+    if layout is None:
+        layout = current_layout()
+    where = re.search(r"\bWHERE\b(.*)", sql, re.IGNORECASE | re.DOTALL)
+    predicates = where.group(1).upper() if where else ""
+    warnings = []
+    for table in sorted(referenced_tables(sql)):
+        info = layout.get(table)
+        if info is None or not is_large(info):
+            continue
+        prune_columns = list(dict.fromkeys(info["cluster_by"] + ([info["date_column"]] if info["date_column"] else [])))
+        if not prune_columns:
+            continue
+        if not any(re.search(rf"\b{re.escape(col)}\b\s*(?:=|<|>|\bBETWEEN\b|\bIN\b)", predicates) for col in prune_columns):
+            warnings.append(f"{table} (~{format_rows(info['rows'])} rows) is scanned without a filter on {' or '.join(prune_columns)}")
+    return warnings
+
+# Function to record a generated query; its bytes scanned are added once Snowflake reports them
+def record_scan(sql, query_id):
+    unpruned = bool(unpruned_scans(sql))
+    with _layout_lock:
+        scan_stats["queries"] += 1
+        scan_stats["unpruned"] += unpruned
+        if query_id:
+            _pending_scans.append(query_id)
+            del _pending_scans[:-METRICS_HISTORY]
+
+# Function to add the bytes scanned of queries whose metrics have arrived
+def collect_scans():
+    with _layout_lock:
+        metrics = collected_metrics(_pending_scans)
+        for query_id, query in metrics.items():
+            if query is not None:
+                scan_stats["measured"] += 1
+                scan_stats["bytes_scanned"] += query[1]
+        _pending_scans[:] = [query_id for query_id in _pending_scans if query_id not in metrics]
+
+# Function to summarise bytes scanned per generated query for display
+def scan_summary():
+    collect_scans()
+    with _layout_lock:
+        if not scan_stats["queries"]:
+            return None
+        avg_bytes = scan_stats["bytes_scanned"] / scan_stats["measured"] if scan_stats["measured"] else 0
+        return {
+            "queries": scan_stats["queries"],
+            "avg_bytes": avg_bytes,
+            "avg_size": format_size(avg_bytes),
+            "unpruned_share": scan_stats["unpruned"] / scan_stats["queries"],
+        }
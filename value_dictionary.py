@@ -0,0 +1,202 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from warehouse_router import referenced_tables, table_aliases
+
+# Text columns with at most this many distinct values get a complete value list
+MAX_DISTINCT_VALUES = 50
+# Values per column shown in the prompt
+PROMPT_MAX_VALUES = 15
+
+VALUE_DICTIONARY_PATH = os.environ.get("LOANBOT_VALUE_DICTIONARY", "value_dictionary.json")
+REFRESH_INTERVAL_SECONDS = 6 * 60 * 60
+# Past this age a value list may miss new values, so fuzzy predicates are left alone
+MAX_REWRITE_AGE_SECONDS = 2 * REFRESH_INTERVAL_SECONDS
+# Rows modified after a refresh can hold values the list lacks, so rewrites keep the fuzzy match for them.
+# The margin covers timestamp time zones and the lag of the Salesforce sync that loads the rows.
+MODIFIED_COLUMN = "LASTMODIFIEDDATE"
+MODIFIED_MARGIN_SECONDS = 24 * 60 * 60
+
+rewrite_stats = Counter()
+_dictionary = {"refreshed_at": 0, "columns": {}, "modified_tables": [], "mtime": None}
+_dictionary_lock = threading.Lock()
+_sync_thread = None
+
+ILIKE_PATTERN = re.compile(
+    r"((?:[A-Za-z_][A-Za-z0-9_]*\.)?\"?([A-Za-z_][A-Za-z0-9_]*)\"?)\s+ILIKE\s+'((?:[^']|'')*)'(?!\s*ESCAPE)",
+    re.IGNORECASE,
+)
+
+# Function to list candidate text columns per table; IDs are never low-cardinality
+def text_columns(conn, tables):
+    cursor = conn.cursor()
+    try:
+        names = ", ".join(f"'{table.upper()}'" for table in tables)
+        cursor.execute(
+            "SELECT TABLE_NAME, COLUMN_NAME FROM FIRSTDB.INFORMATION_SCHEMA.COLUMNS "
+            f"WHERE TABLE_SCHEMA = 'PUBLIC' AND DATA_TYPE = 'TEXT' AND TABLE_NAME IN ({names})"
+        )
+        columns = {}
+        for table, column in cursor.fetchall():
+            if not re.search(r"ID(__C)?$", column.upper()):
+                columns.setdefault(table.upper(), []).append(column)
+        return columns
+    finally:
+        cursor.close()
+
+# Function to list the tables that carry a last-modified timestamp
+def modified_tables(conn, tables):
+    cursor = conn.cursor()
+    try:
+        names = ", ".join(f"'{table.upper()}'" for table in tables)
+        cursor.execute(
+            "SELECT TABLE_NAME FROM FIRSTDB.INFORMATION_SCHEMA.COLUMNS "
+            f"WHERE TABLE_SCHEMA = 'PUBLIC' AND COLUMN_NAME = '{MODIFIED_COLUMN}' AND TABLE_NAME IN ({names})"
+        )
+        return sorted(table.upper() for (table,) in cursor.fetchall())
+    finally:
+        cursor.close()
+
+# Function to read the complete value lists of a table's low-cardinality text columns
+def table_values(conn, table, columns):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT " + ", ".join(f'APPROX_COUNT_DISTINCT("{column}")' for column in columns) + f" FROM {table}"
+        )
+        estimates = cursor.fetchone()
+        values = {}
+        for column, estimate in zip(columns, estimates):
+            if not estimate or estimate > MAX_DISTINCT_VALUES:
+                continue
+            cursor.execute(
+                f'SELECT "{column}", COUNT(*) FROM {table} WHERE "{column}" IS NOT NULL '
+                f"GROUP BY 1 ORDER BY 2 DESC LIMIT {MAX_DISTINCT_VALUES + 1}"
+            )
+            rows = cursor.fetchall()
+            # The estimate can undercount; only complete lists are kept
+            if len(rows) <= MAX_DISTINCT_VALUES:
+                values[f"{table}.{column.upper()}"] = [row[0] for row in rows]
+        return values
+    finally:
+        cursor.close()
+
+# Function to rebuild the value dictionary for the given tables and save it
+def refresh_value_dictionary(conn, tables, path=VALUE_DICTIONARY_PATH):
+    # Taken before the scans: any value the lists miss was written after this
+    refreshed_at = time.time()
+    columns = {}
+    for table, names in text_columns(conn, tables).items():
+        try:
+            columns.update(table_values(conn, table, names))
+        except Exception:
+            continue
+    dictionary = {"refreshed_at": refreshed_at, "columns": columns, "modified_tables": modified_tables(conn, tables)}
+    with _dictionary_lock:
+        with open(path, "w") as f:
+            json.dump(dictionary, f)
+        _dictionary.update(dictionary, mtime=os.path.getmtime(path))
+    return dictionary
+
+# Function to load the saved dictionary, re-reading the file when it has changed
+def load_value_dictionary(path=VALUE_DICTIONARY_PATH):
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    with _dictionary_lock:
+        if mtime is not None and mtime != _dictionary["mtime"]:
+            with open(path) as f:
+                _dictionary.update(json.load(f), mtime=mtime)
+        return {
+            "refreshed_at": _dictionary["refreshed_at"],
+            "columns": _dictionary["columns"],
+            "modified_tables": _dictionary.get("modified_tables", []),
+        }
+
+def _sync_loop(conn_factory, tables):
+    conn = None
+    while True:
+        try:
+            conn = conn or conn_factory()
+            refresh_value_dictionary(conn, tables)
+        except Exception:
+            conn = None
+        time.sleep(REFRESH_INTERVAL_SECONDS)
+
+# Function to start refreshing the dictionary once per process, on its own Snowflake connection
+def start_value_sync(conn_factory, tables):
+    global _sync_thread
+    with _dictionary_lock:
+        if _sync_thread is None:
+            _sync_thread = threading.Thread(target=_sync_loop, args=(conn_factory, tables), daemon=True)
+            _sync_thread.start()
+
+def sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+# Function to render the known values for the prompt, at most PROMPT_MAX_VALUES per column
+def value_hints(dictionary):
+    lines = []
+    for key, values in sorted(dictionary["columns"].items()):
+        shown = ", ".join(sql_literal(value) for value in values[:PROMPT_MAX_VALUES])
+        more = f" (+{len(values) - PROMPT_MAX_VALUES} more)" if len(values) > PROMPT_MAX_VALUES else ""
+        lines.append(f"{key}: {shown}{more}")
+    if not lines:
+        return ""
+    return "Known values (filter these columns with = or IN on the exact values, not ILIKE):\n" + "\n".join(lines)
+
+# Function to translate an ILIKE pattern into a case-insensitive regex
+def ilike_regex(pattern):
+    parts = []
+    for char in pattern.replace("''", "'"):
+        parts.append(".*" if char == "%" else "." if char == "_" else re.escape(char))
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+# Function to replace fuzzy ILIKE filters on columns with a complete, recent value list by = or IN.
+# Values written since the refresh are not in the list, so the fuzzy match is kept for rows modified
+# since the refresh, which Snowflake can prune on; the predicate selects exactly the same rows as the
+# original. Tables without a last-modified column keep their ILIKE.
+def exact_predicates(sql, dictionary=None):
+    dictionary = dictionary or load_value_dictionary()
+    if not dictionary["columns"] or time.time() - dictionary["refreshed_at"] > MAX_REWRITE_AGE_SECONDS:
+        return sql
+    tables = referenced_tables(sql)
+    aliases = table_aliases(sql)
+    modified_since = sql_literal(time.strftime(
+        "%Y-%m-%d %H:%M:%S", time.gmtime(dictionary["refreshed_at"] - MODIFIED_MARGIN_SECONDS)
+    ))
+
+    def rewrite(match):
+        column = match.group(2).upper()
+        qualifier = match.group(1)[:match.group(1).rfind(".") + 1]
+        if qualifier:
+            # a.TYPE is only OPPORTUNITY.TYPE when a is OPPORTUNITY; CTE and subquery aliases resolve to nothing
+            table = aliases.get(qualifier[:-1].upper())
+            keys = [f"{table}.{column}"] if f"{table}.{column}" in dictionary["columns"] else []
+        else:
+            keys = [f"{table}.{column}" for table in tables if f"{table}.{column}" in dictionary["columns"]]
+        # An unqualified column shared by several tables in the query is ambiguous
+        if len(keys) != 1:
+            return match.group(0)
+        table = keys[0].split(".")[0]
+        # The modified column is qualified like the filtered one; unqualified, it is only unambiguous on one table
+        if table not in dictionary.get("modified_tables", []) or not (qualifier or len(tables) == 1):
+            return match.group(0)
+        regex = ilike_regex(match.group(3))
+        values = [value for value in dictionary["columns"][keys[0]] if regex.fullmatch(str(value))]
+        # No match may mean a value newer than the dictionary, so leave the scan in place
+        if not values:
+            return match.group(0)
+        rewrite_stats["predicates"] += 1
+        if len(values) == 1:
+            exact = f"{match.group(1)} = {sql_literal(values[0])}"
+        else:
+            exact = f"{match.group(1)} IN ({', '.join(sql_literal(value) for value in values)})"
+        return f"({exact} OR ({match.group(0)} AND {qualifier}{MODIFIED_COLUMN} >= {modified_since}))"
+
+    rewritten = ILIKE_PATTERN.sub(rewrite, sql)
+    rewrite_stats["queries"] += 1
+    rewrite_stats["rewritten"] += rewritten != sql
+    return rewritten
@@ -0,0 +1,234 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+# Function to parse warehouse profiles such as "SMALL_WH:3,COMPUTE_WH", cheapest first.
+# A profile without a cost limit takes every query the earlier profiles do not.
+def parse_warehouse_profiles(spec):
+    profiles = []
+    for entry in spec.split(","):
+        name, _, max_cost = entry.strip().partition(":")
+        if name:
+            profiles.append({"name": name.strip(), "max_cost": int(max_cost) if max_cost.strip() else None})
+    return profiles
+
+# Each query goes to the first profile whose max_cost covers the estimated cost of the query.
+# By default single-table lookups and simple aggregations go to SMALL_WH and everything else to
+# COMPUTE_WH; a warehouse that cannot be used is skipped for the rest of the process.
+DEFAULT_WAREHOUSE_PROFILES = "SMALL_WH:3,COMPUTE_WH"
+WAREHOUSE_PROFILES = (
+    parse_warehouse_profiles(os.environ.get("LOANBOT_WAREHOUSES", ""))
+    or parse_warehouse_profiles(DEFAULT_WAREHOUSE_PROFILES)
+)
+
+# Connections open on the catch-all profile, so queries that bypass routing always have a warehouse
+DEFAULT_WAREHOUSE = WAREHOUSE_PROFILES[-1]["name"]
+
+# Tables that are big enough to make any query touching them expensive
+HEAVY_TABLES = {"TASK", "EVENT", "OPPORTUNITYTEAMMEMBER", "LEAD"}
+
+# Queue time and bytes scanned are looked up for every METRICS_SAMPLE_EVERY-th query, in one batch
+# per METRICS_INTERVAL_SECONDS on the collector's own connection, off the request path
+METRICS_HISTORY = 1000
+METRICS_SAMPLE_EVERY = max(1, int(os.environ.get("LOANBOT_METRICS_SAMPLE_EVERY", "10")))
+METRICS_INTERVAL_SECONDS = 60
+# Query history can lag the query by a little; a missing id is looked for this many times
+METRICS_ATTEMPTS = 3
+
+# Per-warehouse timings, shared by every session in the process
+warehouse_stats = {}
+# Query id -> (queued_ms, bytes_scanned), or None when it was not sampled or the lookup failed
+query_metrics = OrderedDict()
+_stats_lock = threading.Lock()
+# Sampled queries waiting for the next batch: [warehouse, query_id, attempts]
+_pending_metrics = []
+_unavailable_warehouses = set()
+_routed_queries = 0
+_metrics_thread = None
+
+# Functions whose arguments use FROM without naming a table, e.g. EXTRACT(YEAR FROM CLOSEDATE)
+FUNCTION_FROM_PATTERN = re.compile(r"\b(EXTRACT|TRIM|SUBSTRING|POSITION)\s*\(([^()]*?)\bFROM\b", re.IGNORECASE)
+
+# Function to list the tables referenced in a SQL query; table functions such as
+# TABLE(FLATTEN(...)) and LATERAL FLATTEN(...) are not tables
+def referenced_tables(sql):
+    sql = FUNCTION_FROM_PATTERN.sub(r"\1(\2", sql)
+    names = re.findall(r"\b(?:FROM|JOIN)\s+(?:LATERAL\s+)?([A-Za-z0-9_.\"]+)(?![A-Za-z0-9_.\"]|\s*\()", sql, re.IGNORECASE)
+    return {name.replace('"', "").split(".")[-1].upper() for name in names if not name.startswith("(")}
+
+# Function to map each table a query reads, and the alias it is given, to the upper-cased table name
+def table_aliases(sql):
+    aliases = {}
+    for table, alias in re.findall(
+        r"\b(?:FROM|JOIN)\s+(?:[A-Za-z0-9_\"]+\.)*\"?([A-Za-z0-9_]+)\"?(?:\s+(?:AS\s+)?([A-Za-z_][A-Za-z0-9_]*))?",
+        sql, re.IGNORECASE
+    ):
+        aliases[table.upper()] = table.upper()
+        if alias:
+            aliases[alias.upper()] = table.upper()
+    return aliases
+
+# Function to estimate the cost of a query from its tables, joins and aggregations
+def estimate_query_cost(sql):
+    tables = referenced_tables(sql)
+    cost = len(tables)
+    cost += 2 * len(re.findall(r"\bJOIN\b", sql, re.IGNORECASE))
+    cost += 2 * len(tables & HEAVY_TABLES)
+    cost += len(re.findall(r"\b(?:GROUP BY|ORDER BY|OVER|DISTINCT)\b", sql, re.IGNORECASE))
+    cost += len(re.findall(r"\(\s*SELECT\b", sql, re.IGNORECASE))
+    if re.search(r"\bILIKE\s+'%", sql, re.IGNORECASE):
+        cost += 1
+    return cost
+
+# Function to pick the warehouse for a query
+def choose_warehouse(cost):
+    for profile in WAREHOUSE_PROFILES:
+        if profile["name"] in _unavailable_warehouses:
+            continue
+        if profile["max_cost"] is None or cost <= profile["max_cost"]:
+            return profile["name"]
+    return WAREHOUSE_PROFILES[-1]["name"]
+
+def _warehouse_stats(warehouse):
+    return warehouse_stats.setdefault(warehouse, {
+        "queries": 0, "elapsed_ms": 0, "measured": 0, "queued_ms": 0, "bytes_scanned": 0,
+    })
+
+# Function to record how long a query ran on a warehouse
+def record_warehouse_timing(warehouse, elapsed_ms):
+    with _stats_lock:
+        stats = _warehouse_stats(warehouse)
+        stats["queries"] += 1
+        stats["elapsed_ms"] += elapsed_ms
+
+def _store_metrics(query_id, metrics):
+    query_metrics[query_id] = metrics
+    while len(query_metrics) > METRICS_HISTORY:
+        query_metrics.popitem(last=False)
+
+# Function to look up the queue time and bytes scanned Snowflake reported for a batch of queries
+def fetch_query_metrics(conn, query_ids):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT QUERY_ID, QUEUED_OVERLOAD_TIME + QUEUED_PROVISIONING_TIME, BYTES_SCANNED "
+            "FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY(RESULT_LIMIT => 10000)) "
+            f"WHERE QUERY_ID IN ({', '.join(['%s'] * len(query_ids))})",
+            tuple(query_ids)
+        )
+        return {query_id: (queued or 0, scanned or 0) for query_id, queued, scanned in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+# Function to look up the pending sampled queries in one round trip and add them to the warehouse stats
+def collect_query_metrics(conn):
+    with _stats_lock:
+        batch = _pending_metrics[:]
+        del _pending_metrics[:]
+    if not batch:
+        return
+    try:
+        found = fetch_query_metrics(conn, [query_id for _, query_id, _ in batch])
+    except Exception:
+        with _stats_lock:
+            for _, query_id, _ in batch:
+                _store_metrics(query_id, None)
+        raise
+    with _stats_lock:
+        for warehouse, query_id, attempts in batch:
+            metrics = found.get(query_id)
+            if metrics is None and attempts + 1 < METRICS_ATTEMPTS:
+                _pending_metrics.append([warehouse, query_id, attempts + 1])
+                continue
+            if metrics is not None:
+                stats = _warehouse_stats(warehouse)
+                stats["measured"] += 1
+                stats["queued_ms"] += metrics[0]
+                stats["bytes_scanned"] += metrics[1]
+            _store_metrics(query_id, metrics)
+
+def _metrics_loop(conn_factory):
+    conn = None
+    while True:
+        time.sleep(METRICS_INTERVAL_SECONDS)
+        try:
+            conn = conn or conn_factory()
+            collect_query_metrics(conn)
+        except Exception:
+            conn = None
+
+# Function to start collecting sampled query metrics once per process, on its own Snowflake connection
+def start_metrics_sync(conn_factory):
+    global _metrics_thread
+    with _stats_lock:
+        if _metrics_thread is None:
+            _metrics_thread = threading.Thread(target=_metrics_loop, args=(conn_factory,), daemon=True)
+            _metrics_thread.start()
+
+# Function to queue a finished query for the next metrics batch; queries that are not sampled,
+# or run while no collector is running, are marked as not measured straight away
+def track_query(warehouse, query_id):
+    global _routed_queries
+    with _stats_lock:
+        _routed_queries += 1
+        if _metrics_thread is None or _routed_queries % METRICS_SAMPLE_EVERY:
+            _store_metrics(query_id, None)
+        elif len(_pending_metrics) < METRICS_HISTORY:
+            _pending_metrics.append([warehouse, query_id, 0])
+        else:
+            _store_metrics(query_id, None)
+
+# Function to return the metrics already collected for the given query ids; ids still being looked up are left out
+def collected_metrics(query_ids):
+    with _stats_lock:
+        return {query_id: query_metrics[query_id] for query_id in query_ids if query_id in query_metrics}
+
+# Function to switch a connection to a warehouse, falling back to the catch-all profile when it cannot be used
+def use_warehouse(conn, cursor, warehouse):
+    if getattr(conn, "loanbot_warehouse", None) == warehouse:
+        return warehouse
+    try:
+        cursor.execute(f"USE WAREHOUSE {warehouse}")
+    except Exception:
+        fallback = WAREHOUSE_PROFILES[-1]["name"]
+        if warehouse == fallback:
+            raise
+        # Missing or not granted: stop routing to it rather than failing every cheap query
+        with _stats_lock:
+            _unavailable_warehouses.add(warehouse)
+        return use_warehouse(conn, cursor, fallback)
+    conn.loanbot_warehouse = warehouse
+    return warehouse
+
+# Function to execute a query on the warehouse that matches its cost; returns an open cursor.
+# Queue time and bytes scanned are collected in the background for a sample of queries.
+def execute_routed(conn, sql):
+    cursor = conn.cursor()
+    try:
+        warehouse = use_warehouse(conn, cursor, choose_warehouse(estimate_query_cost(sql)))
+        start = time.perf_counter()
+        cursor.execute(sql)
+    except Exception:
+        cursor.close()
+        raise
+    record_warehouse_timing(warehouse, (time.perf_counter() - start) * 1000)
+    query_id = getattr(cursor, "sfqid", None)
+    if query_id:
+        track_query(warehouse, query_id)
+    return cursor
+
+# Function to summarise per-warehouse timings for display
+def warehouse_summary():
+    with _stats_lock:
+        return [
+            {
+                "Warehouse": name,
+                "Queries": stats["queries"],
+                "Avg Queue (ms)": stats["queued_ms"] / stats["measured"] if stats["measured"] else None,
+                "Avg Elapsed (ms)": stats["elapsed_ms"] / stats["queries"],
+                "Avg Scanned (MB)": stats["bytes_scanned"] / stats["measured"] / 1024 ** 2 if stats["measured"] else None,
+            }
+            for name, stats in warehouse_stats.items()
+        ]